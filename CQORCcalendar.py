@@ -1,31 +1,497 @@
 import os
+import json
+import pickle
+import fnmatch
+import hashlib
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
 import interfaces.google.GSheetsInterface as GSheetsInterface
+from interfaces.shared.FileLock import FileLock, write_atomically
+from interfaces.shared.RequestCache import get_cache
+from interfaces.shared.Resilience import InterfaceError
+from common import to_iso8061, get_title, get_trainer_keys
+
+
+def column_letter(index):
+    """
+    Returns the A1 notation of the column at the 0-based index (0 -> 'A', 25 -> 'Z', 26 -> 'AA').
+    """
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def as_cell(value):
+    """
+    Returns the value as it reads in a cell of the sheet, empty cells being read as ''.
+    """
+    return '' if value is None else str(value)
+
+
+def get_runs(indices):
+    """
+    Returns the runs of consecutive integers of a sorted list, as (first, last) tuples: [2, 3, 4, 7] -> [(2, 4), (7, 7)]
+    """
+    runs = []
+    for index in indices:
+        if runs and index == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs += [(index, index)]
+    return runs
+
+
+class Session:
+    """
+    One session of a course, that is one row of one of the calendar sheets.
+
+    The columns are accessed like a dictionary (session['start_date']). The dates are parsed once, and the
+    derived values are computed when first needed and cached until a column is modified.
+    """
+    __slots__ = ('values', 'sheet', 'row', 'course', '_start', '_end', '_title')
+
+    def __init__(self, values, sheet, row, course=None):
+        self.values = values
+        self.sheet = sheet
+        self.row = row
+        self.course = course
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._start = None
+        self._end = None
+        self._title = None
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        self.clear_cache()
+        if self.course:
+            self.course.clear_cache()
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __repr__(self):
+        return repr(self.values)
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def keys(self):
+        return self.values.keys()
+
+    def items(self):
+        return self.values.items()
+
+    @property
+    def start(self):
+        if self._start is None:
+            self._start = to_iso8061(self.values['start_date'])
+        return self._start
+
+    @property
+    def end(self):
+        if self._end is None:
+            self._end = to_iso8061(self.values['end_date'])
+        return self._end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def title(self):
+        if self._title is None:
+            self._title = get_title(self)
+        return self._title
+
+
+class Course:
+    """
+    A course and its sessions, in the order of the calendar sheet.
+
+    course['sessions'] and course['course_id'] are supported for dictionary-style access. For multi-session
+    courses, start and end span from the start of the first session to the end of the last one.
+    """
+    __slots__ = ('course_id', 'sessions', '_start', '_end', '_last_session', '_trainer_keys')
+
+    def __init__(self, course_id):
+        self.course_id = course_id
+        self.sessions = []
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._start = None
+        self._end = None
+        self._last_session = None
+        self._trainer_keys = {}
+
+    def add_session(self, session):
+        session.course = self
+        self.sessions.append(session)
+        self.clear_cache()
+
+    def __getitem__(self, key):
+        if key == 'sessions':
+            return self.sessions
+        if key == 'course_id':
+            return self.course_id
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __repr__(self):
+        return repr({'course_id': self.course_id, 'sessions': self.sessions})
+
+    def keys(self):
+        return ('course_id', 'sessions')
+
+    @property
+    def first_session(self):
+        return self.sessions[0]
+
+    @property
+    def last_session(self):
+        """ The session which ends last """
+        if self._last_session is None:
+            self._last_session = max(self.sessions, key=lambda session: session.end)
+        return self._last_session
+
+    @property
+    def start(self):
+        if self._start is None:
+            self._start = min(session.start for session in self.sessions)
+        return self._start
+
+    @property
+    def end(self):
+        if self._end is None:
+            self._end = self.last_session.end
+        return self._end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def title(self):
+        return self.first_session.title
+
+    def trainer_keys(self, roles):
+        """ Cached equivalent of common.get_trainer_keys(course, roles) """
+        roles = tuple(roles)
+        if roles not in self._trainer_keys:
+            self._trainer_keys[roles] = get_trainer_keys(self, roles)
+        return self._trainer_keys[roles]
+
 
 class Calendar:
-    def __init__(self, global_config, args):
+    # columns holding the identifiers of the external objects, indexed for lookups
+    ID_COLUMNS = ('eventbrite_id', 'zoom_id', 'slack_channel', 'public_gcal_id', 'private_gcal_id', 'post_mortem_private_gcal_id')
+    # columns always loaded, even when a subset of the columns is requested
+    REQUIRED_COLUMNS = ('course_id', 'start_date', 'end_date')
+
+    def __init__(self, global_config, args, columns=None):
+        """
+        Loads the courses from the calendar sheets.
+
+        calendar_sheet_name is either a sheet name, a comma-separated list of sheet names, or a pattern of sheet
+        names (i.e. `20??-??` for one sheet per academic year). All the sheets are read in the same request and
+        merged, each session remembering the sheet it comes from so that modified cells are written back there.
+
+        If args has a `window` attribute (see common.valid_window), only the courses having a session within
+        that window around now are loaded. If columns is given, only these columns (and REQUIRED_COLUMNS) are
+        loaded. Either way, modified cells are written back to their row of the sheet.
+        """
         # take the credentials file either from google section
         credentials_file = global_config['google']['credentials_file']
         secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
         credentials_file_path = os.path.join(secrets_dir, credentials_file)
 
         # initialize the Google Drive interface
-        self.gsheets = GSheetsInterface.GSheetsInterface(credentials_file_path)
+        self.gsheets = GSheetsInterface.GSheetsInterface(credentials_file_path, secrets_dir=secrets_dir)
+        self.logger = logging.getLogger(__name__)
 
         self.spreadsheet_id = global_config['google']['calendar_file']
-        self.sheet_name = global_config['google']['calendar_sheet_name']
-        list_of_sessions = self.gsheets.get_values(self.spreadsheet_id, "A:Z", self.sheet_name)
+        self.sheet_names = self.get_sheet_names(global_config['google']['calendar_sheet_name'])
+
+        # local snapshot of the sheets, reused as long as the spreadsheet revision does not change
+        self.use_snapshot = global_config['google'].getboolean('calendar_snapshot', True)
+        sheets_key = self.sheet_names[0] if len(self.sheet_names) == 1 else \
+            hashlib.sha1("\n".join(self.sheet_names).encode()).hexdigest()[:12]
+        self.snapshot_file = os.path.join(secrets_dir, 'cache', f"calendar_{self.spreadsheet_id}_{sheets_key}.pickle")
+        # lock held by the scripts of this host while they write to the spreadsheet
+        self.lock_file = os.path.join(secrets_dir, 'cache', f"calendar_{self.spreadsheet_id}.lock")
+        # content of the courses as last processed by each consumer, see changed_courses()
+        self.state_dir = os.path.join(secrets_dir, 'cache')
+
+        self.window = getattr(args, 'window', None)
+        self.columns = set(columns) | set(self.REQUIRED_COLUMNS) if columns else None
+        tables = self.load_rows()
 
-        self.header = list_of_sessions[0]
-        sessions = [{self.header[i]: item[i] if i < len(item) else None for i in range(len(self.header))} for item in list_of_sessions[1:]]
+        # header of each sheet, their columns may differ from one year to another
+        self.headers = {sheet: header for sheet, (header, rows) in tables.items()}
+
+        # each session knows its sheet and its row number in the sheet (the header is row 1), to write back single cells
+        sessions = [Session({key: item[i] if i < len(item) else None for i, key in enumerate(header) if self.is_loaded(key)}, sheet, row)
+                    for sheet, (header, rows) in tables.items() for row, item in rows]
+
+        # cells modified since the last update, {(sheet, row, column name): value}
+        self.dirty_cells = {}
+        self.loaded_values = {}
+        self.transaction_depth = 0
 
         self.courses = {}
         for session in sessions:
             course_id = session['course_id']
             if course_id not in self.courses:
-                self.courses[course_id] = {'sessions': []}
+                self.courses[course_id] = Course(course_id)
+            elif self.courses[course_id].first_session.sheet != session.sheet:
+                self.logger.warning(f"Course {course_id} is found in sheets {self.courses[course_id].first_session.sheet} and {session.sheet}, their sessions are merged")
+
+            self.courses[course_id].add_session(session)
+
+        self.build_indexes()
+
+    def get_sheet_names(self, sheet_names):
+        """
+        Returns the list of sheet names matching calendar_sheet_name: comma-separated names, or patterns
+        which are matched against the sheets of the spreadsheet, in the order of the spreadsheet.
+        """
+        names = [name.strip() for name in sheet_names.split(',') if name.strip()]
+        if not any(set(name) & set('*?[') for name in names):
+            return names
+
+        titles = self.gsheets.get_sheet_names(self.spreadsheet_id)
+        matching = [title for title in titles if any(fnmatch.fnmatchcase(title, name) for name in names)]
+        if not matching:
+            self.logger.warning(f"No sheet of the calendar matches {sheet_names}")
+        return matching
+
+    def build_indexes(self):
+        """
+        Builds the lookup indexes: external identifiers -> sessions, (course_id, start_date) -> session,
+        and the list of sessions sorted by start time for range queries.
+        """
+        self.id_index = {column: {} for column in self.ID_COLUMNS}
+        self.start_date_index = {}
+        # sorted list of (start time, position), with the matching sessions in self.indexed_sessions
+        self.start_index = []
+        self.indexed_sessions = []
+        # sessions by their (sheet, row) cell coordinates
+        self.sessions_by_cell = {}
+        self.max_session_duration = timedelta(0)
 
-            self.courses[course_id]['sessions'] += [session]
+        for session in self.get_all_sessions():
+            for column in self.ID_COLUMNS:
+                if session.get(column):
+                    self.id_index[column].setdefault(session[column], []).append(session)
+            self.start_date_index[(session['course_id'], session['start_date'])] = session
+            self.sessions_by_cell[(session.sheet, session.row)] = session
 
+            try:
+                duration = session.duration
+            except (ValueError, TypeError, AttributeError):
+                # sessions without valid dates are not part of the time index
+                continue
+            self.start_index.append((session.start, len(self.indexed_sessions)))
+            self.indexed_sessions.append(session)
+            self.max_session_duration = max(self.max_session_duration, duration)
+
+        self.start_index.sort()
+
+
+    def get_revision(self):
+        """
+        Returns the (version, modifiedTime) of the spreadsheet file in Google Drive, or None if unavailable.
+        """
+        try:
+            metadata = self.gsheets.get_gdrive().get_file(self.spreadsheet_id, "version, modifiedTime")
+        except InterfaceError as error:
+            self.logger.warning(f"Unable to get the revision of the calendar, the snapshot is not used: {error}")
+            return None
+        return (metadata['version'], metadata['modifiedTime'])
+
+    def is_loaded(self, key):
+        return self.columns is None or key in self.columns
+
+    def load_rows(self):
+        """
+        Returns {sheet name: (header, list of (row number, values) to load)} for the calendar sheets.
+
+        The rows come from the local snapshot if the spreadsheet did not change since it was taken. Otherwise, all
+        the sheets are read in a single request, unless a window or a subset of the columns is requested, in which
+        case only the matching cells are read (see load_partial_rows).
+        """
+        revision = self.get_revision() if self.use_snapshot else None
+        values = None
+        if revision:
+            snapshot = self.read_snapshot()
+            if snapshot and snapshot['revision'] == revision:
+                values = snapshot['values']
+
+        if values is None:
+            if self.window or self.columns:
+                return self.load_partial_rows()
+            results = self.gsheets.batch_get_values(self.spreadsheet_id, [f"'{sheet}'!A:Z" for sheet in self.sheet_names])
+            values = dict(zip(self.sheet_names, results))
+            if revision:
+                self.write_snapshot(revision, values)
+
+        tables = {}
+        for sheet, sheet_values in values.items():
+            header = sheet_values[0] if sheet_values else []
+            rows = list(enumerate(sheet_values[1:], start=2))
+            if self.window:
+                selected_rows = self.get_rows_in_window(header, rows)
+                rows = [(row, item) for row, item in rows if row in selected_rows]
+            tables[sheet] = (header, rows)
+        return tables
+
+    def load_partial_rows(self):
+        """
+        Reads only the requested rows and columns of the calendar sheets, with three small batchGet requests
+        covering all the sheets: the headers, the course_id and date columns to find the rows within the window,
+        and the requested cells.
+        """
+        headers = self.gsheets.batch_get_values(self.spreadsheet_id, [f"'{sheet}'!1:1" for sheet in self.sheet_names])
+        headers = {sheet: header[0] if header else [] for sheet, header in zip(self.sheet_names, headers)}
+
+        # runs of consecutive rows to read for each sheet, the end being None for "until the last row"
+        row_runs = {sheet: [(2, None)] for sheet in self.sheet_names}
+        if self.window:
+            key_ranges = [(sheet, column_letter(headers[sheet].index(key)))
+                          for sheet in self.sheet_names for key in self.REQUIRED_COLUMNS]
+            key_values = self.gsheets.batch_get_values(self.spreadsheet_id, [f"'{sheet}'!{c}2:{c}" for sheet, c in key_ranges], "COLUMNS")
+            key_values = [columns[0] if columns else [] for columns in key_values]
+            for n, sheet in enumerate(self.sheet_names):
+                header = headers[sheet]
+                sheet_key_values = key_values[n * len(self.REQUIRED_COLUMNS):(n + 1) * len(self.REQUIRED_COLUMNS)]
+                rows = []
+                for i in range(max(len(values) for values in sheet_key_values)):
+                    item = [None] * len(header)
+                    for key, values in zip(self.REQUIRED_COLUMNS, sheet_key_values):
+                        item[header.index(key)] = values[i] if i < len(values) else None
+                    rows += [(i + 2, item)]
+                row_runs[sheet] = get_runs(sorted(self.get_rows_in_window(header, rows)))
+
+        ranges = [(sheet, column_run, row_run) for sheet in self.sheet_names
+                  for column_run in get_runs([i for i, key in enumerate(headers[sheet]) if self.is_loaded(key)])
+                  for row_run in row_runs[sheet]]
+        results = self.gsheets.batch_get_values(
+            self.spreadsheet_id,
+            [f"'{sheet}'!{column_letter(c1)}{r1}:{column_letter(c2)}{r2 or ''}" for sheet, (c1, c2), (r1, r2) in ranges],
+            "COLUMNS") if ranges else []
+
+        items = {sheet: {} for sheet in self.sheet_names}
+        for sheet in self.sheet_names:
+            for first, last in row_runs[sheet]:
+                if last:
+                    for row in range(first, last + 1):
+                        items[sheet][row] = [None] * len(headers[sheet])
+        for (sheet, (c1, c2), (r1, r2)), columns in zip(ranges, results):
+            for j, column in enumerate(columns):
+                for i, value in enumerate(column):
+                    items[sheet].setdefault(r1 + i, [None] * len(headers[sheet]))[c1 + j] = value
+
+        return {sheet: (headers[sheet], sorted(items[sheet].items())) for sheet in self.sheet_names}
+
+    def get_rows_in_window(self, header, rows):
+        """
+        Returns the row numbers of the courses having at least one session overlapping the window around now.
+        All the rows of these courses are returned, so that multi-session courses are complete.
+        """
+        now = datetime.now().astimezone()
+        window_start, window_end = now + self.window[0], now + self.window[1]
+        course_index, start_index, end_index = [header.index(key) for key in self.REQUIRED_COLUMNS]
+
+        course_rows = {}
+        selected_courses = set()
+        for row, item in rows:
+            course_id, start_date, end_date = [item[i] if i < len(item) else None for i in (course_index, start_index, end_index)]
+            course_rows.setdefault(course_id, []).append(row)
+            try:
+                if to_iso8061(start_date) <= window_end and to_iso8061(end_date) >= window_start:
+                    selected_courses.add(course_id)
+            except (ValueError, TypeError, AttributeError):
+                continue
+
+        return {row for course_id in selected_courses for row in course_rows[course_id]}
+
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        if snapshot.get('spreadsheet_id') != self.spreadsheet_id or snapshot.get('sheet_names') != self.sheet_names:
+            return None
+        return snapshot
+
+    def write_snapshot(self, revision, values):
+        snapshot = {
+            'spreadsheet_id': self.spreadsheet_id,
+            'sheet_names': self.sheet_names,
+            'revision': revision,
+            'values': values,
+        }
+        write_atomically(self.snapshot_file, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def get_session_hash(session):
+        # empty cells are read as None or '', or not returned at the end of a row, depending on how the rows are loaded
+        values = {key: as_cell(value) for key, value in session.values.items() if as_cell(value) != ''}
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+    def get_course_hashes(self, course):
+        return [self.get_session_hash(session) for session in course['sessions']]
+
+    def get_state_file(self, consumer):
+        return os.path.join(self.state_dir, f"calendar_state_{self.spreadsheet_id}_{consumer}.json")
+
+    def read_state(self, consumer):
+        try:
+            with open(self.get_state_file(consumer)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def changed_courses(self, consumer, courses=None):
+        """
+        Returns the courses (all of them by default) which were added or modified since the consumer last
+        saved its state with save_state(), comparing the content hash of each of their rows.
+        """
+        state = self.read_state(consumer)
+        if courses is None:
+            courses = self.get_courses()
+        return [course for course in courses if state.get(course['course_id']) != self.get_course_hashes(course)]
+
+    def save_state(self, consumer, courses):
+        """
+        Records the current content of the courses as processed by the consumer. The courses which are not
+        given keep their previous state. Nothing is saved while modified cells are not written to the sheet,
+        so that the courses are processed again by the next run.
+        """
+        if self.dirty_cells:
+            self.logger.warning(f"The calendar has unsaved changes, not saving the state of {consumer}")
+            return
+        state = self.read_state(consumer)
+        for course in courses:
+            state[course['course_id']] = self.get_course_hashes(course)
+        write_atomically(self.get_state_file(consumer), json.dumps(state, indent=1))
 
     # equivalent of former events_from_sheet_calendar
     def get_all_sessions(self):
@@ -47,29 +513,296 @@ class Calendar:
     def __getitem__(self, course_id):
         return self.courses[course_id]
 
+    def get_sessions_by(self, column, value):
+        """
+        Returns the sessions which have the value in the given identifier column (i.e. 'zoom_id').
+        """
+        return list(self.id_index[column].get(value, []))
+
+    def get_course_by(self, column, value):
+        """
+        Returns the course which has the value in the given identifier column (i.e. 'eventbrite_id'), or None.
+        """
+        sessions = self.id_index[column].get(value)
+        if not sessions:
+            return None
+        return self.courses[sessions[0]['course_id']]
+
+    def get_session(self, course_id, start_date):
+        """
+        Returns the session of the course which starts at start_date (as written in the sheet), or None.
+        """
+        return self.start_date_index.get((course_id, start_date))
+
+    def sessions_between(self, start, end):
+        """
+        Returns the sessions which overlap the [start, end) time interval, sorted by start time.
+        """
+        start = to_iso8061(start)
+        end = to_iso8061(end)
+        # a session overlapping start cannot have started more than max_session_duration before it
+        first = bisect_left(self.start_index, (start - self.max_session_duration,))
+        last = bisect_left(self.start_index, (end,))
+        sessions = [self.indexed_sessions[i] for _, i in self.start_index[first:last]]
+        return [session for session in sessions if session.end > start]
+
+    def sessions_on(self, date):
+        """
+        Returns the sessions which start on the given date (local time), sorted by start time.
+        """
+        day_start = datetime.combine(date, time.min).astimezone()
+        day_end = day_start + timedelta(days=1)
+        first = bisect_left(self.start_index, (day_start,))
+        last = bisect_left(self.start_index, (day_end,))
+        return [self.indexed_sessions[i] for _, i in self.start_index[first:last]]
+
+    def courses_on(self, date):
+        """
+        Returns the courses whose first session starts on the given date (local time).
+        """
+        return [self.courses[session['course_id']] for session in self.sessions_on(date)
+                if self.courses[session['course_id']].first_session is session]
+
+    def next_course(self, after=None):
+        """
+        Returns the first course having a session starting after the given time (now by default), or None.
+        """
+        after = to_iso8061(after or datetime.now())
+        index = bisect_left(self.start_index, (after, float('inf')))
+        if index == len(self.start_index):
+            return None
+        _, i = self.start_index[index]
+        return self.courses[self.indexed_sessions[i]['course_id']]
+
+    def update_indexes(self, session, key, old_value, new_value):
+        if key in self.ID_COLUMNS:
+            if old_value:
+                self.id_index[key][old_value].remove(session)
+                if not self.id_index[key][old_value]:
+                    del self.id_index[key][old_value]
+            if new_value:
+                self.id_index[key].setdefault(new_value, []).append(session)
+
+    def set_value(self, session, key, value):
+        """
+        Sets the value of a field of a session, and records the cell to be written by the next update.
+        """
+        old_value = session.get(key)
+        if old_value == value:
+            return
+        # the value of the cell as loaded, to detect concurrent modifications when writing
+        self.loaded_values.setdefault((session.sheet, session.row, key), old_value)
+        session[key] = value
+        self.update_indexes(session, key, old_value, value)
+        if key not in self.headers[session.sheet]:
+            self.logger.warning(f"Column {key} is not in the calendar sheet {session.sheet}, it will not be saved")
+            return
+        self.dirty_cells[(session.sheet, session.row, key)] = value
+
     def set_eventbrite_id(self, course_id, eventbrite_id):
         for session in self.courses[course_id]['sessions']:
-            session['eventbrite_id'] = eventbrite_id
+            self.set_value(session, 'eventbrite_id', eventbrite_id)
 
     def set_zoom_id(self, course_id, zoom_id):
         for session in self.courses[course_id]['sessions']:
-            session['zoom_id'] = zoom_id
+            self.set_value(session, 'zoom_id', zoom_id)
 
     def set_slack_channel(self, course_id, slack_channel):
         for session in self.courses[course_id]['sessions']:
-            session['slack_channel'] = slack_channel
+            self.set_value(session, 'slack_channel', slack_channel)
 
     def set_gcal_id(self, course_id, session_start_date, gcal_id,  gcal_id_type=""):
-        for session in self.courses[course_id]['sessions']:
-            if session['start_date'] == session_start_date:
-                session[gcal_id_type] = gcal_id
+        session = self.get_session(course_id, session_start_date)
+        if session:
+            self.set_value(session, gcal_id_type, gcal_id)
+
+    def get_column_runs(self, cells):
+        """
+        Groups the (sheet, row, column name) cells into runs of contiguous rows of the same column.
+        Returns a list of (sheet, column name, first row, last row, A1 range).
+        """
+        columns = {}
+        for sheet, row, key in cells:
+            columns.setdefault((sheet, key), set()).add(row)
+
+        runs = []
+        for (sheet, key), rows in columns.items():
+            column = column_letter(self.headers[sheet].index(key))
+            for first, last in get_runs(sorted(rows)):
+                runs += [(sheet, key, first, last, f"'{sheet}'!{column}{first}:{column}{last}")]
+        return runs
+
+    def get_dirty_ranges(self, cells=None):
+        """
+        Returns the modified cells (all the dirty cells by default) as value ranges for a batch update, each in
+        the sheet its session comes from. Modified cells that are contiguous in the same column are coalesced
+        into a single range.
+        """
+        if cells is None:
+            cells = self.dirty_cells
+        return [{
+                    'range': a1_range,
+                    'values': [[cells[(sheet, row, key)]] for row in range(first, last + 1)],
+                } for sheet, key, first, last, a1_range in self.get_column_runs(cells)]
+
+    def read_cells(self, cells):
+        """
+        Reads the current content of the given (sheet, row, column name) cells in a single request.
+        Returns {cell: value}.
+        """
+        runs = self.get_column_runs(cells)
+        # the current content of the sheet is needed, not a response cached earlier in the run
+        with get_cache().disabled():
+            results = self.gsheets.batch_get_values(self.spreadsheet_id, [run[-1] for run in runs], "COLUMNS")
+
+        values = {}
+        for (sheet, key, first, last, a1_range), columns in zip(runs, results):
+            column = columns[0] if columns else []
+            for row in range(first, last + 1):
+                values[(sheet, row, key)] = column[row - first] if row - first < len(column) else ''
+        return values
+
+    def locate_sessions(self, sessions):
+        """
+        Finds the current row of sessions whose row changed since they were loaded (i.e. rows were inserted above
+        them), by their course_id and start_date, in the identity columns of their sheet read in a single request.
+        Returns {session: row} for the sessions found.
+        """
+        sheets = sorted({session.sheet for session in sessions})
+        ranges = []
+        for sheet in sheets:
+            for key in ('course_id', 'start_date'):
+                column = column_letter(self.headers[sheet].index(key))
+                ranges += [f"'{sheet}'!{column}2:{column}"]
+        with get_cache().disabled():
+            results = self.gsheets.batch_get_values(self.spreadsheet_id, ranges, "COLUMNS")
+
+        rows = {}
+        for n, sheet in enumerate(sheets):
+            course_ids, start_dates = [columns[0] if columns else [] for columns in results[2 * n:2 * n + 2]]
+            for i, course_id in enumerate(course_ids):
+                start_date = start_dates[i] if i < len(start_dates) else ''
+                rows.setdefault((sheet, course_id, start_date), i + 2)
+
+        return {session: rows[(session.sheet, as_cell(session['course_id']), as_cell(session['start_date']))]
+                for session in sessions if (session.sheet, as_cell(session['course_id']), as_cell(session['start_date'])) in rows}
+
+    def move_sessions(self, rows):
+        """
+        Moves the sessions to their new row ({session: row}), with their dirty cells.
+        """
+        moved_cells = {}
+        for session in rows:
+            old = (session.sheet, session.row)
+            for cell in [cell for cell in self.dirty_cells if cell[:2] == old]:
+                moved_cells[(session, cell[2])] = (self.dirty_cells.pop(cell), self.loaded_values.pop(cell, None))
+            if self.sessions_by_cell.get(old) is session:
+                del self.sessions_by_cell[old]
+
+        for session, row in rows.items():
+            self.logger.warning(f"Session {session['course_id']} of {session['start_date']} moved from row {session.row} "
+                                f"to row {row} of sheet {session.sheet}, its cells are written there")
+            session.row = row
+            self.sessions_by_cell[(session.sheet, row)] = session
+        for (session, key), (value, loaded_value) in moved_cells.items():
+            self.dirty_cells[(session.sheet, session.row, key)] = value
+            self.loaded_values[(session.sheet, session.row, key)] = loaded_value
+
+    def read_dirty_cells(self):
+        """
+        Reads the current content of the dirty cells and of the identity cells (course_id, start_date) of their rows.
+        """
+        rows = {(sheet, row) for sheet, row, key in self.dirty_cells}
+        identity_cells = {(sheet, row, key) for sheet, row in rows for key in ('course_id', 'start_date')}
+        return self.read_cells(set(self.dirty_cells) | identity_cells)
+
+    def get_cells_to_write(self):
+        """
+        Compares the dirty cells with the current content of the sheet, and returns those which can be written.
+
+        A cell is written only if its row still holds the same session (same course_id and start_date), and if it
+        still holds the value it had when it was loaded, or already holds the new value. Otherwise another script,
+        or someone editing the sheet, modified it in the meantime: the cell is not written and the conflict is logged.
+        When rows were inserted or deleted above a session, the session is found again by its course_id and
+        start_date (see locate_sessions) and its cells are written in its new row. The cells of sessions which
+        cannot be found are kept dirty, so that they are not lost and save_state refuses to record the courses.
+
+        Returns (cells to write, cells to keep dirty).
+        """
+        current = self.read_dirty_cells()
+
+        is_moved = lambda session: any(as_cell(current[(session.sheet, session.row, id_key)]) != as_cell(session.get(id_key))
+                                       for id_key in ('course_id', 'start_date'))
+        moved = {session for session in (self.sessions_by_cell.get((sheet, row)) for sheet, row, key in self.dirty_cells) if is_moved(session)}
+        if moved:
+            rows = self.locate_sessions(moved)
+            # a session is not moved to a row where the cells of a session which cannot be moved are kept
+            occupied = {(sheet, row) for sheet, row, key in self.dirty_cells} - {(session.sheet, session.row) for session in rows}
+            rows = {session: row for session, row in rows.items() if (session.sheet, row) not in occupied}
+            if rows:
+                self.move_sessions(rows)
+                current = self.read_dirty_cells()
+
+        cells = {}
+        kept = {}
+        for (sheet, row, key), value in self.dirty_cells.items():
+            session = self.sessions_by_cell.get((sheet, row))
+            if is_moved(session):
+                self.logger.error(f"Conflict: session {session['course_id']} of {session['start_date']} is not in row {row} of sheet {sheet} "
+                                  f"anymore and its new row is unknown, {key} not saved")
+                kept[(sheet, row, key)] = value
+            elif as_cell(current[(sheet, row, key)]) == as_cell(value):
+                continue
+            elif as_cell(current[(sheet, row, key)]) != as_cell(self.loaded_values[(sheet, row, key)]):
+                self.logger.warning(f"Conflict: {key} of session {session['course_id']} of {session['start_date']} was modified "
+                                    f"to {current[(sheet, row, key)]!r} in the meantime, {value!r} not saved")
+            else:
+                cells[(sheet, row, key)] = value
+        return cells, kept
 
     def update_spreadsheet(self):
-        values = [self.header]
-        for course in self.courses.values():
-            for session in course['sessions']:
-                session_line = [session[k] for k in self.header]
-                values += [session_line]
+        """
+        Writes the cells modified since the last update in a single batch request.
+        Within a transaction, the write is deferred until the end of the transaction.
+
+        Scripts running at the same time on this host write one at a time, under a file lock. Before writing,
+        the target cells are read again, and only the cells which were not modified by someone else since they
+        were loaded are written (see get_cells_to_write), so that parallel runs do not overwrite each other.
+        """
+        if self.transaction_depth or not self.dirty_cells:
+            return
+
+        with FileLock(self.lock_file):
+            try:
+                cells, kept = self.get_cells_to_write()
+            except InterfaceError as error:
+                self.logger.error(f"Unable to read the calendar, {len(self.dirty_cells)} cells not saved: {error}")
+                return
+
+            if cells:
+                try:
+                    self.gsheets.batch_update_values(self.spreadsheet_id, self.get_dirty_ranges(cells))
+                except InterfaceError as error:
+                    self.logger.error(f"Unable to update the calendar, {len(self.dirty_cells)} cells not saved: {error}")
+                    return
+
+        self.dirty_cells = kept
+        self.loaded_values = {cell: value for cell, value in self.loaded_values.items() if cell in kept}
 
-        self.gsheets.update_values(self.spreadsheet_id, "A:Z", values, self.sheet_name)
+    @contextmanager
+    def transaction(self):
+        """
+        Groups the modifications made within the context and writes them in a single request when it exits,
+        even if an exception was raised.
 
+        Usage:
+            with calendar.transaction():
+                calendar.set_zoom_id(course_id, webinar['id'])
+                ...
+        """
+        self.transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self.transaction_depth -= 1
+            self.update_spreadsheet()
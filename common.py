@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import argparse, configparser, os, glob
 import urllib
 import yaml
@@ -34,6 +34,29 @@ def valid_date(d):
     except ValueError:
         raise argparse.ArgumentTypeError(f"Invalid ISO 8061 date value: {d!r}.")
 
+def valid_window(window):
+    """
+    Validate a time window around now, i.e. '-30d:+120d' (units: h, d, w), otherwise raise.
+
+    Returns: a (start, end) tuple of timedelta relative to now
+    """
+    units = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    try:
+        start, end = [timedelta(**{units[bound[-1]]: int(bound[:-1])}) for bound in window.split(':')]
+    except (ValueError, KeyError, IndexError):
+        raise argparse.ArgumentTypeError(f"Invalid window value: {window!r}, expected i.e. -30d:+120d.")
+    if start > end:
+        raise argparse.ArgumentTypeError(f"Invalid window value: {window!r}, the start is after the end.")
+    return start, end
+
+def get_consumer_name(script, args):
+    """
+    Returns the name under which a script records the courses it processed (see Calendar.changed_courses),
+    made of the script name and of its selected actions, i.e. 'zoom-create-update'.
+    """
+    actions = sorted(key for key, value in vars(args).items() if value is True and key not in ('dry_run', 'changed_only'))
+    return '-'.join([script] + actions)
+
 
 def get_config(args, debug_level:int=0):
     '''Read all configuration files (*.cfg) from configuration directories
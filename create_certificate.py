@@ -22,8 +22,8 @@ from email.mime.multipart import MIMEMultipart
 
 import interfaces.eventbrite.EventbriteInterface as Eventbrite
 import interfaces.google.GDriveInterface as GDriveInterface
+from interfaces.shared.Resilience import InterfaceError
 import CQORCcalendar
-from googleapiclient.http import MediaFileUpload
 
 from common import get_config
 
@@ -443,26 +443,17 @@ def upload_certificates_to_gdrive(certificate_dir, gdrive, global_config, dry_ru
         return
 
     print(f"--- Uploading PDFs to Google Drive folder {google_drive_url} ---")
-    uploaded = 0
-    for file_path in files_to_upload:
+    results = gdrive.upload_files(files_to_upload, folder_id, 'application/pdf')
+    for file_path, result in results.items():
         file_name = os.path.basename(file_path)
-        media = MediaFileUpload(file_path, mimetype='application/pdf', resumable=False)
-        drive_file = (
-            gdrive.get_service()
-            .files()
-            .create(
-                body={'name': file_name},
-                media_body=media,
-                fields='id',
-                supportsAllDrives=True,
-            )
-            .execute()
-        )
-
-        gdrive.move_file_to_folder(drive_file['id'], folder_id)
-        uploaded += 1
-        print(f"Uploaded: {file_name}")
+        if isinstance(result, InterfaceError):
+            print(f"Failed to upload: {file_name}: {result}")
+        elif result == "unchanged":
+            print(f"Unchanged, not uploaded: {file_name}")
+        else:
+            print(f"Uploaded: {file_name}")
 
+    uploaded = len([result for result in results.values() if not isinstance(result, InterfaceError) and result != "unchanged"])
     print(f"Upload complete: {uploaded} file(s) transferred to Google Drive.")
     
 
@@ -498,9 +489,10 @@ if __name__ == '__main__':
 
     # Read configuration files:
     global_config = get_config(args)
+    secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
     
     # Initialize EventBrite interface:
-    eb = Eventbrite.EventbriteInterface(global_config['eventbrite']['api_key'])
+    eb = Eventbrite.EventbriteInterface(global_config['eventbrite']['api_key'], secrets_dir)
 
     # Resolve course_id to EventBrite event id via the calendar:
     calendar = CQORCcalendar.Calendar(global_config, args)
@@ -510,9 +502,8 @@ if __name__ == '__main__':
 
     # Google drive interface:
     credentials_file = global_config['google']['credentials_file']
-    secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
     credentials_file_path = os.path.join(secrets_dir, credentials_file)
-    gdrive = GDriveInterface.GDriveInterface(credentials_file_path)
+    gdrive = GDriveInterface.GDriveInterface(credentials_file_path, secrets_dir=secrets_dir)
 
     # Get event information:
     eb_event = eb.get_event(eventbrite_id)
@@ -135,7 +135,8 @@ if __name__ == "__main__":
 
     actualize_repo(config["descriptions"]["repo_url"], config["descriptions"]["local_repo"])
 
-    eb = eventbrite.EventbriteInterface(config["eventbrite"]["api_key"])
+    # the HTTP cache is kept next to the secrets file
+    eb = eventbrite.EventbriteInterface(config["eventbrite"]["api_key"], os.path.dirname(args.secret) or '.')
 
     instructor = Trainers(config['global']["trainers_db"]).fullname(args.instructor)
 
@@ -1,11 +1,13 @@
 #!/bin/env python3
 
-import os, argparse, datetime
+import os, re, argparse, datetime
+from collections import Counter
 
 import interfaces.eventbrite.EventbriteInterface as Eventbrite
 import interfaces.google.GDriveInterface as GDriveInterface
 import interfaces.google.GSheetsInterface as GSheetsInterface
 import interfaces.slack.SlackInterface as SlackInterface
+from interfaces.shared.Resilience import InterfaceError
 import CQORCcalendar
 
 from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, get_title
@@ -33,10 +35,11 @@ credentials_file = global_config['google']['credentials_file']
 secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
 credentials_file_path = os.path.join(secrets_dir, credentials_file)
 # initialize the Google Drive interface
-gdrive = GDriveInterface.GDriveInterface(credentials_file_path)
-gsheets = GSheetsInterface.GSheetsInterface(credentials_file_path)
+gdrive = GDriveInterface.GDriveInterface(credentials_file_path, secrets_dir=secrets_dir)
+gsheets = GSheetsInterface.GSheetsInterface(credentials_file_path, secrets_dir=secrets_dir)
 calendar = CQORCcalendar.Calendar(global_config, args)
 
+course = None
 if args.course_id:
     if args.course_id in calendar.keys():
         course = calendar[args.course_id]
@@ -52,7 +55,7 @@ if args.create_template_file:
     exit(0)
 
 # initialize EventBrite interface:
-eb = Eventbrite.EventbriteInterface(global_config['eventbrite']['api_key'])
+eb = Eventbrite.EventbriteInterface(global_config['eventbrite']['api_key'], secrets_dir)
 
 eventbrite_id =None
 if course:
@@ -76,8 +79,7 @@ else:
 
 # course was not specified, find it from eventbrite_id
 if not course:
-    courses = [course for course in calendar.get_courses() if course['sessions'][0]['eventbrite_id'] == eventbrite_id]
-    course = courses[0]
+    course = calendar.get_course_by('eventbrite_id', eventbrite_id)
 
 # retrieve list of attendees
 attendees = eb.get_event_attendees_registered(eventbrite_id, fields = ['email', 'name'])
@@ -105,25 +107,9 @@ elif 'password_template' in config:
 filename_template = config.get(f"filename_template_{locale}", config.get('filename_template_en'))
 new_file_name = eval('f' + repr(filename_template))
 
-# create or update the spreadsheet
-source_file_id = config.get("template_%s" % locale, config["template_en"])
-if args.update:
-    sheet_id = gdrive.get_file_id(config['google_drive_folder_id'], new_file_name)
-elif args.dry_run:
-    print(f"Dry-run: would copy template to '{new_file_name}' in Google Drive folder {config['google_drive_folder_id']}")
-    sheet_id = None
-else:
-    new_file = gdrive.copy_file(source_file_id, new_file_name, config['google_drive_folder_id'])
-    sheet_id = new_file['id']
-
-# update the spreadsheet
+# Create the data to be inserted, sort by name alphabetically
 header = [[url], [password]]
 header_range = config['header_range']
-if not args.dry_run:
-    gsheets.update_values(sheet_id, header_range, header)
-
-
-# Create the data to be inserted, sort by name alphabetically
 
 if locale == "fr":
     start_username=0;
@@ -136,14 +122,74 @@ data = [
 ]
 
 data_range = config['data_range']
-if args.dry_run:
+
+# create or update the spreadsheet
+source_file_id = config.get("template_%s" % locale, config["template_en"])
+sheet_id = None
+sheet_url = None
+if args.update:
+    sheet_id = gdrive.get_file_id(config['google_drive_folder_id'], new_file_name)
+    if not sheet_id:
+        print(f"Spreadsheet '{new_file_name}' not found")
+        exit(1)
+
+    # read the spreadsheet once. The usernames already given are kept, the cancelled attendees are blanked out
+    # and the new ones are appended after the last row, so that only the changed rows are written
+    try:
+        current_header, current_data = gsheets.batch_get_values(sheet_id, [header_range, data_range])
+    except InterfaceError as error:
+        print(f"Could not read the spreadsheet '{new_file_name}': {error}")
+        exit(1)
+    registered = Counter(attendee['name'] for attendee in attendees.values())
+    updates = []
+    if current_header != header:
+        updates.append({"range": header_range, "values": header})
+
+    # the ranges written are in the sheet of data_range, if it names one
+    cells = GSheetsInterface.split_a1_range(data_range)[1]
+    prefix = data_range[:-len(cells)]
+    first_column, first_row, last_column = re.match(r"([A-Z]+)(\d+):([A-Z]+)", cells).groups()
+    first_row = int(first_row)
+    cancelled = []
+    for row_index, row in enumerate(current_data):
+        name = row[1] if len(row) > 1 else ''
+        if registered[name] > 0:
+            registered[name] -= 1
+        elif name:
+            cancelled.append(name)
+            row_number = first_row + row_index
+            updates.append({"range": f"{prefix}{first_column}{row_number}:{last_column}{row_number}", "values": [[row[0], '']]})
+
+    new_names = sorted(registered.elements(), key=str.casefold)
+    if new_names:
+        data = [
+            [eval('f' + repr(config['username_template'])), name]
+            for user_index, name in enumerate(new_names, start=start_username + len(current_data))
+        ]
+        row_number = first_row + len(current_data)
+        updates.append({"range": f"{prefix}{first_column}{row_number}:{last_column}{row_number + len(data) - 1}", "values": data})
+
+    print(f"{len(new_names)} new attendees, {len(cancelled)} cancelled")
+    if not updates:
+        print(f"Spreadsheet '{new_file_name}' is up to date")
+    elif args.dry_run:
+        print(f"Dry-run: would update spreadsheet '{new_file_name}' with {updates}")
+    else:
+        gsheets.batch_update_values(sheet_id, updates)
+elif args.dry_run:
+    print(f"Dry-run: would copy template to '{new_file_name}' in Google Drive folder {config['google_drive_folder_id']}")
     print(f"Dry-run: would update spreadsheet '{new_file_name}' with url={url}, password={password} and {len(data)} attendees")
 else:
-    gsheets.update_values(sheet_id, data_range, data)
-    # clone the spreadsheet protection
-    gsheets.copy_protection(source_file_id, sheet_id)
+    # the copy is filled and protected in a single request, and its URL is returned with the copy
+    try:
+        sheet_id, sheet_url = gsheets.copy_template(source_file_id, new_file_name, config['google_drive_folder_id'],
+                                                    {header_range: header, data_range: data})
+    except InterfaceError as error:
+        print(f"Could not create the spreadsheet '{new_file_name}': {error}")
+        exit(1)
 
-sheet_url = gdrive.get_file_url(sheet_id) if sheet_id else f"<new spreadsheet: {new_file_name}>"
+if not sheet_url:
+    sheet_url = gdrive.get_file_url(sheet_id) if sheet_id else f"<new spreadsheet: {new_file_name}>"
 
 print(f"URL: {sheet_url}")
 
@@ -163,9 +209,12 @@ else:
 
 start = to_iso8061(event['start']['local'])
 
-if args.dry_run:
+if args.update:
+    # the link was posted when the spreadsheet was created, and --update can run every few minutes
+    print(f"Not posting the link to Slack channel '{channel_name}' again")
+elif args.dry_run:
     print(f"Dry-run: would post to Slack channel '{channel_name}': {message}")
-    print(f"Dry-run: would {'update' if args.update else 'add'} bookmark in '{channel_name}': {sheet_url}")
+    print(f"Dry-run: would add bookmark in '{channel_name}': {sheet_url}")
 else:
     # post now
     slack.post_to_channel(channel_name, message)
@@ -9,8 +9,7 @@ import configparser
 from glob import glob
 #import interfaces.zoom.ZoomInterface as ZoomInterface
 import interfaces.eventbrite.EventbriteInterface as eventbrite
-from common import UTC_FMT, valid_date, to_iso8061, ISO_8061_FORMAT, Trainers, get_config, get_title
-from common import get_trainer_keys
+from common import UTC_FMT, valid_date, ISO_8061_FORMAT, Trainers, get_config, get_title, valid_window, get_consumer_name
 import CQORCcalendar
 
 
@@ -120,6 +119,8 @@ if __name__ == "__main__":
     parser.add_argument("--secrets_dir", default="./secrets", help="Directory that holds the configuration files")
     parser.add_argument("--date", metavar=ISO_8061_FORMAT, type=valid_date, help="Generate for the first event on this date")
     parser.add_argument("--course_id", help="Handle course specified by course_id")
+    parser.add_argument("--window", metavar="START:END", type=valid_window, help="Only load the courses within this window around now, i.e. -30d:+120d")
+    parser.add_argument("--changed-only", default=False, action='store_true', help="Only handle the courses added or modified since the last run with the same actions")
     parser.add_argument("--dry-run", default=False, action='store_true', help="Dry-run")
     parser.add_argument("--create", default=False, action='store_true', help="Create event")
     parser.add_argument("--update", default=False, action='store_true', help="Update event")
@@ -136,7 +137,7 @@ if __name__ == "__main__":
     # no need to actualize the repo if we are not creating or updating the event
     if args.create or args.update:
         actualize_repo(config["descriptions"]["repo_url"], config["descriptions"]["local_repo"])
-    eb = eventbrite.EventbriteInterface(config["eventbrite"]["api_key"])
+    eb = eventbrite.EventbriteInterface(config["eventbrite"]["api_key"], os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir))
 
     # get the courses from the working calendar in the Google spreadsheets
     calendar = CQORCcalendar.Calendar(config, args)
@@ -144,101 +145,107 @@ if __name__ == "__main__":
 
     # keep only courses that start on the date listed
     if args.date:
-        courses = [courses for course in courses if args.date.date().isoformat() in course['sessions'][0]['start_date']]
+        courses = calendar.courses_on(args.date.date())
     # keep only the course for the course_id specified
     if args.course_id:
         courses = [calendar[args.course_id]]
-
-    for course in courses:
-        first_session = course['sessions'][0]
-        instructor = ','.join([trainers.fullname(key) for key in get_trainer_keys(course, ['instructor'])])
-
-        if first_session['code']:
-            # Read the description from the repo
-            with open(os.path.join(config["descriptions"]["local_repo"], f"{first_session['code']}-{first_session['language']}.yaml")) as f:
-                event_description = yaml.safe_load(f)
-        else:
-            event_description = None
-            print("Empty workshop code, skipping updating description")
-
-        # handle course on multiple sessions
-        if len(course['sessions']) > 1:
-            print(f"{event_description['plan']}")
-            if not isinstance(event_description['plan'], list) or not len(event_description['plan']) == len(course['sessions']):
-                print(f"Error: Course is multiple sessions. Expecting a lesson plan that is two-dimensional of length {len(course['sessions'])}.")
-
-            for idx, session in enumerate(course['sessions']):
-                start_date = to_iso8061(session['start_date'])
-                end_date = to_iso8061(session['end_date'])
-
-                event_description['plan'][idx][0] = f"<b>{event_description['plan'][idx][0]} ({start_date.date()}, {start_date.time().__str__()[:5]} - {end_date.time().__str__()[:5]})</b>"
-
-        # Create the event
-        if args.create:
-            if first_session['eventbrite_id']:
-                print(f"Error: event already exists with EventBrite ID: {first_session['eventbrite_id']}")
-                exit(1)
-
-            # for multi-session courses, the duration of the webinar must be from the start to the end
-            start_date = min([to_iso8061(session['start_date']) for session in course['sessions']])
-            end_date = max([to_iso8061(session['end_date']) for session in course['sessions']])
-
-            # Build title based on course code and mode
-            title = get_title(first_session)
-
-            if args.dry_run:
-                print(f"Dry-run: would create {title} {start_date} {end_date}")
-                eventid = "<new_event_id>"
-            else:
-                eventid = eb.create_event_from(
-                    event_id=first_session['template'],
-                    title=title,
-                    start_date=start_date,
-                    end_date=end_date,
-                    tz=config["global"]["timezone"],
-                    summary=event_description["summary"] if event_description else "",
-                )
-                calendar.set_eventbrite_id(first_session['course_id'], eventid)
-                calendar.update_spreadsheet()
-                print(f"Successfully created {title}({eventid}) {start_date} {end_date}")
-        else:
-            eventid = first_session['eventbrite_id']
-
-
-        # Update the event
-        if args.update or args.create:
-            if args.dry_run:
-                print(f"Dry-run: would update {eventid} description and ticket classes")
+    # keep only the courses modified since the last run
+    consumer = get_consumer_name('eventbrite', args)
+    if args.changed_only:
+        courses = calendar.changed_courses(consumer, courses)
+
+    with calendar.transaction():
+        for course in courses:
+            first_session = course['sessions'][0]
+            instructor = ','.join([trainers.fullname(key) for key in course.trainer_keys(['instructor'])])
+
+            if first_session['code']:
+                # Read the description from the repo
+                with open(os.path.join(config["descriptions"]["local_repo"], f"{first_session['code']}-{first_session['language']}.yaml")) as f:
+                    event_description = yaml.safe_load(f)
             else:
-                if event_description:
-                    # Update the description
-                    eb.update_event_description(eventid, str(update_html(
-                        eb.get_event_description(eventid)['description'],
-                        event_description,
-                        instructor,
-                    )))
-                    print(f'Successfully updated {eventid} description')
-
-                # Update tickets classes
-                hours = int(config["eventbrite"]["close_hours_before_event"])
-                eb.update_tickets(eventid, "", (to_iso8061(first_session['start_date']) - timedelta(hours=hours)).astimezone(timezone.utc).strftime(UTC_FMT))
-                print(f'Successfully updated {eventid} ticket classes')
-
-            # Update Zoom webinar
-            # Note: This merely creates a generic webinar, not a Zoom connection
-#            if first_session['zoom_id']:
-#                webinar = zoom.get_webinar(first_session['zoom_id'])
-#                eb.update_webinar_url(eventid, webinar['join_url'])
-
-        # Delete the event
-        if args.delete:
-            if args.dry_run:
-                cmd = f"eb.delete_event {eventid}, calendar.set_eventbrite_id({first_session['course_id']}, {''}), for this course: {get_title(first_session)} "
-                print(f"Dry-run: would run {cmd}")
+                event_description = None
+                print("Empty workshop code, skipping updating description")
+
+            # handle course on multiple sessions
+            if len(course['sessions']) > 1:
+                print(f"{event_description['plan']}")
+                if not isinstance(event_description['plan'], list) or not len(event_description['plan']) == len(course['sessions']):
+                    print(f"Error: Course is multiple sessions. Expecting a lesson plan that is two-dimensional of length {len(course['sessions'])}.")
+
+                for idx, session in enumerate(course['sessions']):
+                    start_date = session.start
+                    end_date = session.end
+
+                    event_description['plan'][idx][0] = f"<b>{event_description['plan'][idx][0]} ({start_date.date()}, {start_date.time().__str__()[:5]} - {end_date.time().__str__()[:5]})</b>"
+
+            # Create the event
+            if args.create and first_session['eventbrite_id']:
+                # the course is not created again, and only updated if requested
+                print(f"Event already exists with EventBrite ID: {first_session['eventbrite_id']}, not creating")
+                if not args.update:
+                    continue
+
+            if args.create and not first_session['eventbrite_id']:
+                # for multi-session courses, the duration of the webinar must be from the start to the end
+                start_date = course.start
+                end_date = course.end
+
+                # Build title based on course code and mode
+                title = first_session.title
+
+                if args.dry_run:
+                    print(f"Dry-run: would create {title} {start_date} {end_date}")
+                    eventid = "<new_event_id>"
+                else:
+                    eventid = eb.create_event_from(
+                        event_id=first_session['template'],
+                        title=title,
+                        start_date=start_date,
+                        end_date=end_date,
+                        tz=config["global"]["timezone"],
+                        summary=event_description["summary"] if event_description else "",
+                    )
+                    calendar.set_eventbrite_id(first_session['course_id'], eventid)
+                    print(f"Successfully created {title}({eventid}) {start_date} {end_date}")
             else:
-                eb.delete_event(eventid)
-                calendar.set_eventbrite_id(first_session['course_id'], '')
-                print(f'Successfully deleted {eventid}')
+                eventid = first_session['eventbrite_id']
+
+
+            # Update the event
+            if args.update or args.create:
+                if args.dry_run:
+                    print(f"Dry-run: would update {eventid} description and ticket classes")
+                else:
+                    if event_description:
+                        # Update the description
+                        eb.update_event_description(eventid, str(update_html(
+                            eb.get_event_description(eventid)['description'],
+                            event_description,
+                            instructor,
+                        )))
+                        print(f'Successfully updated {eventid} description')
+
+                    # Update tickets classes
+                    hours = int(config["eventbrite"]["close_hours_before_event"])
+                    eb.update_tickets(eventid, "", (first_session.start - timedelta(hours=hours)).astimezone(timezone.utc).strftime(UTC_FMT))
+                    print(f'Successfully updated {eventid} ticket classes')
+
+                # Update Zoom webinar
+                # Note: This merely creates a generic webinar, not a Zoom connection
+    #            if first_session['zoom_id']:
+    #                webinar = zoom.get_webinar(first_session['zoom_id'])
+    #                eb.update_webinar_url(eventid, webinar['join_url'])
+
+            # Delete the event
+            if args.delete:
+                if args.dry_run:
+                    cmd = f"eb.delete_event {eventid}, calendar.set_eventbrite_id({first_session['course_id']}, {''}), for this course: {get_title(first_session)} "
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    eb.delete_event(eventid)
+                    calendar.set_eventbrite_id(first_session['course_id'], '')
+                    print(f'Successfully deleted {eventid}')
 
     if not args.dry_run:
-        calendar.update_spreadsheet()
+        calendar.save_state(consumer, courses)
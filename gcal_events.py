@@ -5,15 +5,16 @@ import interfaces.zoom.ZoomInterface as ZoomInterface
 import interfaces.google.GCalInterface as GCalInterface
 import CQORCcalendar
 
-from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, get_title
+from common import valid_date, ISO_8061_FORMAT, get_config, valid_window, get_consumer_name
 from common import get_trainer_keys
 from common import Trainers
-from collections import Counter
 from datetime import datetime, timedelta
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--date", metavar=ISO_8061_FORMAT, type=valid_date, help="Generate for the first event on this date")
 parser.add_argument("--course_id", help="Generate events for the course specified by the course_id")
+parser.add_argument("--window", metavar="START:END", type=valid_window, help="Only load the courses within this window around now, i.e. -30d:+120d")
+parser.add_argument("--changed-only", default=False, action='store_true', help="Only handle the courses added or modified since the last run with the same actions")
 parser.add_argument("--config_dir", default=".", help="Directory that holds the configuration files")
 parser.add_argument("--secrets_dir", default="./secrets", help="Directory that holds the configuration files")
 parser.add_argument("--all", default=False, action='store_true', help="Act for all events")
@@ -34,9 +35,9 @@ secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
 credentials_file = config['google']['credentials_file']
 credentials_file_path = os.path.join(secrets_dir, credentials_file)
 timezone = config['google.calendar'].get('timezone', config['global']['timezone'])
-gcal = GCalInterface.GCalInterface(credentials_file_path, config['google.calendar']['calendar_id'], timezone)
+gcal = GCalInterface.GCalInterface(credentials_file_path, config['google.calendar']['calendar_id'], timezone, secrets_dir=secrets_dir)
 zoom_user = config['zoom']['user']
-zoom = ZoomInterface.ZoomInterface(config['zoom']['account_id'], config['zoom']['client_id'], config['zoom']['client_secret'], config['global']['timezone'], zoom_user)
+zoom = ZoomInterface.ZoomInterface(config['zoom']['account_id'], config['zoom']['client_id'], config['zoom']['client_secret'], config['global']['timezone'], zoom_user, secrets_dir=secrets_dir)
 
 start_offset_minutes = int(config['google.calendar']['start_offset_minutes'])
 
@@ -44,137 +45,164 @@ start_offset_minutes = int(config['google.calendar']['start_offset_minutes'])
 calendar = CQORCcalendar.Calendar(config, args)
 sessions = calendar.get_all_sessions()
 
-# list courses on multiple sessions.
-counter = Counter(item["course_id"] for item in sessions)
-
-# Identify course_ids that appear more than once
-duplicate_ids = {course_id for course_id, count in counter.items() if count > 1}
-
-# Select the session with the latest end_date for each duplicate course_id for the given course_id
-latest_sessions_duplicate_course = {}
-for item in sessions:
-    course_id = item["course_id"]
-    if course_id in duplicate_ids:
-        current_end = to_iso8061(item["end_date"])
-        if course_id not in latest_sessions_duplicate_course or current_end > to_iso8061(latest_sessions_duplicate_course[course_id]["end_date"]):
-            latest_sessions_duplicate_course[course_id] = item
-latest_session = list(latest_sessions_duplicate_course.values())
-latest_session = [session for session in latest_session if args.course_id == session['course_id']]
+# Select the session with the latest end_date for the given course_id, if it is on multiple sessions
+latest_session = []
+if args.course_id in calendar.keys() and len(calendar[args.course_id]['sessions']) > 1:
+    latest_session = [calendar[args.course_id].last_session]
 
 # keep only sessions on the date listed
 if args.date:
-    sessions = [session for session in sessions if args.date.date().isoformat() in session['start_date']]
+    sessions = calendar.sessions_on(args.date.date())
 # keep only sessions for the given course_id
 if args.course_id:
     sessions = [session for session in sessions if args.course_id == session['course_id']]
+# keep only the sessions of the courses modified since the last run
+consumer = get_consumer_name('gcal', args)
+if args.changed_only:
+    changed_courses = calendar.changed_courses(consumer, {session.course for session in sessions})
+    sessions = [session for session in sessions if session.course in changed_courses]
 
 if args.no_notifications:
     send_updates = "none"
 else:
     send_updates = "all"
 
-for session in sessions:
-    try:
-        attendees = [trainers.calendar_email(key) for key in get_trainer_keys(session, ['instructor', 'host', 'assistants'])]
-        webinar = zoom.get_webinar(webinar_id = session['zoom_id'])
-        google_meet_link = config['google.calendar']['google_meet_link']
-        post_mortem_doc_link = config['slack']['post_mortem_link']
-        event_dict = {
-            "course": {
-                "title": f"{get_title(session)}",
-                "start_time": to_iso8061(session['start_date']) + timedelta(minutes=start_offset_minutes),
-                "end_time": to_iso8061(session['end_date']),
-                "description": f"""Voyez l'invitation envoyée par Zoom, ou encore le canal sur Slack pour les liens""",
-                "session_id": 'private_gcal_id'
-            },
-            "post_mortem": {
-                "title": f"{get_title(session)} - post mortem",
-                "start_time": to_iso8061(session['end_date']),
-                "end_time":  to_iso8061(session['end_date']) + timedelta(minutes=30),
-                "description": f"""Voici le lien Google Meet <a href="{google_meet_link}">{google_meet_link}</a> et le Google doc post-mortem <a href="{post_mortem_doc_link}">{post_mortem_doc_link}</a>. Le google doc post-mortem se retrouve aussi sur le canal Slack""",
-                "session_id": 'post_mortem_private_gcal_id'
+failed_sessions = set()
+# the events are created, updated and deleted together after the loop, in a few batch requests
+creations, updates, deletions = [], [], []
+with calendar.transaction():
+    for session in sessions:
+        try:
+            attendees = [trainers.calendar_email(key) for key in get_trainer_keys(session, ['instructor', 'host', 'assistants'])]
+            webinar = zoom.get_webinar(webinar_id = session['zoom_id'])
+            google_meet_link = config['google.calendar']['google_meet_link']
+            post_mortem_doc_link = config['slack']['post_mortem_link']
+            event_dict = {
+                "course": {
+                    "title": f"{session.title}",
+                    "start_time": session.start + timedelta(minutes=start_offset_minutes),
+                    "end_time": session.end,
+                    "description": f"""Voyez l'invitation envoyée par Zoom, ou encore le canal sur Slack pour les liens""",
+                    "session_id": 'private_gcal_id'
+                },
+                "post_mortem": {
+                    "title": f"{session.title} - post mortem",
+                    "start_time": session.end,
+                    "end_time":  session.end + timedelta(minutes=30),
+                    "description": f"""Voici le lien Google Meet <a href="{google_meet_link}">{google_meet_link}</a> et le Google doc post-mortem <a href="{post_mortem_doc_link}">{post_mortem_doc_link}</a>. Le google doc post-mortem se retrouve aussi sur le canal Slack""",
+                    "session_id": 'post_mortem_private_gcal_id'
+                }
             }
-        }
-        event_list = []
-        if args.course:
-            event_list.append(event_dict['course'])
-        if args.post_mortem:
-            event_list.append(event_dict['post_mortem'])
-
-        if args.create:
-            if not latest_session:
-                latest_session = [session]
-            for event_type in event_list:
-                if event_type['session_id'] == 'private_gcal_id' or (event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] == to_iso8061(latest_session[0]['end_date'])):
+            event_list = []
+            if args.course:
+                event_list.append(event_dict['course'])
+            if args.post_mortem:
+                event_list.append(event_dict['post_mortem'])
+
+            if args.create:
+                if not latest_session:
+                    latest_session = [session]
+                for event_type in event_list:
+                    if event_type['session_id'] == 'private_gcal_id' or (event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] == latest_session[0].end):
+                        if session[event_type['session_id']]:
+                            event_id = session[event_type['session_id']]
+                            print(f"Calendar ID found: {session[event_type['session_id']]}, not creating a new event")
+                        elif args.dry_run:
+                            cmd = f"gcal.create_event({event_type['start_time'].isoformat()}, {event_type['end_time'].isoformat()}, {event_type['title']}, {event_type['description']}, {attendees}, send_updates={send_updates})"
+                            print(f"Dry-run: would run {cmd}")
+                        else:
+                            creations.append((session, event_type, {'start_time': event_type['start_time'].isoformat(), 'end_time': event_type['end_time'].isoformat(),
+                                                                    'summary': event_type['title'], 'description': event_type['description'], 'attendees': attendees}))
+
+            elif args.update:
+                if not latest_session:
+                    latest_session = [session]
+                for event_type in event_list:
                     if session[event_type['session_id']]:
                         event_id = session[event_type['session_id']]
-                        print(f"Calendar ID found: {session[event_type['session_id']]}, not creating a new event")
-                    elif args.dry_run:
-                        cmd = f"gcal.create_event({event_type['start_time'].isoformat()}, {event_type['end_time'].isoformat()}, {event_type['title']}, {event_type['description']}, {attendees}, send_updates={send_updates})"
+                    else:
+                        if event_type['session_id'] == 'private_gcal_id':
+                            print(f"This private Google Calendar event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be updated because it has not been created.")  
+                        elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] != latest_session[0].end:
+                            print(f"This event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) has no post-mortem Google Calendar because it is not the last session of the event. It couldn't be updated.")
+                        elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] == latest_session[0].end:
+                            print(f"This post mortem event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be updated because it has not been created.")
+                        event_id = ""
+
+                    if args.dry_run:
+                        if not event_id:
+                            print("Please note that this Google Calendar event has not been created.")
+                        cmd = f"gcal.update_event({event_id}, {event_type['start_time'].isoformat()}, {event_type['end_time'].isoformat()}, {event_type['title']}, {event_type['description']}, {attendees}, send_updates={send_updates})"
                         print(f"Dry-run: would run {cmd}")
                     else:
-                        event = gcal.create_event(event_type['start_time'].isoformat(), event_type['end_time'].isoformat(), event_type['title'], event_type['description'], attendees, send_updates=send_updates)                            
-                        print(f'Successfully created event {event["id"]} for {event_type["title"]}')
-                        calendar.set_gcal_id(session['course_id'], session['start_date'], event['id'], event_type['session_id'])
-                        calendar.update_spreadsheet()
-                        print(f"Google spreadsheet copied google calendar id for session {session['course_id']} - {event_type['title']}")                        
-
-        elif args.update:
-            if not latest_session:
-                latest_session = [session]
-            for event_type in event_list:
-                if session[event_type['session_id']]:
-                    event_id = session[event_type['session_id']]
-                else:
-                    if event_type['session_id'] == 'private_gcal_id':
-                        print(f"This private Google Calendar event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be updated because it has not been created.")  
-                    elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] != to_iso8061(latest_session[0]['end_date']):
-                        print(f"This event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) has no post-mortem Google Calendar because it is not the last session of the event. It couldn't be updated.")
-                    elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] == to_iso8061(latest_session[0]['end_date']):
-                        print(f"This post mortem event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be updated because it has not been created.")
-                    event_id = ""
-
-                if args.dry_run:
-                    if not event_id:
-                        print("Please note that this Google Calendar event has not been created.")
-                    cmd = f"gcal.update_event({event_id}, {event_type['start_time'].isoformat()}, {event_type['end_time'].isoformat()}, {event_type['title']}, {event_type['description']}, {attendees}, send_updates={send_updates})"
-                    print(f"Dry-run: would run {cmd}")
-                else:
-                    if event_id:
-                        gcal.update_event(event_id, event_type['start_time'].isoformat(), event_type['end_time'].isoformat(), event_type['title'], event_type['description'], attendees, send_updates=send_updates)
-                        print(f"Successfully updated event {event_id} for {event_type['title']}")
-
-        elif args.delete:
-            if not latest_session:
-                latest_session = [session]
-            for event_type in event_list:
-                if session[event_type['session_id']]:
-                    event_id = session[event_type['session_id']]
-                else:
-                    if event_type['session_id'] == 'private_gcal_id':
-                        print(f"This private Google Calendar event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be deleted because it does not exist.")  
-                    elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] != to_iso8061(latest_session[0]['end_date']):
-                        print(f"This event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) has no post-mortem Google Calendar entry because it is not the last session of the event. It cannot be deleted because it does not exist.")
-                    elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] == to_iso8061(latest_session[0]['end_date']):
-                        print(f"This post-mortem event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be deleted because it does not exist.")
-                    event_id = ""
-
-                if args.dry_run:
-                    if not event_id:
-                        print("Please note that this Google Calendar event has not been created.")
-                    print(f"Dry-run: would delete event {event_id} ({event_type['title']}), send_updates={send_updates}")
-                else:
-                    if event_id:
-                        gcal.delete_event(event_id, send_updates=send_updates)
-                        print(f"Successfully deleted event {event_id} for {event_type['title']}")
-                        calendar.set_gcal_id(session['course_id'], session['start_date'], '', event_type['session_id'])
-                        calendar.update_spreadsheet()
-                        print(f"Google spreadsheet deleted google calendar id for session {session['course_id']} - {event_type['title']}")
+                        if event_id:
+                            updates.append((session, event_type, {'event_id': event_id, 'start_time': event_type['start_time'].isoformat(), 'end_time': event_type['end_time'].isoformat(),
+                                                                  'summary': event_type['title'], 'description': event_type['description'], 'attendees': attendees}))
+
+            elif args.delete:
+                if not latest_session:
+                    latest_session = [session]
+                for event_type in event_list:
+                    if session[event_type['session_id']]:
+                        event_id = session[event_type['session_id']]
+                    else:
+                        if event_type['session_id'] == 'private_gcal_id':
+                            print(f"This private Google Calendar event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be deleted because it does not exist.")  
+                        elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] != latest_session[0].end:
+                            print(f"This event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) has no post-mortem Google Calendar entry because it is not the last session of the event. It cannot be deleted because it does not exist.")
+                        elif event_type['session_id'] == 'post_mortem_private_gcal_id' and event_type['start_time'] == latest_session[0].end:
+                            print(f"This post-mortem event (course id : {session['course_id']}, start date: {event_type['start_time'].isoformat()}) cannot be deleted because it does not exist.")
+                        event_id = ""
+
+                    if args.dry_run:
+                        if not event_id:
+                            print("Please note that this Google Calendar event has not been created.")
+                        print(f"Dry-run: would delete event {event_id} ({event_type['title']}), send_updates={send_updates}")
+                    else:
+                        if event_id:
+                            deletions.append((session, event_type, event_id))
 
-    except Exception as error:
-        print(f"Error encountered when processing session {session}: %s" % error)
+        except Exception as error:
+            print(f"Error encountered when processing session {session}: %s" % error)
+            failed_sessions.add(session)
+
+    try:
+        if creations:
+            events = gcal.create_events([event for session, event_type, event in creations], send_updates=send_updates)
+            for (session, event_type, _), event in zip(creations, events):
+                if isinstance(event, Exception):
+                    print(f"Error encountered when creating event {event_type['title']} for session {session}: {event}")
+                    failed_sessions.add(session)
+                    continue
+                print(f'Successfully created event {event["id"]} for {event_type["title"]}')
+                calendar.set_gcal_id(session['course_id'], session['start_date'], event['id'], event_type['session_id'])
+                print(f"Google spreadsheet copied google calendar id for session {session['course_id']} - {event_type['title']}")
+
+        if updates:
+            events = gcal.update_events([event for session, event_type, event in updates], send_updates=send_updates)
+            for (session, event_type, event), result in zip(updates, events):
+                if isinstance(result, Exception):
+                    print(f"Error encountered when updating event {event['event_id']} for session {session}: {result}")
+                    failed_sessions.add(session)
+                    continue
+                print(f"Successfully updated event {event['event_id']} for {event_type['title']}")
+
+        if deletions:
+            results = gcal.delete_events([event_id for session, event_type, event_id in deletions], send_updates=send_updates)
+            for (session, event_type, event_id), error in zip(deletions, results):
+                if error:
+                    print(f"Error encountered when deleting event {event_id} for session {session}: {error}")
+                    failed_sessions.add(session)
+                    continue
+                print(f"Successfully deleted event {event_id} for {event_type['title']}")
+                calendar.set_gcal_id(session['course_id'], session['start_date'], '', event_type['session_id'])
+                print(f"Google spreadsheet deleted google calendar id for session {session['course_id']} - {event_type['title']}")
 
+    except Exception as error:
+        print(f"Error encountered when sending the calendar events: {error}")
+        failed_sessions.update(session for session, _, _ in creations + updates + deletions)
 
+# the courses are processed only if all their selected sessions (i.e. those of --date) were processed
 if not args.dry_run:
-    calendar.update_spreadsheet()
-
+    calendar.save_state(consumer, [course for course in {session.course for session in sessions}
+                                   if not failed_sessions.intersection(course['sessions'])])
@@ -1,10 +1,19 @@
 import eventbrite as eb
+from eventbrite.compat import json
+from eventbrite.decorators import objectify
+from eventbrite.utils import format_path
 from requests.models import PreparedRequest
 import os
 import itertools
 import configparser
 import logging
 from datetime import datetime, timezone
+from interfaces.shared.HttpSession import get_session
+from interfaces.shared.RateLimiter import get_scheduler
+from interfaces.shared.RequestCache import get_cache, resource_path
+from interfaces.shared.HttpCache import get_http_cache
+from interfaces.shared import Resilience
+from interfaces.shared.Resilience import InterfaceError
 
 
 class EventbriteInterface(eb.Eventbrite):
@@ -16,9 +25,81 @@ class EventbriteInterface(eb.Eventbrite):
     UTC_FMT = '%Y-%m-%dT%H:%M:%SZ'
     ISO_8061_FORMAT = "YYYY-MM-DD[THH:MM:SS[±HH:MM]]"
 
-    def __init__(self, token):
+    def __init__(self, token, secrets_dir="./secrets"):
         super(EventbriteInterface, self).__init__(token)
         self.logger = logging.getLogger(__name__)
+        # directory of the HTTP cache
+        self.secrets_dir = secrets_dir
+        # connections are kept alive between the calls to the API
+        self.session = get_session()
+
+    def send(self, method, path, **kwargs):
+        """
+        Send a request through the shared session, within the rate limits of Eventbrite.
+        Throttled requests (HTTP 429) are retried after a delay. Requests other than POST are
+        also retried, with a backoff, on network errors and 5xx responses.
+        Raises InterfaceError if the request still fails after the retries.
+
+        Successful GET responses are cached for the rest of the run, and the other requests
+        invalidate the cached responses of the same resource (see RequestCache). Between runs,
+        GET responses are kept on disk for a few minutes (see HttpCache).
+
+        The resources are compared without the query of their URL, so that a POST to
+        /events/ID/structured_content/N/ invalidates /events/ID/structured_content/?purpose=digital_content.
+        """
+        resource = resource_path(path)
+        if method == 'GET':
+            request_key = f"{path} {json.dumps(kwargs.get('params'), sort_keys=True, default=str)}"
+            return get_cache().get('eventbrite', resource, request_key,
+                                   lambda: get_http_cache(self.secrets_dir).send('eventbrite', resource, request_key,
+                                       lambda headers: self.send_request(method, path,
+                                           **dict(kwargs, headers={**kwargs.get('headers', {}), **headers}))),
+                                   cacheable=lambda response: response.ok)
+
+        try:
+            return self.send_request(method, path, **kwargs)
+        finally:
+            get_cache().invalidate('eventbrite', resource)
+            get_http_cache(self.secrets_dir).invalidate('eventbrite', resource)
+
+    def send_request(self, method, path, **kwargs):
+        """
+        Send a request, without the cache, within the rate limits and with retries (see send()).
+        """
+        return Resilience.call(
+            'eventbrite',
+            lambda: get_scheduler().call(
+                'eventbrite', 'default',
+                lambda: self.session.request(method, path, **kwargs),
+                is_throttled=lambda response: getattr(response, 'status_code', None) == 429,
+                retry_after=lambda response: response.headers.get('Retry-After')),
+            is_transient=lambda response: Resilience.is_transient_error(response) or
+                getattr(response, 'status_code', None) in Resilience.RETRYABLE_STATUSES,
+            idempotent=method != 'POST',
+            get_status=lambda response: getattr(response, 'status_code', None))
+
+    # get, post and delete are those of eb.Eventbrite, sending the requests with send()
+    @objectify
+    def get(self, path, data=None, expand=()):
+        headers = self.headers
+        headers.pop('content-type', None)
+        path = format_path(path, self.eventbrite_api_url)
+
+        if data is None:
+            data = {}
+        if not data.get('expand'):
+            data['expand'] = ','.join(expand) if expand else 'none'
+        return self.send('GET', path, headers=headers, params=data)
+
+    @objectify
+    def post(self, path, data=None):
+        path = format_path(path, self.eventbrite_api_url)
+        return self.send('POST', path, headers=self.headers, data=json.dumps(data or {}))
+
+    @objectify
+    def delete(self, path, data=None):
+        path = format_path(path, self.eventbrite_api_url)
+        return self.send('DELETE', path, headers=self.headers, data=data or {})
 
     def get_pages(self, url, key, **params):
         """
@@ -82,12 +163,12 @@ class EventbriteInterface(eb.Eventbrite):
 
     def _raise_or_ok(self, response):
         """
-        Raise exception if response is not OK
+        Raise InterfaceError if response is not OK
         """
         if response.ok:
             return response
         else:
-            raise Exception(response)
+            raise InterfaceError('eventbrite', response, status=response.status_code, response=response)
 
     def _to_iso8061(self, dt, tz=None):
         """
@@ -145,7 +226,7 @@ class EventbriteInterface(eb.Eventbrite):
             self.logger.debug(f"Created event {response['id']}")
         else:
             self.logger.error(f'Error creating event! Got {response}')
-            raise Exception(response)
+            raise InterfaceError('eventbrite', response, status=response.status_code, response=response)
 
         return response["id"]
 
@@ -376,7 +457,7 @@ if __name__ == '__main__':
         glob(os.path.join(os.environ.get('CQORC_SECRET_DIR', '.'), '*.cfg'))
     )
 
-    eb = EventbriteInterface(config['eventbrite']['api_key'])
+    eb = EventbriteInterface(config['eventbrite']['api_key'], os.environ.get('CQORC_SECRET_DIR', '.'))
     lang = 'fr'
 
     # Test get template event
@@ -1,150 +1,469 @@
 #!/usr/bin/env python3
 import datetime
+import hashlib
+import json
 import logging
 import os
+import time
 import pytz
 
 try:
-    from interfaces.google.GoogleInterface import GoogleInterface
+    from interfaces.google.GoogleInterface import GoogleInterface, is_rate_limited, is_transient, to_interface_error
 except:
-    from GoogleInterface import GoogleInterface
+    from GoogleInterface import GoogleInterface, is_rate_limited, is_transient, to_interface_error
 from googleapiclient.errors import HttpError
+from interfaces.shared.RateLimiter import get_scheduler
+from interfaces.shared.RequestCache import get_cache, resource_path
+from interfaces.shared.HttpCache import get_http_cache
+from interfaces.shared import Resilience
+from interfaces.shared.FileLock import FileLock, write_atomically
+
+
+# result of the requests of a batch until Google answers them
+NOT_ANSWERED = object()
+
+
+class CalendarMirror:
+    """
+    Local copy of the events of a calendar, kept up to date with incremental synchronizations.
+
+    The first refresh lists all the events, and Google returns a sync token with the last page. The next
+    refreshes, including those of later runs since the mirror is saved in <secrets>/cache, only list the
+    events added, modified or deleted since the token was issued. When Google no longer accepts the token
+    (410 Gone), the events are all listed again.
+    https://developers.google.com/calendar/api/guides/sync
+    """
+    PAGE_SIZE = 2500
+
+    def __init__(self, gcal):
+        self.gcal = gcal
+        name = hashlib.sha1(gcal.calendar_id.encode('utf-8')).hexdigest()[:12]
+        self.path = os.path.join(gcal.secrets_dir, 'cache', f"gcal_{name}.json")
+        self.logger = logging.getLogger(__name__)
+        self.sync_token = None
+        self.events = {}
+        # event ids by local start date, rebuilt when the events change
+        self.dates = None
+
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                mirror = json.load(f)
+        except (OSError, ValueError):
+            return
+        if mirror.get('calendar_id') == self.gcal.calendar_id:
+            self.sync_token = mirror['sync_token']
+            self.events = mirror['events']
+            self.dates = None
+
+
+    def save(self):
+        write_atomically(self.path, json.dumps({'calendar_id': self.gcal.calendar_id, 'sync_token': self.sync_token, 'events': self.events}))
+
+
+    def refresh(self):
+        """Fetches the changes since the last synchronization, of this or of another run"""
+        with FileLock(self.path + ".lock"):
+            self.load()
+            try:
+                self.sync()
+            except Resilience.InterfaceError as error:
+                if error.status != 410:
+                    raise
+                self.logger.info(f"Sync token of the calendar {self.gcal.calendar_id} expired, listing all the events")
+                self.sync_token = None
+                self.events = {}
+                self.sync()
+            self.save()
+
+
+    def sync(self):
+        # documentation: https://developers.google.com/calendar/api/v3/reference/events/list
+        page_token = None
+        while True:
+            params = {'calendarId': self.gcal.calendar_id, 'singleEvents': True, 'showDeleted': True, 'maxResults': self.PAGE_SIZE}
+            if self.sync_token:
+                params['syncToken'] = self.sync_token
+            if page_token:
+                params['pageToken'] = page_token
+            # the changes are listed again by each synchronization, never served from the cache of the run
+            with get_cache().disabled():
+                response = self.gcal.get_service().events().list(**params).execute()
+            for event in response.get('items', []):
+                self.update(event)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                self.sync_token = response.get('nextSyncToken')
+                return
+
+
+    def update(self, event):
+        if event.get('status') == 'cancelled':
+            self.events.pop(event['id'], None)
+        else:
+            self.events[event['id']] = event
+        self.dates = None
+
+
+    def remove(self, event_id):
+        self.events.pop(event_id, None)
+        self.dates = None
+
+
+    def get(self, event_id):
+        return self.events.get(event_id)
+
+
+    def get_start(self, event):
+        start = event.get('start', {})
+        if 'dateTime' in start:
+            return datetime.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00')).astimezone(self.gcal.tzinfo)
+        return self.gcal.tzinfo.localize(datetime.datetime.fromisoformat(start['date']))
+
+
+    def events_on(self, date):
+        """Events starting on the given date, in the time zone of the calendar, sorted by start time"""
+        if self.dates is None:
+            self.dates = {}
+            for event_id, event in self.events.items():
+                try:
+                    self.dates.setdefault(self.get_start(event).date(), []).append(event_id)
+                except (KeyError, ValueError):
+                    continue
+        events = [self.events[event_id] for event_id in self.dates.get(date, [])]
+        return sorted(events, key=self.get_start)
+
+
+    def is_up_to_date(self, event_id, fields):
+        """True if the mirrored event already has the given fields (as built by GCalInterface.make_event)"""
+        event = self.events.get(event_id)
+        if not event:
+            return False
+        for key, value in fields.items():
+            if key in ('start', 'end'):
+                try:
+                    if self.get_start({'start': event.get(key, {})}) != self.get_start({'start': value}):
+                        return False
+                except (KeyError, ValueError):
+                    return False
+            elif key == 'attendees':
+                if {a['email'].lower() for a in event.get(key, [])} != {a['email'].lower() for a in value}:
+                    return False
+            elif event.get(key, 'opaque' if key == 'transparency' else None) != value:
+                # Google omits the transparency of the events which are opaque, the default
+                return False
+        return True
+
 
 class GCalInterface(GoogleInterface):
-    def __init__(self, key_file, calendar_id, timezone = "America/Montreal", credentials_type='user'):
-        super(GCalInterface, self).__init__(key_file, credentials_type, 'calendar', 'v3', ['https://www.googleapis.com/auth/calendar.events'])
+    # maximum number of requests in a batch of the Calendar API
+    BATCH_SIZE = 50
+    # the requests of a batch which fail transiently are sent again, up to this number of times
+    batch_attempts = 4
+
+    def __init__(self, key_file, calendar_id, timezone = "America/Montreal", credentials_type='user', secrets_dir="./secrets"):
+        super(GCalInterface, self).__init__(key_file, credentials_type, 'calendar', 'v3', ['https://www.googleapis.com/auth/calendar.events'], secrets_dir)
         self.logger = logging.getLogger(__name__)
         self.calendar_id = calendar_id
         self.timezone = timezone
         self.tzinfo = pytz.timezone(self.timezone)
+        # etag of the events read or written, by event id, sent with If-Match when they are patched
+        self.etags = {}
+        self.mirror = None
 
 
-    def get_event(self, event_id):
-        try:
-            event = self.get_service().events().get(calendarId=self.calendar_id, eventId=event_id).execute()
-            return event
+    def get_mirror(self):
+        """Local copy of the calendar (see CalendarMirror), synchronized on its first use in the run"""
+        if self.mirror is None:
+            self.mirror = CalendarMirror(self)
+            self.mirror.refresh()
+        return self.mirror
 
-        except HttpError as error:
-            self.logger.error('An error occurred: %s' % error)
+
+    def get_event(self, event_id):
+        event = self.get_service().events().get(calendarId=self.calendar_id, eventId=event_id).execute()
+        return self.remember(event)
 
 
     def get_events(self, start_time, limit=10, end_time=None):
-        try:
+        # returns up to limit events (all of them if limit is None), listed page by page
+        events = []
+        page_token = None
+        while limit is None or len(events) < limit:
+            params = {'calendarId': self.calendar_id, 'timeMin': start_time, 'singleEvents': True, 'orderBy': 'startTime',
+                      'maxResults': min(limit - len(events), CalendarMirror.PAGE_SIZE) if limit else CalendarMirror.PAGE_SIZE}
             if end_time:
-                events_result = self.get_service().events().list(calendarId=self.calendar_id, timeMin=start_time,
-                                              timeMax=end_time,
-                                              maxResults=limit, singleEvents=True,
-                                              orderBy='startTime').execute()
-            else:
-                events_result = self.get_service().events().list(calendarId=self.calendar_id, timeMin=start_time,
-                                              maxResults=limit, singleEvents=True,
-                                              orderBy='startTime').execute()
-            events = events_result.get('items', [])
-            return events
-
-        except HttpError as error:
-            self.logger.error('An error occurred: %s' % error)
+                params['timeMax'] = end_time
+            if page_token:
+                params['pageToken'] = page_token
+            events_result = self.get_service().events().list(**params).execute()
+            events += events_result.get('items', [])
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                break
+        return [self.remember(event) for event in events]
 
 
     def get_events_by_date(self, date, limit=10):
-        try:
-            # get the start of day
-            start_time = date.replace(hour=0, minute=0, second=0)
-            end_time = date.replace(hour=23, minute=59, second=59)
-            if start_time.tzinfo is None:
-                start_time = self.tzinfo.localize(start_time).astimezone(pytz.utc)
-                end_time = self.tzinfo.localize(end_time).astimezone(pytz.utc)
-            start_time = start_time.isoformat()
-            end_time = end_time.isoformat()
-            events = self.get_events(start_time, limit=limit, end_time=end_time)
-            return events
-
-        except HttpError as error:
-            self.logger.error('An error occurred: %s' % error)
+        # served by the local copy of the calendar
+        if date.tzinfo is not None:
+            date = date.astimezone(self.tzinfo)
+        return [self.remember(event) for event in self.get_mirror().events_on(date.date())[:limit]]
+
+
+    def remember(self, event):
+        if event and 'id' in event and 'etag' in event:
+            self.etags[event['id']] = event['etag']
+            if self.mirror is not None:
+                self.mirror.update(event)
+        return event
+
+
+    def make_patch(self, event_id, body, send_updates, etag=None):
+        """
+        Request patching the given fields of an event. It is sent with If-Match and the etag of the event, if it
+        is known, so that Google answers 412 Precondition Failed if the event was modified in the meantime.
+        """
+        # documentation: https://developers.google.com/calendar/api/v3/reference/events/patch
+        # https://developers.google.com/calendar/api/guides/version-resources
+        request = self.get_service().events().patch(
+                        calendarId=self.calendar_id,
+                        eventId=event_id,
+                        body=body,
+                        sendUpdates=send_updates
+                        )
+        etag = etag or self.etags.get(event_id)
+        if not etag and self.mirror is not None and self.mirror.get(event_id):
+            etag = self.mirror.get(event_id).get('etag')
+        if etag:
+            request.headers['If-Match'] = etag
+        return request
+
+
+    def make_event(self, start_time=None, end_time=None, summary=None, description=None, attendees=None):
+        # reference for fields of an event
+        # https://developers.google.com/calendar/api/v3/reference/events#resource
+        event_dict = {}
+        if start_time: event_dict['start'] = {'dateTime': start_time, 'timeZone': self.timezone}
+        if end_time: event_dict['end'] = {'dateTime': end_time, 'timeZone': self.timezone}
+        if summary: event_dict['summary'] = summary
+        if description: event_dict['description'] = description
+        event_dict['transparency'] = 'opaque'
+        if isinstance(attendees, str):
+            attendees = [{'email': x.strip()} for x in attendees.split(',')]
+        if isinstance(attendees, list) and attendees and isinstance(attendees[0], str):
+            attendees = [{'email': x} for x in attendees]
+        if attendees: event_dict['attendees'] = attendees
+        return event_dict
 
 
     def create_event(self, start_time, end_time, summary, description, attendees, send_updates="all"):
         # create an event
         # documentation: https://developers.google.com/calendar/api/v3/reference/events/insert
-        try:
-            # reference for fields of an event
-            # https://developers.google.com/calendar/api/v3/reference/events#resource
-            event_dict = {}
-            event_dict['start'] = {'dateTime': start_time, 'timeZone': self.timezone}
-            event_dict['end'] = {'dateTime': end_time, 'timeZone': self.timezone}
-            event_dict['summary'] = summary
-            event_dict['description'] = description
-            event_dict['transparency'] = 'opaque'
-            if isinstance(attendees, str):
-                attendees = [{'email': x.strip()} for x in attendees.split(',')]
-            if isinstance(attendees, list) and isinstance(attendees[0], str):
-                attendees = [{'email': x} for x in attendees]
-            event_dict['attendees'] = attendees
-
-            event = self.get_service().events().insert(
-                        calendarId=self.calendar_id,
-                        body=event_dict,
-                        sendUpdates=send_updates
-                        ).execute()
-            self.logger.info("Event created: %s" % (event.get('htmlLink')))
-            return event
-        except HttpError as error:
-            self.logger.error('An error occurred: %s' % error)
+        event = self.get_service().events().insert(
+                    calendarId=self.calendar_id,
+                    body=self.make_event(start_time, end_time, summary, description, attendees),
+                    sendUpdates=send_updates
+                    ).execute()
+        self.logger.info("Event created: %s" % (event.get('htmlLink')))
+        return self.remember(event)
 
 
     def update_event(self, event_id, start_time=None, end_time=None, summary=None, description=None, attendees=None, send_updates="all"):
-        # update an event
-        # documentation: https://developers.google.com/calendar/api/v3/reference/events/update
+        # update the given fields of an event, the others are left unchanged
+        body = self.make_event(start_time, end_time, summary, description, attendees)
         try:
-            # reference for fields of an event
-            # https://developers.google.com/calendar/api/v3/reference/events#resource
-            event = self.get_event(event_id)
-            if start_time: event['start'] = {'dateTime': start_time, 'timeZone': self.timezone}
-            if end_time: event['end'] = {'dateTime': end_time, 'timeZone': self.timezone}
-            if summary: event['summary'] = summary
-            if description: event['description'] = description
-            event['transparency'] = 'opaque'
-
-            if isinstance(attendees, str):
-                attendees = [{'email': x.strip()} for x in attendees.split(',')]
-            if isinstance(attendees, list) and isinstance(attendees[0], str):
-                attendees = [{'email': x} for x in attendees]
-            if attendees: event['attendees'] = attendees
-
-            event = self.get_service().events().update(
-                        calendarId=self.calendar_id,
-                        eventId=event_id,
-                        body=event,
-                        sendUpdates=send_updates
-                        ).execute()
-            self.logger.info("Event updated: %s" % (event.get('htmlLink')))
-            return event
-        except HttpError as error:
-            self.logger.error('An error occurred: %s' % error)
-
-
-    def add_attendees(self, event_id, attendees):
-        # update an event
-        # documentation: https://developers.google.com/calendar/api/v3/reference/events/update
-        event = self.get_event(event_id)
+            event = self.make_patch(event_id, body, send_updates).execute()
+        except Resilience.InterfaceError as error:
+            if error.status != 412:
+                raise
+            # the event was modified since it was read: the fields are set again on its current version
+            self.logger.warning(f"Event {event_id} was modified in the meantime, updating its current version")
+            self.etags.pop(event_id, None)
+            self.get_event(event_id)
+            event = self.make_patch(event_id, body, send_updates).execute()
+        self.logger.info("Event updated: %s" % (event.get('htmlLink')))
+        return self.remember(event)
+
+
+    def add_attendees(self, event_id, attendees, send_updates="all"):
+        # add attendees to the current ones, sending only the attendees
         if isinstance(attendees, str):
             attendees = [{'email': x.strip()} for x in attendees.split(',')]
-        attendees += event['attendees']
-        return self.update_event(event_id, attendees = attendees)
+        for attempt in range(self.batch_attempts):
+            event = self.get_event(event_id)
+            try:
+                event = self.make_patch(event_id, {'attendees': attendees + event.get('attendees', [])},
+                                        send_updates, etag=event['etag']).execute()
+                self.logger.info("Event updated: %s" % (event.get('htmlLink')))
+                return self.remember(event)
+            except Resilience.InterfaceError as error:
+                # 412: the attendees were modified since the event was read, they are read again
+                if error.status != 412 or attempt == self.batch_attempts - 1:
+                    raise
+                self.etags.pop(event_id, None)
 
 
     def delete_event(self, event_id, send_updates="all"):
         # delete an event
         # documentation: https://developers.google.com/calendar/api/v3/reference/events/delete
-        try:
-            event = self.get_service().events().delete(
+        self.get_service().events().delete(
+                    calendarId=self.calendar_id,
+                    eventId=event_id,
+                    sendUpdates=send_updates,
+                    ).execute()
+        self.logger.info(f"Event deleted: {event_id}")
+        if self.mirror is not None:
+            self.mirror.remove(event_id)
+
+
+    def execute_batch(self, requests):
+        """
+        Executes the requests in batches of BATCH_SIZE, each batch in a single HTTP request.
+        Returns the result of each request, in the order of requests: the response, or the InterfaceError of the
+        request (or of the batch, when the batch itself failed).
+
+        The requests which are throttled, those of batches which were not sent (circuit open), and those
+        other than insertions which fail transiently, are sent again in the next batches.
+        """
+        # documentation: https://developers.google.com/calendar/api/guides/batch
+        results = [None] * len(requests)
+        pending = list(range(len(requests)))
+
+        def should_retry(i):
+            result = results[i]
+            if isinstance(result, Resilience.CircuitOpenError) or is_rate_limited(result):
+                return True
+            # the insertions which failed with a server error may have been done, they are not sent again
+            if requests[i].method == 'POST':
+                return False
+            return isinstance(result, Resilience.InterfaceError) and result.retryable
+
+        for attempt in range(self.batch_attempts):
+            retry = []
+            for first in range(0, len(pending), self.BATCH_SIZE):
+                chunk = pending[first:first + self.BATCH_SIZE]
+                def callback(request_id, response, exception):
+                    results[int(request_id)] = to_interface_error('google.calendar', exception) if exception is not None else response
+                batch = self.get_service().new_batch_http_request(callback=callback)
+                for i in chunk:
+                    results[i] = NOT_ANSWERED
+                    batch.add(requests[i], request_id=str(i))
+                try:
+                    self.execute_batch_request(batch, [requests[i] for i in chunk])
+                except Resilience.InterfaceError as error:
+                    # the results of the other batches, already done on Google's side, are kept
+                    self.logger.error(f"Batch of {len(chunk)} requests failed: {error}")
+                    for i in chunk:
+                        if results[i] is NOT_ANSWERED:
+                            results[i] = error
+                retry += [i for i in chunk if should_retry(i)]
+
+            pending = retry
+            if not pending or attempt == self.batch_attempts - 1:
+                break
+            if any(is_rate_limited(results[i]) for i in pending):
+                get_scheduler().throttled('google.calendar', 'default', attempt=attempt)
+            delay = Resilience.backoff_delay(attempt)
+            self.logger.warning(f"{len(pending)} requests of the batch failed transiently, retrying in {delay:.1f}s")
+            time.sleep(delay)
+        return results
+
+
+    def execute_batch_request(self, batch, requests):
+        # the items of a batch count as separate requests for the quotas: one token each
+        service = 'google.calendar'
+        scheduler = get_scheduler()
+        with scheduler.slot(service):
+            for _ in requests[1:]:
+                scheduler.get_bucket(service, 'default').acquire()
+            try:
+                Resilience.call(service, batch.execute, is_transient=is_transient,
+                                idempotent=all(request.method != 'POST' for request in requests),
+                                get_status=lambda error: error.resp.status if isinstance(error, HttpError) else None)
+            except HttpError as error:
+                raise to_interface_error(service, error) from error
+            finally:
+                resources = {resource_path(request.uri) for request in requests if request.method != 'GET'}
+                for resource in resources:
+                    get_cache().invalidate(service, resource)
+                if resources:
+                    get_http_cache(self.secrets_dir).invalidate_all(service, resources)
+
+
+    def create_events(self, events, send_updates="all"):
+        """
+        Creates several events, with few HTTP requests. events is a list of dictionaries with the arguments
+        of create_event (start_time, end_time, summary, description, attendees).
+        Returns the created event, or the InterfaceError, of each event.
+        """
+        results = self.execute_batch([self.get_service().events().insert(
+                        calendarId=self.calendar_id,
+                        body=self.make_event(**event),
+                        sendUpdates=send_updates
+                        ) for event in events])
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error('An error occurred: %s' % result)
+            else:
+                self.logger.info("Event created: %s" % (result.get('htmlLink')))
+                self.remember(result)
+        return results
+
+
+    def update_events(self, events, send_updates="all"):
+        """
+        Updates several events, with few HTTP requests. events is a list of dictionaries with the arguments
+        of update_event (event_id, and the fields to update).
+        Returns the updated event, or the InterfaceError, of each event.
+
+        The events which already have these fields in the local copy of the calendar are not sent.
+        """
+        mirror = self.get_mirror()
+        bodies = [self.make_event(**{key: value for key, value in event.items() if key != 'event_id'}) for event in events]
+        changed = [i for i, (event, body) in enumerate(zip(events, bodies)) if not mirror.is_up_to_date(event['event_id'], body)]
+        unchanged = set(range(len(events))) - set(changed)
+        results = [mirror.get(event['event_id']) for event in events]
+        for i, result in zip(changed, self.execute_batch([self.make_patch(events[i]['event_id'], bodies[i], send_updates) for i in changed])):
+            results[i] = result
+
+        for i, (event, result) in enumerate(zip(events, results)):
+            if i in unchanged:
+                self.logger.info(f"Event {event['event_id']} is up to date")
+                continue
+            if isinstance(result, Resilience.InterfaceError) and result.status == 412:
+                # modified since it was read, updated on its own (see update_event)
+                try:
+                    results[i] = result = self.update_event(send_updates=send_updates, **event)
+                except Resilience.InterfaceError as error:
+                    results[i] = result = error
+            if isinstance(result, Exception):
+                self.logger.error('An error occurred: %s' % result)
+            else:
+                self.logger.info("Event updated: %s" % (result.get('htmlLink')))
+                self.remember(result)
+        return results
+
+
+    def delete_events(self, event_ids, send_updates="all"):
+        """
+        Deletes several events, with few HTTP requests.
+        Returns None, or the InterfaceError, for each event.
+        """
+        results = self.execute_batch([self.get_service().events().delete(
                         calendarId=self.calendar_id,
                         eventId=event_id,
                         sendUpdates=send_updates,
-                        ).execute()
-            self.logger.info(f"Event deleted: {event_id}")
-        except HttpError as error:
-            self.logger.error('An error occurred: %s' % error)
+                        ) for event_id in event_ids])
+        for event_id, result in zip(event_ids, results):
+            if isinstance(result, Exception):
+                self.logger.error('An error occurred: %s' % result)
+            else:
+                self.logger.info(f"Event deleted: {event_id}")
+                if self.mirror is not None:
+                    self.mirror.remove(event_id)
+        return [result if isinstance(result, Exception) else None for result in results]
 
 
 def main():
@@ -164,7 +483,7 @@ def main():
     credentials_file_path = os.path.join(secrets_dir, credentials_file)
 
     timezone = config['google.calendar'].get('timezone', config['global']['timezone'])
-    gcal = GCalInterface(credentials_file_path, config['google.calendar']['calendar_id'], timezone)
+    gcal = GCalInterface(credentials_file_path, config['google.calendar']['calendar_id'], timezone, secrets_dir=secrets_dir)
 
     # Call the Calendar API
     now_dt = datetime.datetime.utcnow()
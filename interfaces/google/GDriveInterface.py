@@ -1,95 +1,174 @@
 #!/usr/bin/env python3
 import datetime
+import hashlib
+import json
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from interfaces.google.GoogleInterface import GoogleInterface
 except:
     from GoogleInterface import GoogleInterface
-from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload
+from interfaces.shared.RequestCache import get_cache
+from interfaces.shared.FileLock import FileLock, write_atomically
+from interfaces.shared.Resilience import InterfaceError
+
+def get_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class FolderIndex:
+    """
+    Local index of the files of a Drive folder, by id and by name.
+
+    The folder is listed once, and the index is saved in <secrets>/cache with a page token of the Changes
+    API taken before the listing. The next refreshes, including those of later runs, only apply the changes
+    since that token: files added to the folder, modified, moved out of it, trashed or deleted.
+    https://developers.google.com/drive/api/guides/manage-changes
+    """
+    FIELDS = "id, name, md5Checksum, webViewLink, createdTime, parents, trashed"
+
+    def __init__(self, gdrive, folder_id):
+        self.gdrive = gdrive
+        self.folder_id = folder_id
+        self.path = os.path.join(gdrive.secrets_dir, 'cache', f"drive_folder_{folder_id}.json")
+        self.page_token = None
+        self.files = {}
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.page_token = index['page_token']
+        self.files = index['files']
+
+
+    def save(self):
+        write_atomically(self.path, json.dumps({'page_token': self.page_token, 'files': self.files}))
+
+
+    def refresh(self):
+        with FileLock(self.path + ".lock"):
+            self.load()
+            if self.page_token:
+                changes, self.page_token = self.gdrive.list_changes(self.page_token, fields=f"fileId, removed, file({self.FIELDS})")
+                for change in changes:
+                    if change.get('removed') or 'file' not in change:
+                        self.remove(change['fileId'])
+                    else:
+                        self.update(change['file'])
+            else:
+                # the changes made during the listing are applied by the next refresh
+                page_token = self.gdrive.get_start_page_token()
+                files = self.gdrive.list_folder(self.folder_id, self.FIELDS)
+                self.page_token = page_token
+                self.files = {file['id']: file for file in files}
+            self.save()
+
+
+    def update(self, file):
+        with self.lock:
+            if file.get('trashed') or self.folder_id not in file.get('parents', []):
+                self.files.pop(file['id'], None)
+            else:
+                self.files[file['id']] = file
+
+
+    def remove(self, file_id):
+        with self.lock:
+            self.files.pop(file_id, None)
+
+
+    def get(self, file_id):
+        return self.files.get(file_id)
+
+
+    def get_by_name(self, name):
+        """Files with the given name, the most recently created first"""
+        files = [file for file in list(self.files.values()) if file['name'] == name]
+        return sorted(files, key=lambda file: file.get('createdTime', ''), reverse=True)
+
 
 class GDriveInterface(GoogleInterface):
-    def __init__(self, key_file, credentials_type='user'):
+    # files larger than this are uploaded in chunks, which can be resumed
+    RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+
+    def __init__(self, key_file, credentials_type='user', secrets_dir="./secrets"):
         # liste des scopes https://developers.google.com/identity/protocols/oauth2/scopes#drive
-        super(GDriveInterface, self).__init__(key_file, credentials_type, 'drive', 'v3', ['https://www.googleapis.com/auth/drive.file'])
+        super(GDriveInterface, self).__init__(key_file, credentials_type, 'drive', 'v3', ['https://www.googleapis.com/auth/drive.file',
+                                                                                             'https://www.googleapis.com/auth/drive.metadata.readonly'], secrets_dir)
         self.logger = logging.getLogger(__name__)
+        # indexes of the folders used in the run, by folder id
+        self.folders = {}
+        self.folders_lock = threading.Lock()
+
+
+    def get_folder_index(self, folder_id):
+        """Index of the files of the folder (see FolderIndex), refreshed on its first use in the run"""
+        with self.folders_lock:
+            if folder_id not in self.folders:
+                index = FolderIndex(self, folder_id)
+                index.refresh()
+                self.folders[folder_id] = index
+            return self.folders[folder_id]
+
+
+    def update_indexes(self, file):
+        # keeps the indexes of the run up to date with the files written
+        for index in list(self.folders.values()):
+            index.update(file)
 
 
     def move_file_to_folder(self, file_id, folder_id):
         # https://developers.google.com/drive/api/guides/folder#move_files_between_folders
-        try:
-            # Retrieve the existing parents to remove
-            file = self.get_service().files().get(fileId=file_id, fields="parents").execute()
-            previous_parents = ",".join(file.get("parents"))
-            # Move the file to the new folder
-            file = (
-                    self.get_service().files()
-                    .update(
-                        fileId=file_id,
-                        addParents=folder_id,
-                        removeParents=previous_parents,
-                        fields="id, parents",
-                        # necessary to support shared drives
-                        supportsAllDrives=True,
-                    )
-                    .execute()
-                    )
-            return file.get("parents")
-
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return None
+        # Retrieve the existing parents to remove
+        file = self.get_service().files().get(fileId=file_id, fields="parents").execute()
+        previous_parents = ",".join(file.get("parents"))
+        # Move the file to the new folder
+        file = (
+                self.get_service().files()
+                .update(
+                    fileId=file_id,
+                    addParents=folder_id,
+                    removeParents=previous_parents,
+                    fields="id, parents",
+                    # necessary to support shared drives
+                    supportsAllDrives=True,
+                )
+                .execute()
+                )
+        return file.get("parents")
 
 
     def copy_file(self, original_id, newtitle, parent_folder_id):
         # https://developers.google.com/drive/api/reference/rest/v3/files/copy
-        try:
-            # Retrieve the existing parents to remove
-            newfile = {'name': newtitle, 'parents': [ {"id": parent_folder_id } ] }
-            file = self.get_service().files().copy(fileId=original_id, body=newfile, supportsAllDrives=True).execute()
-            return file
-
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return None
+        # Retrieve the existing parents to remove
+        newfile = {'name': newtitle, 'parents': [parent_folder_id]}
+        file = self.get_service().files().copy(fileId=original_id, body=newfile, fields=FolderIndex.FIELDS, supportsAllDrives=True).execute()
+        self.update_indexes(file)
+        return file
 
 
     def get_file(self, file_id, fields):
         # https://developers.google.com/drive/api/reference/rest/v3/files/get
-        try:
-            file = self.get_service().files().get(fileId=file_id, fields=fields, supportsAllDrives=True).execute()
-            return file
-
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return None
+        file = self.get_service().files().get(fileId=file_id, fields=fields, supportsAllDrives=True).execute()
+        return file
 
 
     def get_file_ids(self, folder_id, title):
-        # https://developers.google.com/drive/api/guides/search-files
-        try:
-            page_token = None
-            files = self.get_service().files().list(
-                        q=f'name="{title}" and "{folder_id}" in parents and trashed=false',
-                        fields="files(id, name)",
-                        spaces='drive',
-                        supportsAllDrives=True,
-                        pageSize=20,
-                        pageToken=page_token,
-                        corpora='allDrives',
-                        includeItemsFromAllDrives=True,
-                        orderBy='createdTime desc',
-                    ).execute()
-
-            if files:
-                return [file['id'] for file in files['files']]
-            else:
-                return None
-
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return None
+        # looked up in the index of the folder, the most recently created first
+        return [file['id'] for file in self.get_folder_index(folder_id).get_by_name(title)]
 
 
     def get_file_id(self, folder_id, title):
@@ -102,9 +181,111 @@ class GDriveInterface(GoogleInterface):
 
 
     def get_file_url(self, file_id):
+        for index in list(self.folders.values()):
+            file = index.get(file_id)
+            if file and file.get('webViewLink'):
+                return file['webViewLink']
         return self.get_file(file_id, "webViewLink")["webViewLink"]
 
 
+    def list_folder(self, folder_id, fields="id, name, md5Checksum"):
+        # https://developers.google.com/drive/api/guides/search-files
+        """
+        Returns the files of a folder, with the given fields.
+        """
+        files = []
+        page_token = None
+        while True:
+            response = self.get_service().files().list(
+                        q=f'"{folder_id}" in parents and trashed=false',
+                        fields=f"nextPageToken, files({fields})",
+                        spaces='drive',
+                        supportsAllDrives=True,
+                        includeItemsFromAllDrives=True,
+                        corpora='allDrives',
+                        pageSize=1000,
+                        pageToken=page_token,
+                    ).execute()
+            files += response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return files
+
+
+    def upload_file(self, file_path, folder_id, mimetype, file_id=None):
+        # https://developers.google.com/drive/api/guides/manage-uploads
+        """
+        Uploads a file in the folder, or as the new content of file_id if it is given.
+        Files larger than RESUMABLE_THRESHOLD are sent with a resumable upload, in chunks.
+        Returns the file (with the fields of FolderIndex.FIELDS).
+        """
+        resumable = os.path.getsize(file_path) > self.RESUMABLE_THRESHOLD
+        media = MediaFileUpload(file_path, mimetype=mimetype, resumable=resumable)
+        if file_id:
+            request = self.get_service().files().update(fileId=file_id, media_body=media,
+                                                        fields=FolderIndex.FIELDS, supportsAllDrives=True)
+        else:
+            request = self.get_service().files().create(body={'name': os.path.basename(file_path), 'parents': [folder_id]},
+                                                        media_body=media, fields=FolderIndex.FIELDS, supportsAllDrives=True)
+        file = request.execute()
+        self.update_indexes(file)
+        return file
+
+
+    def upload_files(self, file_paths, folder_id, mimetype, max_workers=8):
+        """
+        Uploads files in the folder, in parallel. A file of the folder with the same name is replaced, unless
+        it already has the same content (same MD5 checksum), in which case the file is not uploaded.
+        Returns {file path: the file, "unchanged", or the InterfaceError of its upload}.
+        """
+        index = self.get_folder_index(folder_id)
+        existing = {file['name']: file for file in sorted(index.files.values(), key=lambda file: file.get('createdTime', ''))}
+
+        def upload(file_path):
+            file = existing.get(os.path.basename(file_path))
+            if file and file.get('md5Checksum') == get_md5(file_path):
+                return "unchanged"
+            try:
+                return self.upload_file(file_path, folder_id, mimetype, file_id=file['id'] if file else None)
+            except InterfaceError as error:
+                self.logger.error(f"An error occurred: {error}")
+                return error
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(file_paths, executor.map(upload, file_paths)))
+
+
+    def get_start_page_token(self):
+        # https://developers.google.com/drive/api/reference/rest/v3/changes/getStartPageToken
+        with get_cache().disabled():
+            response = self.get_service().changes().getStartPageToken(supportsAllDrives=True).execute()
+        return response.get("startPageToken")
+
+
+    def list_changes(self, page_token, fields="fileId, removed, time, file(name, version, modifiedTime)"):
+        """
+        Returns the changes since page_token, and the page token to use for the next call.
+        """
+        # https://developers.google.com/drive/api/guides/manage-changes
+        changes = []
+        while page_token:
+            # polled repeatedly, the changes are never served from the cache
+            with get_cache().disabled():
+                response = self.get_service().changes().list(
+                        pageToken=page_token,
+                        fields=f"nextPageToken, newStartPageToken, changes({fields})",
+                        spaces='drive',
+                        supportsAllDrives=True,
+                        includeItemsFromAllDrives=True,
+                        pageSize=100,
+                    ).execute()
+            changes += response.get("changes", [])
+            if "newStartPageToken" in response:
+                return changes, response["newStartPageToken"]
+            page_token = response.get("nextPageToken")
+        return changes, page_token
+
+
 def main():
     import configparser
     import os
@@ -119,7 +300,7 @@ def main():
     # take the credentials file either from google.calendar or from google section
     credentials_file = config['google']['credentials_file']
     credentials_file_path = os.path.join(secrets_dir, credentials_file)
-    gdrive = GDriveInterface(credentials_file_path)
+    gdrive = GDriveInterface(credentials_file_path, secrets_dir=secrets_dir)
 
     # These are to uncomment when you want to test something
 #    source_file_id = "1eURwPuPMDkL2C0R7ZD4e6qHLl8DNaGxtwYLgsfZ79Ec"
@@ -2,6 +2,7 @@
 import datetime
 import logging
 import os
+import re
 
 try:
     from interfaces.google.GoogleInterface import GoogleInterface
@@ -10,12 +11,54 @@ except:
     from GoogleInterface import GoogleInterface
     from GDriveInterface import GDriveInterface
 
-from googleapiclient.errors import HttpError
+from interfaces.shared.Resilience import InterfaceError
+
+def to_cell_data(value):
+    # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/other#ExtendedValue
+    # like the USER_ENTERED input of the values API for the values written by the scripts: numbers and formulas
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    value = str(value)
+    if value.startswith("="):
+        return {"userEnteredValue": {"formulaValue": value}}
+    return {"userEnteredValue": {"stringValue": value}}
+
+
+def split_a1_range(a1_range):
+    """
+    Returns the sheet name (None if there is none) and the cells of an A1 range: "'My sheet'!A5:B" -> ("My sheet", "A5:B")
+    """
+    if '!' not in a1_range:
+        return None, a1_range
+    sheet_name, cells = a1_range.rsplit('!', 1)
+    if sheet_name.startswith("'") and sheet_name.endswith("'"):
+        sheet_name = sheet_name[1:-1].replace("''", "'")
+    return sheet_name, cells
+
+
+def to_update_cells(sheet_id, a1_range, values):
+    """
+    updateCells request writing the rows of values from the first cell of a1_range (i.e. "A5:B") of the
+    sheet with the given id, for spreadsheets.batchUpdate. The sheet name of a1_range, if any, is ignored.
+    """
+    # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/request#updatecellsrequest
+    match = re.match(r"([A-Za-z]*)(\d*)", split_a1_range(a1_range)[1])
+    column = 0
+    for letter in match.group(1).upper():
+        column = column * 26 + ord(letter) - ord('A') + 1
+    return {"updateCells": {
+        "start": {"sheetId": sheet_id, "rowIndex": max(int(match.group(2) or 1) - 1, 0), "columnIndex": max(column - 1, 0)},
+        "rows": [{"values": [to_cell_data(value) for value in row]} for row in values],
+        "fields": "userEnteredValue",
+    }}
+
 
 class GSheetsInterface(GoogleInterface):
-    def __init__(self, key_file, credentials_type='user'):
+    def __init__(self, key_file, credentials_type='user', secrets_dir="./secrets"):
         # liste des scopes https://developers.google.com/identity/protocols/oauth2/scopes#sheets
-        super(GSheetsInterface, self).__init__(key_file, credentials_type, 'sheets', 'v4', ['https://www.googleapis.com/auth/spreadsheets'])
+        super(GSheetsInterface, self).__init__(key_file, credentials_type, 'sheets', 'v4', ['https://www.googleapis.com/auth/spreadsheets'], secrets_dir)
         # maximum of 26 columns to update
         self.default_range = "A:Z"
         self.logger = logging.getLogger(__name__)
@@ -24,30 +67,26 @@ class GSheetsInterface(GoogleInterface):
 
     def get_gdrive(self):
         if not self.gdrive:
-            self.gdrive = GDriveInterface(self.key_file)
+            self.gdrive = GDriveInterface(self.key_file, secrets_dir=self.secrets_dir)
         return self.gdrive
 
 
     def create_spreadsheet(self, title, content=None, folder_id=None):
         # https://developers.google.com/sheets/api/guides/create
-        try:
-            spreadsheet = {"properties": {"title": title}}
-            spreadsheet = (
-                self.get_service().spreadsheets()
-                .create(body=spreadsheet, fields="spreadsheetId")
-                .execute()
-            )
-            self.logger.info(f"Spreadsheet ID: {(spreadsheet.get('spreadsheetId'))}")
-            spreadsheet_id = spreadsheet.get('spreadsheetId')
-            if content:
-                self.update_values(spreadsheet_id, self.default_range, content)
-            if folder_id:
-                self.get_gdrive().move_file_to_folder(spreadsheet_id, folder_id)
+        spreadsheet = {"properties": {"title": title}}
+        spreadsheet = (
+            self.get_service().spreadsheets()
+            .create(body=spreadsheet, fields="spreadsheetId")
+            .execute()
+        )
+        self.logger.info(f"Spreadsheet ID: {(spreadsheet.get('spreadsheetId'))}")
+        spreadsheet_id = spreadsheet.get('spreadsheetId')
+        if content:
+            self.update_values(spreadsheet_id, self.default_range, content)
+        if folder_id:
+            self.get_gdrive().move_file_to_folder(spreadsheet_id, folder_id)
 
-            return spreadsheet_id
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return error
+        return spreadsheet_id
 
 
     def get_values(self, spreadsheet_id, range_name, sheet_name=None):
@@ -56,24 +95,39 @@ class GSheetsInterface(GoogleInterface):
         """
         Creates the batch_update the user has access to.
         """
-        try:
-            if sheet_name:
-                range_name = f"'{sheet_name}'!{range_name}"
-            result = (
-                self.get_service().spreadsheets()
-                    .values()
-                    .get(
-                        spreadsheetId=spreadsheet_id,
-                        range=range_name,
-                )
-                .execute()
+        if sheet_name:
+            range_name = f"'{sheet_name}'!{range_name}"
+        result = (
+            self.get_service().spreadsheets()
+                .values()
+                .get(
+                    spreadsheetId=spreadsheet_id,
+                    range=range_name,
+            )
+            .execute()
+        )
+        rows = result.get("values", [])
+        self.logger.info(f"{rows}")
+        return rows
+
+
+    def batch_get_values(self, spreadsheet_id, ranges, major_dimension="ROWS"):
+        # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets.values/batchGet
+        """
+        Gets several ranges in a single request. Returns one list of rows (or columns if
+        major_dimension is "COLUMNS") per range, in the order of ranges.
+        """
+        result = (
+            self.get_service().spreadsheets()
+                .values()
+                .batchGet(
+                    spreadsheetId=spreadsheet_id,
+                    ranges=ranges,
+                    majorDimension=major_dimension,
             )
-            rows = result.get("values", [])
-            self.logger.info(f"{rows}")
-            return rows
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return error
+            .execute()
+        )
+        return [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
 
 
     def update_values(self, spreadsheet_id, range_name, values, sheet_name=None):
@@ -81,72 +135,131 @@ class GSheetsInterface(GoogleInterface):
         """
         Creates the batch_update the user has access to.
         """
-        try:
-            value_input_option = "USER_ENTERED"
-            body = {"values": values}
-            if sheet_name:
-                range_name = f"'{sheet_name}'!{range_name}"
-            result = (
-                self.get_service().spreadsheets()
-                    .values()
-                    .update(
-                        spreadsheetId=spreadsheet_id,
-                        range=range_name,
-                        valueInputOption=value_input_option,
-                        body=body,
-                )
-                .execute()
+        value_input_option = "USER_ENTERED"
+        body = {"values": values}
+        if sheet_name:
+            range_name = f"'{sheet_name}'!{range_name}"
+        result = (
+            self.get_service().spreadsheets()
+                .values()
+                .update(
+                    spreadsheetId=spreadsheet_id,
+                    range=range_name,
+                    valueInputOption=value_input_option,
+                    body=body,
+            )
+            .execute()
+        )
+        self.logger.info(f"{result.get('updatedCells')} cells updated.")
+        return result
+
+
+    def batch_update_values(self, spreadsheet_id, data):
+        # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets.values/batchUpdate
+        """
+        Updates several ranges in a single request. data is a list of {"range": ..., "values": ...}
+        """
+        body = {"valueInputOption": "USER_ENTERED", "data": data}
+        result = (
+            self.get_service().spreadsheets()
+                .values()
+                .batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body=body,
             )
-            self.logger.info(f"{result.get('updatedCells')} cells updated.")
-            return result
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return error
+            .execute()
+        )
+        self.logger.info(f"{result.get('totalUpdatedCells')} cells updated.")
+        return result
 
 
     def append_values(self, spreadsheet_id, range_name, values, sheet_name=None):
         # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets.values/append
         # https://developers.google.com/sheets/api/guides/values
-        try:
-            value_input_option = "USER_ENTERED"
-            body = {"values": values}
-            if sheet_name:
-                range_name = f"'{sheet_name}'!{range_name}"
-            result = (
-                self.get_service().spreadsheets()
-                    .values()
-                    .append(
-                        spreadsheetId=spreadsheet_id,
-                        range=range_name,
-                        valueInputOption=value_input_option,
-                        body=body,
-                )
-                .execute()
+        value_input_option = "USER_ENTERED"
+        body = {"values": values}
+        if sheet_name:
+            range_name = f"'{sheet_name}'!{range_name}"
+        result = (
+            self.get_service().spreadsheets()
+                .values()
+                .append(
+                    spreadsheetId=spreadsheet_id,
+                    range=range_name,
+                    valueInputOption=value_input_option,
+                    body=body,
             )
-            self.logger.info(f"{result.get('updatedCells')} cells appended.")
-            return result
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return error
+            .execute()
+        )
+        self.logger.info(f"{result.get('updatedCells')} cells appended.")
+        return result
 
 
-    def get_spreadsheet_metadata(self, sheet_id):
+    def get_spreadsheet_metadata(self, sheet_id, fields=None):
         # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/get
-        try:
-            spreadsheet = (
-                self.get_service().spreadsheets().get(spreadsheetId=sheet_id).execute()
+        # https://developers.google.com/sheets/api/guides/field-masks
+        """
+        Returns the metadata of the spreadsheet, limited to the given fields mask (i.e. "sheets.protectedRanges")
+        if any. Without a mask, the whole metadata is returned, including the properties of every sheet.
+        """
+        spreadsheet = (
+            self.get_service().spreadsheets().get(spreadsheetId=sheet_id, fields=fields).execute()
+        )
+        self.logger.info(f"Spreadsheet ID: {(spreadsheet.get('spreadsheetId'))}")
+        return spreadsheet
+
+
+    def batch_update(self, spreadsheet_id, requests, response_fields=None):
+        # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/batchUpdate
+        """
+        Applies several structural requests (i.e. addProtectedRange, updateCells) in a single request. They
+        are applied in order, and none is applied if one of them is invalid. The replies are only returned for
+        the given response_fields mask (i.e. "replies.addProtectedRange.protectedRange.protectedRangeId").
+        """
+        result = (
+            self.get_service().spreadsheets()
+            .batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={"requests": requests},
+                fields=response_fields or "spreadsheetId",
             )
-            self.logger.info(f"Spreadsheet ID: {(spreadsheet.get('spreadsheetId'))}")
-            return spreadsheet
-        except HttpError as error:
-            self.logger.error(f"An error occurred: {error}")
-            return error
+            .execute()
+        )
+        self.logger.info(f"{len(requests)} requests applied.")
+        return result
+
+
+    def get_sheet_names(self, spreadsheet_id):
+        # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/get
+        """
+        Returns the titles of the sheets (tabs) of the spreadsheet, in order.
+        """
+        spreadsheet = (
+            self.get_service().spreadsheets()
+            .get(spreadsheetId=spreadsheet_id, fields="sheets.properties.title")
+            .execute()
+        )
+        return [sheet['properties']['title'] for sheet in spreadsheet.get('sheets', [])]
 
 
     def copy_protection(self, src_sheet_id, dst_sheet_id, sheet_id=0, wipe_dst_protection=True):
-        src_metadata = self.get_spreadsheet_metadata(src_sheet_id)
+        # only the protected ranges are needed, not the properties of the sheets
+        src_metadata = self.get_spreadsheet_metadata(src_sheet_id, fields="sheets(properties.sheetId,protectedRanges)")
+        dst_metadata = self.get_spreadsheet_metadata(dst_sheet_id, fields="sheets(properties.sheetId,protectedRanges.protectedRangeId)")
+        requests = self.get_protection_requests(src_metadata, dst_metadata, sheet_id, wipe_dst_protection)
+
+        if requests:
+            result = self.batch_update(dst_sheet_id, requests)
+            print(f"Result:{result}")
+        else:
+            self.logger.info(f"No changes needed in protected ranges")
+
+
+    def get_protection_requests(self, src_metadata, dst_metadata, sheet_id=0, wipe_dst_protection=True):
+        """
+        Requests replacing the protected ranges of the sheet (by index) of the destination by those of the source
+        """
         src_protected_ranges = src_metadata['sheets'][sheet_id].get('protectedRanges', None)
-        dst_metadata = self.get_spreadsheet_metadata(dst_sheet_id)
         dst_protected_ranges = dst_metadata['sheets'][sheet_id].get('protectedRanges', None)
 
         requests = []
@@ -159,25 +272,46 @@ class GSheetsInterface(GoogleInterface):
             # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/request#addprotectedrangerequest
             # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/sheets#ProtectedRange
             requests += [{"addProtectedRange": {"protectedRange": p}} for p in src_protected_ranges]
+        return requests
 
-        if requests:
+
+    def copy_template(self, template_id, title, folder_id, values, sheet_id=0):
+        """
+        Copies the template spreadsheet in the folder, and writes values ({A1 range: rows}) in the sheet named
+        by each range, or in the sheet of index sheet_id for the ranges without a sheet name, and copies the
+        protection of the template (see copy_protection) in a single batchUpdate.
+        Returns (spreadsheet id, URL). InterfaceError is raised if the template cannot be read or copied, and
+        the requests which do not apply on the copy either are logged, and its URL is None.
+
+        The copy has the sheets and the protected ranges of the template, with the same ids: the requests are
+        built from the metadata of the template alone. If they do not apply, the metadata of the copy is read
+        and they are sent again.
+        """
+        template = self.get_spreadsheet_metadata(template_id, fields="sheets(properties(sheetId,title),protectedRanges)")
+        titles = {sheet['properties'].get('title') for sheet in template['sheets']}
+        unknown = {split_a1_range(a1_range)[0] for a1_range in values} - titles - {None}
+        if unknown:
+            raise InterfaceError('google.sheets', f"Sheets {unknown} are not in the template {template_id}")
+        new_file = self.get_gdrive().copy_file(template_id, title, folder_id)
+        spreadsheet_id = new_file['id']
+
+        def get_requests(copy):
+            gids = {sheet['properties'].get('title'): sheet['properties']['sheetId'] for sheet in copy['sheets']}
+            gids[None] = copy['sheets'][sheet_id]['properties']['sheetId']
+            return [to_update_cells(gids[split_a1_range(a1_range)[0]], a1_range, rows) for a1_range, rows in values.items()] + \
+                self.get_protection_requests(template, copy, sheet_id)
+
+        try:
+            self.batch_update(spreadsheet_id, get_requests(template))
+        except InterfaceError:
+            self.logger.info("The copy differs from the template, reading its sheets and protected ranges")
             try:
-                body = {"requests": requests}
-                result = (
-                        self.get_service().spreadsheets()
-                        .batchUpdate(
-                            spreadsheetId=dst_sheet_id,
-                            body=body,
-                            )
-                        .execute()
-                        )
-                print(f"Result:{result}")
-                self.logger.info(f"{result}")
-            except HttpError as error:
+                copy = self.get_spreadsheet_metadata(spreadsheet_id, fields="sheets(properties(sheetId,title),protectedRanges.protectedRangeId)")
+                self.batch_update(spreadsheet_id, get_requests(copy))
+            except InterfaceError as error:
                 self.logger.error(f"An error occurred: {error}")
-                return error
-        else:
-            self.logger.info(f"No changes needed in protected ranges")
+                return spreadsheet_id, None
+        return spreadsheet_id, new_file.get('webViewLink')
 
 
 
@@ -195,7 +329,7 @@ def main():
     # take the credentials file either from google.calendar or from google section
     credentials_file = config['google']['credentials_file']
     credentials_file_path = os.path.join(secrets_dir, credentials_file)
-    gsheets = GSheetsInterface(credentials_file_path)
+    gsheets = GSheetsInterface(credentials_file_path, secrets_dir=secrets_dir)
     content = [['1', '2'], ['3', '4', '5', '8'], ['x']]
 #    folder_id = config['script.usernames']['google_drive_folder_id']
 #    gsheets.create_spreadsheet("Ceci est un test", content, folder_id)
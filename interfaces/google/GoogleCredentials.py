@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import sys
+import threading
+
+import google_auth_httplib2
+import httplib2
+from google.auth.transport.requests import Request
+from google.oauth2 import service_account
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from interfaces.shared.FileLock import FileLock, write_atomically
+from interfaces.shared.HttpSession import DEFAULT_TIMEOUT
+from interfaces.shared.Resilience import InterfaceError
+
+
+# scopes of all the Google interfaces, so that a single token authorizes them all
+# https://developers.google.com/identity/protocols/oauth2/scopes
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive.file',
+    # the revision and the changes of the calendar spreadsheet, which is not created by the application
+    'https://www.googleapis.com/auth/drive.metadata.readonly',
+    'https://www.googleapis.com/auth/calendar.events',
+]
+
+
+class SharedTokenCredentials(Credentials):
+    """
+    User credentials whose token is shared, through token_file, by all the processes of the host.
+
+    Before asking Google for a new access token, the credentials take the lock of token_file and
+    reload it: if another process refreshed the token in the meantime, its token is used. Otherwise
+    the token is refreshed and saved for the other processes. The google-auth library refreshes the
+    token a few minutes before it expires, so that calls do not fail with expired tokens.
+    """
+    token_file = None
+
+    def refresh(self, request):
+        with FileLock(self.token_file + ".lock"):
+            if os.path.exists(self.token_file):
+                saved = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+                if saved.valid and saved.token != self.token:
+                    self.token = saved.token
+                    self.expiry = saved.expiry
+                    return
+            super(SharedTokenCredentials, self).refresh(request)
+            write_atomically(self.token_file, self.to_json())
+
+
+class CredentialsBroker:
+    """
+    Credentials shared by the Google interfaces (Sheets, Drive, Calendar) of a process.
+
+    User credentials are stored in a single token file, token_google.json in secrets_dir,
+    authorizing all of SCOPES. When there is no valid token, the authorization flow, which needs a
+    browser, is only run from a terminal: unattended runs raise InterfaceError instead of waiting for
+    a login. Run this module to authorize the application.
+
+    Each thread gets its own authorized HTTP connection (httplib2 is not thread-safe), all of them
+    using the same credentials.
+    """
+    def __init__(self, key_file, credentials_type, secrets_dir):
+        self.key_file = key_file
+        self.credentials_type = credentials_type
+        self.token_file = os.path.join(secrets_dir, "token_google.json")
+        self.credentials = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.logger = logging.getLogger(__name__)
+
+
+    def get_credentials(self, interactive=None):
+        with self.lock:
+            if not self.credentials:
+                if self.credentials_type == "service":
+                    self.credentials = service_account.Credentials.from_service_account_file(self.key_file, scopes=SCOPES)
+                else:
+                    self.credentials = self.get_user_credentials(sys.stdin.isatty() if interactive is None else interactive)
+            return self.credentials
+
+
+    def get_user_credentials(self, interactive):
+        with FileLock(self.token_file + ".lock"):
+            credentials = None
+            if os.path.exists(self.token_file):
+                credentials = SharedTokenCredentials.from_authorized_user_file(self.token_file, SCOPES)
+                if not credentials.has_scopes(SCOPES) or not credentials.refresh_token:
+                    credentials = None
+
+            if not credentials:
+                if not interactive:
+                    raise InterfaceError('google', f"no valid token in {self.token_file}, run "
+                                                   f"`python -m interfaces.google.GoogleCredentials` to authorize the application")
+                flow = InstalledAppFlow.from_client_secrets_file(self.key_file, SCOPES)
+                authorized = flow.run_local_server(port=0)
+                credentials = SharedTokenCredentials.from_authorized_user_info(json.loads(authorized.to_json()), SCOPES)
+                write_atomically(self.token_file, credentials.to_json())
+
+        credentials.token_file = self.token_file
+        if not credentials.valid:
+            credentials.refresh(Request())
+        return credentials
+
+
+    def get_http(self):
+        """Authorized HTTP connection of the current thread"""
+        if getattr(self.local, 'http', None) is None:
+            self.local.http = google_auth_httplib2.AuthorizedHttp(self.get_credentials(),
+                                                                  http=httplib2.Http(timeout=DEFAULT_TIMEOUT[1]))
+        return self.local.http
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_credentials_broker(key_file, credentials_type="user", secrets_dir="./secrets"):
+    """Get the credentials broker of the key file, shared by all the Google interfaces of the process"""
+    with _brokers_lock:
+        key = (os.path.abspath(key_file), credentials_type, os.path.abspath(secrets_dir))
+        if key not in _brokers:
+            _brokers[key] = CredentialsBroker(key_file, credentials_type, secrets_dir)
+        return _brokers[key]
+
+
+def main():
+    import configparser
+    import glob
+    config = configparser.ConfigParser()
+    config_dir = os.environ.get('CQORC_CONFIG_DIR', '.')
+    secrets_dir = os.environ.get('CQORC_SECRETS_DIR', '.')
+    config_files = glob.glob(os.path.join(config_dir, '*.cfg')) + glob.glob(os.path.join(secrets_dir, '*.cfg'))
+    print("Reading config files: %s" % str(config_files))
+    config.read(config_files)
+
+    credentials_file_path = os.path.join(secrets_dir, config['google']['credentials_file'])
+    broker = get_credentials_broker(credentials_file_path, secrets_dir=secrets_dir)
+    broker.get_credentials(interactive=True)
+    print(f"Token saved in {broker.token_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,216 @@
+import copy
+import functools
+import json
 import logging
 import os
+import threading
+import httplib2
 
-from googleapiclient.discovery import build
+import googleapiclient
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.oauth2.credentials import Credentials
-from oauth2client.service_account import ServiceAccountCredentials
-from google.auth.transport.requests import Request
+from googleapiclient.http import HttpRequest
+from interfaces.shared.RateLimiter import get_scheduler
+from interfaces.shared.RequestCache import get_cache, resource_path
+from interfaces.shared.HttpCache import get_http_cache
+from interfaces.shared.HttpSession import get_session
+from interfaces.shared.FileLock import write_atomically
+from interfaces.shared import Resilience
+try:
+    from interfaces.google.GoogleCredentials import get_credentials_broker, SCOPES
+except:
+    from GoogleCredentials import get_credentials_broker, SCOPES
+
+
+def is_rate_limited(error):
+    # https://developers.google.com/sheets/api/limits#exceeding_a_quota
+    # https://developers.google.com/drive/api/guides/limits
+    if isinstance(error, Resilience.InterfaceError):
+        error = error.response
+    if not isinstance(error, HttpError):
+        return False
+    return error.resp.status == 429 or \
+        (error.resp.status == 403 and any(reason in str(error.content) for reason in ('rateLimitExceeded', 'userRateLimitExceeded')))
+
+
+def is_transient(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in Resilience.RETRYABLE_STATUSES
+    return Resilience.is_transient_error(error) or isinstance(error, httplib2.HttpLib2Error)
+
+
+def to_interface_error(service, error):
+    """InterfaceError for an HttpError of Google, with its status and the HttpError as response"""
+    if isinstance(error, Resilience.InterfaceError):
+        return error
+    reason = error.reason if isinstance(getattr(error, 'reason', None), str) else str(error)
+    return Resilience.InterfaceError(service, f"{error.resp.status} {reason}", status=error.resp.status,
+                                     retryable=is_transient(error) or is_rate_limited(error), response=error)
+
+
+class RateLimitedHttpRequest(HttpRequest):
+    """
+    HttpRequest executed within the rate limits of its API ('google.sheets', 'google.drive', 'google.calendar'),
+    and retried after a delay when Google answers that a rate limit is exceeded.
+
+    Requests other than POST are also retried, with a backoff, on network errors and 5xx responses.
+    InterfaceError is raised if they still fail after the retries, and HttpError is raised as an InterfaceError
+    with its status, so that the interfaces (GSheetsInterface, GDriveInterface, GCalInterface) raise
+    InterfaceError on every failure, like the other interfaces.
+
+    The results of GET requests are cached for the rest of the run (a copy is returned, so that callers can
+    modify it), and the other requests invalidate the cached results of the same resource, of its
+    sub-resources and of its parents (i.e. a values:batchUpdate invalidates the values:batchGet).
+    Between runs, the results with an ETag are kept on disk and revalidated with conditional requests
+    (see HttpCache), in the secrets directory of the interface.
+    """
+    def __init__(self, *args, secrets_dir="./secrets", **kwargs):
+        super(RateLimitedHttpRequest, self).__init__(*args, **kwargs)
+        self.secrets_dir = secrets_dir
+
+    def execute(self, http=None, num_retries=0):
+        service = 'google.' + self.methodId.split('.')[0]
+        try:
+            return self.execute_cached(service, http, num_retries)
+        except HttpError as error:
+            raise to_interface_error(service, error) from error
+
+    def execute_cached(self, service, http, num_retries):
+        resource = resource_path(self.uri)
+        if self.method == 'GET':
+            result = get_cache().get(service, resource, self.uri,
+                                     lambda: self.send_conditional(service, resource, http, num_retries))
+            return copy.deepcopy(result)
+
+        try:
+            return self.send(service, http, num_retries)
+        finally:
+            get_cache().invalidate(service, resource)
+            get_http_cache(self.secrets_dir).invalidate(service, resource)
+
+    def send_conditional(self, service, resource, http, num_retries):
+        """
+        Send a GET revalidating the result stored in the HTTP cache, if any. Google answers 304 Not Modified
+        with an HttpError, in which case the stored body is deserialized instead.
+        """
+        if 'alt=media' in self.uri:
+            # downloads are not stored
+            return self.send(service, http, num_retries)
+
+        cache = get_http_cache(self.secrets_dir)
+        entry = cache.load(service, self.uri)
+        self.headers.update({name.lower(): value for name, value in cache.conditional_headers(entry).items()})
+
+        # the raw response is needed to store it, it is caught on its way to the deserialization
+        postproc = self.postproc
+        responses = []
+        def capture(resp, content):
+            responses.append((resp, content))
+            return postproc(resp, content)
+        self.postproc = capture
+        try:
+            result = self.send(service, http, num_retries)
+        except HttpError as error:
+            if error.resp.status != 304 or entry is None:
+                raise
+            cache.store(service, resource, self.uri, entry['body'], entry['etag'], entry['last_modified'])
+            return postproc(httplib2.Response({'status': 200}), entry['body'].encode('utf-8'))
+        finally:
+            self.postproc = postproc
+
+        resp, content = responses[-1]
+        try:
+            cache.store(service, resource, self.uri, content.decode('utf-8') if isinstance(content, bytes) else content,
+                        resp.get('etag'), resp.get('last-modified'))
+        except UnicodeDecodeError:
+            pass
+        return result
+
+    def send(self, service, http, num_retries):
+        return Resilience.call(
+            service,
+            lambda: get_scheduler().call(
+                service, 'default',
+                lambda: super(RateLimitedHttpRequest, self).execute(http=http, num_retries=num_retries),
+                is_throttled=is_rate_limited,
+                retry_after=lambda error: error.resp.get('retry-after')),
+            is_transient=is_transient,
+            idempotent=self.method != 'POST',
+            get_status=lambda error: error.resp.status if isinstance(error, HttpError) else None)
+
+
+# discovery documents parsed in this process, by (service name, version)
+_documents = {}
+_documents_lock = threading.Lock()
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{name}/{version}/rest"
+
+
+def get_discovery_document(name, version, secrets_dir="./secrets"):
+    """
+    Discovery document of a Google API, parsed once per process.
+
+    The documents of the APIs used here are bundled with googleapiclient. Others are downloaded once and
+    kept in <secrets_dir>/cache/discovery, in a file named after the version of googleapiclient, so that a
+    new version of the library downloads them again.
+    """
+    with _documents_lock:
+        if (name, version) not in _documents:
+            document = get_static_doc(name, version)
+            if document is None:
+                path = os.path.join(os.getenv('CQORC_SECRETS_DIR', './secrets'), 'cache', 'discovery',
+                                    f"{name}.{version}.{googleapiclient.__version__}.json")
+                if os.path.exists(path):
+                    with open(path) as f:
+                        document = f.read()
+                else:
+                    response = get_session().get(DISCOVERY_URL.format(name=name, version=version))
+                    response.raise_for_status()
+                    document = response.text
+                    write_atomically(path, document)
+            _documents[(name, version)] = json.loads(document)
+        return _documents[(name, version)]
+
 
 class GoogleInterface:
-    def __init__(self, key_file, credentials_type, service_name, service_version, scopes):
+    def __init__(self, key_file, credentials_type, service_name, service_version, scopes, secrets_dir="./secrets"):
         assert credentials_type in ["user", "service"], f'credentials_type should be either "user" or "service", found {credentials_type}'
         assert os.path.exists(key_file), f'key file should exist, {key_file} does not exist'
         assert isinstance(service_name, str), f"service_name should be a string, found {service_name}"
         assert isinstance(service_version, str), f"service_version should be a string, found {service_version}"
         assert isinstance(scopes, list), f"scopes should be a list, found {scopes}"
         self.key_file = key_file
+        # token and cache files are kept in the secrets directory
+        self.secrets_dir = secrets_dir
         self.logger = logging.getLogger(__name__)
         self.scopes = scopes
-        self.credentials = None
-        self.service = None
+        # one service per thread, each with the authorized HTTP connection of its thread
+        self.local = threading.local()
         self.credentials_type = credentials_type
         self.service_name = service_name
         self.service_version = service_version
-        token_file_name = "token_%s_%s.json" % (self.service_name, self.service_version)
-        self.token_file = os.path.join(os.getenv('CQORC_SECRETS_DIR', './secrets'), token_file_name)
+        # the credentials and the token file are shared by all the Google interfaces, see GoogleCredentials
+        self.credentials_broker = get_credentials_broker(key_file, credentials_type, secrets_dir)
+        missing_scopes = set(scopes) - set(SCOPES)
+        assert not missing_scopes, f"scopes should be listed in GoogleCredentials.SCOPES, {missing_scopes} are not"
 
 
     def get_credentials(self):
-        if self.credentials_type == "user":
-            return self.get_user_credentials()
-        elif self.credentials_type == "service":
-            return self.get_service()
-
-
-    def get_user_credentials(self):
-        if not self.credentials or not self.credentials.valid:
-            # The file token.json stores the user's access and refresh tokens, and is
-            # created automatically when the authorization flow completes for the first
-            # time.
-            if os.path.exists(self.token_file):
-                self.credentials = Credentials.from_authorized_user_file(self.token_file, self.scopes)
-            # If there are no (valid) credentials available, let the user log in.
-            if not self.credentials or not self.credentials.valid:
-                if self.credentials and self.credentials.expired and self.credentials.refresh_token:
-                    self.credentials.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                            self.key_file, self.scopes
-                            )
-                    self.credentials = flow.run_local_server(port=0)
-                # Save the credentials for the next run
-                with open(self.token_file, "w") as token:
-                    token.write(self.credentials.to_json())
-
-        return self.credentials
-
-
-    def get_service_credentials(self):
-        """Creates a Credential object with the correct OAuth2 authorization.
-        Uses the service account key stored in self.key_file
-        Returns:
-            Credentials, the user's credential.
-        """
-        if not self.credentials:
-            creds = ServiceAccountCredentials.from_json_keyfile_name(self.key_file, self.scopes)
-
-            if not creds or creds.invalid:
-                print('Unable to authenticate using service account key.')
-                sys.exit()
-            else:
-                self.credentials = creds
-
-        return self.credentials
+        return self.credentials_broker.get_credentials()
 
 
     def get_service(self):
-        if not self.service:
+        if getattr(self.local, 'service', None) is None:
             try:
-                service = build(self.service_name, self.service_version, credentials=self.get_credentials())
-                self.service = service
+                # built from the local discovery document, without fetching it
+                service = build_from_document(get_discovery_document(self.service_name, self.service_version, self.secrets_dir),
+                                              http=self.credentials_broker.get_http(),
+                                              requestBuilder=functools.partial(RateLimitedHttpRequest, secrets_dir=self.secrets_dir))
+                self.local.service = service
             except HttpError as error:
                 print('An error occurred: %s' % error)
 
-        return self.service
+        return getattr(self.local, 'service', None)
 
 
 
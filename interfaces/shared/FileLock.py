@@ -0,0 +1,44 @@
+import fcntl
+import os
+
+
+class FileLock:
+    '''Advisory lock on a file, shared between processes of the same host
+
+    Usage:
+        with FileLock(os.path.join(secrets_dir, 'token_zoom.json.lock')):
+            # only one process at a time runs this block
+            ...
+
+    Arguments:
+        path -- string. Path of the lock file, created if needed
+        shared -- boolean. Take a shared (read) lock instead of an exclusive one
+    '''
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.fd = None
+
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def write_atomically(path, data, mode=0o600):
+    '''Write data (str or bytes) to path so that readers never see a partial file'''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    with os.fdopen(os.open(tmp_path, flags, mode), 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
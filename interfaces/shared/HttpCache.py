@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from interfaces.shared.FileLock import FileLock, write_atomically
+
+
+class HttpCache:
+    '''Persistent cache of GET responses, revalidated with conditional requests
+
+    A response with an ETag or a Last-Modified header is stored with its body,
+    and the next identical GET is sent with If-None-Match / If-Modified-Since:
+    when the server answers 304 Not Modified, the stored body is used. A
+    response without validators is stored only if its service has a TTL, and
+    served without any request until it expires.
+
+    Entries are JSON files in `directory`, one per (service, request), listed
+    with their resource in an index (index.json). Like RequestCache, writes to
+    a resource invalidate the entries of the resource, of its sub-resources and
+    of its parents, including those stored by other runs: the entries are found
+    in the index, without reading them. Entries older than MAX_AGE are removed,
+    as are the oldest ones beyond MAX_ENTRIES (i.e. the pages of lists, which
+    are requested once).
+
+    Storing an entry appends one line to a journal (index.journal) instead of
+    rewriting the index. The journal is merged into the index by the next
+    invalidation, or when it grows beyond MAX_JOURNAL_SIZE.
+    '''
+    # seconds during which a response without validators is served without a request, 0 not to store it.
+    # The Zoom and Eventbrite APIs send no validators, Google sends an ETag for most of its resources
+    TTLS = {
+        'zoom': 300,
+        'eventbrite': 300,
+    }
+    # resources served without validators whose content changes at any time, never reused without a request:
+    # the registrants of late registrations must be seen as soon as they register, and the version of the
+    # structured content must be the current one, since the next version is posted with its number
+    NO_TTL_RESOURCES = {
+        'zoom': ('/registrants',),
+        'eventbrite': ('/attendees/', '/structured_content/'),
+    }
+    MAX_AGE = 7 * 24 * 3600
+    MAX_ENTRIES = 2000
+    # bytes, about 500 entries
+    MAX_JOURNAL_SIZE = 64 * 1024
+
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.json')
+        self.journal_path = os.path.join(directory, 'index.journal')
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+
+    def get_name(self, service, request):
+        return hashlib.sha1(json.dumps([service, request]).encode('utf-8')).hexdigest()
+
+
+    def get_path(self, service, request):
+        return os.path.join(self.directory, f"{self.get_name(service, request)}.json")
+
+
+    def get_ttl(self, service, resource):
+        if any(part in resource for part in self.NO_TTL_RESOURCES.get(service, ())):
+            return 0
+        return self.TTLS.get(service, 0)
+
+
+    def read_index(self):
+        '''{entry name: [service, resource, stored_at]}, with the entries of the journal'''
+        index = self.read_index_file()
+        try:
+            with open(self.journal_path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return index
+        for line in lines:
+            try:
+                name, service, resource, stored_at = json.loads(line)
+            except ValueError:
+                # line cut by a crash while it was written
+                continue
+            # an entry removed by an invalidation whose journal was not cleared is not added again
+            if os.path.exists(os.path.join(self.directory, f"{name}.json")):
+                index[name] = [service, resource, stored_at]
+        return index
+
+
+    def read_index_file(self):
+        '''Index of index.json, rebuilt from the entries if there is none'''
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            self.logger.warning(f"Invalid index {self.index_path}, rebuilding it")
+        index = {}
+        try:
+            files = [entry.path for entry in os.scandir(self.directory) if entry.name.endswith('.json') and entry.path != self.index_path]
+        except FileNotFoundError:
+            return index
+        for path in files:
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                index[os.path.basename(path)[:-len('.json')]] = [entry['service'], entry['resource'], entry['stored_at']]
+            except (OSError, ValueError, KeyError):
+                continue
+        return index
+
+
+    def update_index(self, function):
+        '''
+        Apply function to the index, under the lock of the processes of the host, and remove the entries it drops
+        and the expired ones. The journal is merged into the rewritten index.
+        '''
+        with self.lock, FileLock(self.index_path + ".lock"):
+            self.rewrite_index(function)
+
+
+    def rewrite_index(self, function):
+        index = self.read_index()
+        names = set(index)
+        function(index)
+        now = time.time()
+        kept = sorted((name for name in index if now - index[name][2] <= self.MAX_AGE),
+                      key=lambda name: index[name][2], reverse=True)[:self.MAX_ENTRIES]
+        for name in names - set(kept):
+            try:
+                os.remove(os.path.join(self.directory, f"{name}.json"))
+            except FileNotFoundError:
+                pass
+        write_atomically(self.index_path, json.dumps({name: index[name] for name in kept}))
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+
+    def load(self, service, request):
+        '''Return the stored entry of the request, or None'''
+        try:
+            with open(self.get_path(service, request)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # guard against hash collisions
+        return entry if entry.get('service') == service and entry.get('request') == request else None
+
+
+    def is_fresh(self, entry, service):
+        '''True if the entry has no validators and can be used without a request'''
+        if entry is None or entry.get('etag') or entry.get('last_modified'):
+            return False
+        return time.time() - entry['stored_at'] < self.get_ttl(service, entry['resource'])
+
+
+    def conditional_headers(self, entry):
+        '''Headers of a conditional GET revalidating the entry'''
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+
+    def store(self, service, resource, request, body, etag=None, last_modified=None, content_type=None):
+        '''Store the body of a response, if it has validators or its service has a TTL'''
+        if not etag and not last_modified and not self.get_ttl(service, resource):
+            return
+        entry = {
+            'service': service,
+            'resource': resource,
+            'request': request,
+            'etag': etag,
+            'last_modified': last_modified,
+            'content_type': content_type,
+            'stored_at': time.time(),
+            'body': body,
+        }
+        line = json.dumps([self.get_name(service, request), service, resource, entry['stored_at']]) + "\n"
+        try:
+            # written under the lock, so that an invalidation sees the entry in the journal once it is stored
+            with self.lock, FileLock(self.index_path + ".lock"):
+                write_atomically(self.get_path(service, request), json.dumps(entry))
+                with open(self.journal_path, 'a') as f:
+                    f.write(line)
+                    journal_size = f.tell()
+                if journal_size > self.MAX_JOURNAL_SIZE:
+                    self.rewrite_index(lambda index: None)
+        except OSError as error:
+            self.logger.warning(f"Could not store the response of {request}: {error}")
+
+
+    def invalidate(self, service, resource):
+        '''Remove the entries of the resource, of its sub-resources and of its parents'''
+        self.invalidate_all(service, [resource])
+
+
+    def invalidate_all(self, service, resources):
+        '''Remove the entries of the resources, of their sub-resources and of their parents'''
+        def remove(index):
+            for name, (entry_service, entry_resource, _) in list(index.items()):
+                if entry_service == service and any(entry_resource.startswith(resource) or resource.startswith(entry_resource)
+                                                    for resource in resources):
+                    del index[name]
+
+        if not os.path.exists(self.directory):
+            return
+        try:
+            self.update_index(remove)
+        except OSError as error:
+            self.logger.warning(f"Could not invalidate the responses of {resources}: {error}")
+
+
+    def send(self, service, resource, request, function):
+        '''Send a GET with the requests library, through the cache
+
+        Arguments:
+            service -- string. i.e. 'zoom'
+            resource -- string. Path of the resource read, for the invalidation
+            request -- string. Identifies the read, i.e. its URL and parameters
+            function -- callable taking the conditional headers to add, and sending the GET
+
+        Returns: a requests.Response, with the stored body if the resource was not modified
+        '''
+        entry = self.load(service, request)
+        if self.is_fresh(entry, service):
+            return to_response(entry)
+
+        response = function(self.conditional_headers(entry))
+        if response.status_code == 304 and entry is not None:
+            # the stored body is still valid, store it again to restart its TTL
+            self.store(service, resource, request, entry['body'], entry['etag'], entry['last_modified'], entry['content_type'])
+            response.status_code = 200
+            response.reason = 'OK'
+            response._content = entry['body'].encode('utf-8')
+            if entry['content_type']:
+                response.headers['Content-Type'] = entry['content_type']
+        elif response.status_code == 200:
+            self.store(service, resource, request, response.text,
+                       response.headers.get('ETag'), response.headers.get('Last-Modified'), response.headers.get('Content-Type'))
+        return response
+
+
+def to_response(entry):
+    '''requests.Response holding the body of a cache entry'''
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.url = entry['request'].split(' ', 1)[0]
+    response.encoding = 'utf-8'
+    response._content = entry['body'].encode('utf-8')
+    if entry['content_type']:
+        response.headers['Content-Type'] = entry['content_type']
+    return response
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_http_cache(secrets_dir):
+    '''Get the HTTP cache in <secrets_dir>/cache/http, shared by all the interfaces of the process'''
+    directory = os.path.join(secrets_dir, 'cache', 'http')
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = HttpCache(directory)
+        return _caches[directory]
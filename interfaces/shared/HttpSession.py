@@ -0,0 +1,53 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    '''HTTP adapter which applies a default timeout to the requests sent without one
+
+    Arguments:
+        timeout -- float or (connect, read) tuple of floats, in seconds
+        pool_maxsize -- integer. Number of connections kept alive per host
+    '''
+
+    def __init__(self, timeout, pool_maxsize):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+# seconds to establish a connection, and to wait for the response
+DEFAULT_TIMEOUT = (10, 60)
+# connections kept alive per host, enough for the thread pools of the scripts
+POOL_MAXSIZE = 16
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''Get the HTTP session shared by all the interfaces of the process
+
+    The session keeps the connections alive between calls, so that successive
+    calls to the same API reuse the same TCP+TLS connection. It asks for
+    compressed responses and applies DEFAULT_TIMEOUT to the calls made without
+    a timeout.
+
+    Returns: a requests.Session
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = TimeoutHTTPAdapter(DEFAULT_TIMEOUT, POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _session = session
+        return _session
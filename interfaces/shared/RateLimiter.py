@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from interfaces.shared.Resilience import InterfaceError
+
+
+class TokenBucket:
+    '''Token bucket, refilled at a constant rate, from which each call takes one token
+
+    Arguments:
+        rate -- float. Tokens added per second
+        capacity -- integer. Maximum number of tokens, that is the size of a burst
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # no token is given before this time, set when the server asks to retry later
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        '''Wait until a token is available and take it'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+
+    def pause(self, seconds):
+        '''Give no token for the given number of seconds, and empty the bucket'''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class AdaptiveLimit:
+    '''Limit of concurrent calls, adjusted with additive increase and multiplicative decrease (AIMD)
+
+    The limit grows by one after `increase_after` successful calls in a row,
+    up to `maximum`, and is halved, down to 1, each time a call is throttled.
+    '''
+
+    def __init__(self, maximum, increase_after=10):
+        self.maximum = maximum
+        self.limit = maximum
+        self.increase_after = increase_after
+        self.successes = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+
+    def acquire(self):
+        with self.condition:
+            while self.running >= int(self.limit):
+                self.condition.wait()
+            self.running += 1
+
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+
+    def increase(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.increase_after and self.limit < self.maximum:
+                self.successes = 0
+                self.limit += 1
+                self.condition.notify()
+
+
+    def decrease(self):
+        with self.condition:
+            self.successes = 0
+            self.limit = max(1, self.limit / 2)
+
+
+class RateLimitExceeded(InterfaceError):
+    '''Raised by Scheduler.call when a call is still throttled after all its retries'''
+
+
+class Scheduler:
+    '''Rate limits of the APIs, shared by all the interfaces of the process
+
+    Each service has a limit of concurrent calls, and each (service, category)
+    pair has a token bucket. The categories are those of the services
+    themselves: the Zoom light/medium/heavy endpoints, the Slack tiers.
+
+    Usage:
+        scheduler = get_scheduler()
+        response = scheduler.call('zoom', 'light', lambda: session.get(url),
+                                  is_throttled=lambda r: r.status_code == 429,
+                                  retry_after=lambda r: r.headers.get('Retry-After'))
+    '''
+    # (calls per second, burst) for each service and category, below the published quotas
+    # https://developers.zoom.us/docs/api/rest/rate-limits/
+    # https://api.slack.com/apis/rate-limits
+    # https://www.eventbrite.com/platform/api#/introduction/rate-limits
+    # https://developers.google.com/sheets/api/limits
+    RATES = {
+        ('zoom', 'light'): (20, 20),
+        ('zoom', 'medium'): (10, 10),
+        ('zoom', 'heavy'): (5, 5),
+        ('slack', 'tier1'): (1 / 60, 1),
+        ('slack', 'tier2'): (20 / 60, 5),
+        ('slack', 'tier3'): (50 / 60, 10),
+        ('slack', 'tier4'): (100 / 60, 20),
+        ('slack', 'post'): (1, 1),
+        ('eventbrite', 'default'): (2000 / 3600, 50),
+        ('google.sheets', 'default'): (1, 10),
+        ('google.drive', 'default'): (10, 20),
+        ('google.calendar', 'default'): (5, 10),
+    }
+    # maximum number of concurrent calls to each service
+    CONCURRENCY = {
+        'zoom': 8,
+        'slack': 4,
+        'eventbrite': 4,
+        'google.sheets': 4,
+        'google.drive': 8,
+        'google.calendar': 8,
+    }
+    # seconds to wait when a call is throttled without a Retry-After, doubled for each retry
+    default_retry_after = 2
+    max_retries = 5
+
+
+    def __init__(self):
+        self.buckets = {}
+        self.limits = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+
+    def get_bucket(self, service, category):
+        with self.lock:
+            key = (service, category)
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(*self.RATES.get(key, self.RATES.get((service, 'default'), (1, 1))))
+            return self.buckets[key]
+
+
+    def get_limit(self, service):
+        with self.lock:
+            if service not in self.limits:
+                self.limits[service] = AdaptiveLimit(self.CONCURRENCY.get(service, 4))
+            return self.limits[service]
+
+
+    @contextmanager
+    def slot(self, service, category='default'):
+        '''Wait for a concurrency slot and a token of the service, for one call'''
+        limit = self.get_limit(service)
+        limit.acquire()
+        try:
+            self.get_bucket(service, category).acquire()
+            yield
+        finally:
+            limit.release()
+
+
+    def throttled(self, service, category, retry_after=None, attempt=0):
+        '''Record that a call was throttled, and pause the category for Retry-After seconds'''
+        try:
+            seconds = float(retry_after)
+        except (TypeError, ValueError):
+            seconds = self.default_retry_after * 2 ** attempt
+        self.logger.warning(f"Rate limit of {service} ({category}) exceeded, waiting {seconds}s")
+        self.get_bucket(service, category).pause(seconds)
+        self.get_limit(service).decrease()
+
+
+    def succeeded(self, service):
+        self.get_limit(service).increase()
+
+
+    def call(self, service, category, function, is_throttled, retry_after=lambda result: None):
+        '''Call function within the rate limits of the service, and retry it while it is throttled
+
+        Arguments:
+            service -- string. i.e. 'zoom'
+            category -- string. Category of the endpoint, i.e. 'light'
+            function -- callable without arguments, doing the call
+            is_throttled -- callable taking the result, or the exception raised, of function
+            retry_after -- callable taking the result, or the exception, returning Retry-After
+
+        Returns: the result of function
+        '''
+        for attempt in range(self.max_retries + 1):
+            with self.slot(service, category):
+                try:
+                    result = function()
+                except Exception as error:
+                    if not is_throttled(error) or attempt == self.max_retries:
+                        raise
+                    self.throttled(service, category, retry_after(error), attempt)
+                    continue
+
+            if not is_throttled(result):
+                self.succeeded(service)
+                return result
+            if attempt == self.max_retries:
+                raise RateLimitExceeded(service, f"rate limit ({category}) still exceeded after {self.max_retries} retries",
+                                        status=429, retryable=True, response=result)
+            self.throttled(service, category, retry_after(result), attempt)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    '''Get the rate limit scheduler shared by all the interfaces of the process'''
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
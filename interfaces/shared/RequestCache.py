@@ -0,0 +1,121 @@
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+
+def resource_path(url):
+    '''Host and path of the resource of a URL, without the query and without a trailing ":action"
+
+    i.e. 'https://sheets.googleapis.com/v4/spreadsheets/ID/values:batchUpdate?alt=json'
+      -> 'sheets.googleapis.com/v4/spreadsheets/ID/values'
+         'https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart'
+      -> 'www.googleapis.com/drive/v3/files'
+    '''
+    parts = urlsplit(url)
+    path = parts.path
+    # media uploads modify the same resources as the other requests
+    if path.startswith('/upload/'):
+        path = path[len('/upload'):]
+    if ':' in path.rsplit('/', 1)[-1]:
+        path = path[:path.rindex(':')]
+    return parts.netloc + path
+
+
+class RequestCache:
+    '''Cache of the responses of idempotent reads, for the duration of a run
+
+    Identical concurrent reads are coalesced: the first one does the call, the
+    others wait for its result (single-flight). Writes invalidate the cached
+    reads of the same resource, of its sub-resources and of its parents (i.e.
+    a write to /webinars/123/panelists invalidates /webinars/123/panelists and
+    /webinars/123).
+
+    Entries are (service, resource, request) keys, where resource is a path
+    compared by prefix for the invalidation, and request identifies the read
+    (i.e. its full URL with the query).
+    '''
+
+    def __init__(self):
+        self.values = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    @contextmanager
+    def disabled(self):
+        '''Within the context, the reads of the current thread are neither cached nor served from the cache'''
+        previous = getattr(self.local, 'disabled', False)
+        self.local.disabled = True
+        try:
+            yield
+        finally:
+            self.local.disabled = previous
+
+
+    def get(self, service, resource, request, function, cacheable=lambda result: True):
+        '''Return the cached result of the read, or call function and cache its result
+
+        Arguments:
+            service -- string. i.e. 'zoom'
+            resource -- string. Path of the resource read
+            request -- hashable. Identifies the read of the resource, i.e. its URL and parameters
+            function -- callable without arguments, doing the read
+            cacheable -- callable taking the result, False for results not to cache (i.e. errors)
+        '''
+        if getattr(self.local, 'disabled', False):
+            return function()
+
+        key = (service, resource, request)
+        while True:
+            with self.lock:
+                if key in self.values:
+                    return self.values[key]
+                event = self.pending.get(key)
+                if event is None:
+                    event = self.pending[key] = threading.Event()
+                    break
+            # another thread is doing the same read, wait for it and use its result
+            event.wait()
+
+        try:
+            result = function()
+            if cacheable(result):
+                with self.lock:
+                    # not cached if the resource was written in the meantime
+                    if self.pending.get(key) is event:
+                        self.values[key] = result
+            return result
+        finally:
+            with self.lock:
+                if self.pending.get(key) is event:
+                    del self.pending[key]
+            event.set()
+
+
+    def invalidate(self, service, resource):
+        '''Forget the cached reads of the resource, of its sub-resources and of its parents'''
+        with self.lock:
+            for key in list(self.values) + list(self.pending):
+                if key[0] == service and (key[1].startswith(resource) or resource.startswith(key[1])):
+                    self.values.pop(key, None)
+                    self.pending.pop(key, None)
+
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+            self.pending = {}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    '''Get the request cache shared by all the interfaces of the process'''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RequestCache()
+        return _cache
@@ -0,0 +1,148 @@
+import logging
+import random
+import socket
+import threading
+import time
+import urllib.error
+
+import requests
+
+# HTTP statuses of transient failures, worth retrying (429 is retried by the rate limit scheduler)
+RETRYABLE_STATUSES = {408, 500, 502, 503, 504}
+
+
+class InterfaceError(Exception):
+    '''Error raised by the interfaces when a call to a service fails
+
+    Attributes:
+        service -- string. i.e. 'zoom', 'google.sheets'
+        status -- integer or None. HTTP status of the response, if any
+        retryable -- boolean. True if the failure was transient, and retries were exhausted
+        response -- the response or the exception of the last attempt, if any
+    '''
+
+    def __init__(self, service, message, status=None, retryable=False, response=None):
+        super(InterfaceError, self).__init__(f"{service}: {message}")
+        self.service = service
+        self.status = status
+        self.retryable = retryable
+        self.response = response
+
+
+class CircuitOpenError(InterfaceError):
+    '''Raised without calling a service which failed repeatedly, until its circuit breaker resets'''
+
+
+def is_transient_error(error):
+    '''True for network errors: connection refused or reset, timeouts, DNS failures'''
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, urllib.error.URLError,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class CircuitBreaker:
+    '''Stops calling a service after consecutive transient failures
+
+    After `failure_threshold` consecutive failures, the circuit opens and calls
+    fail immediately with CircuitOpenError. After `reset_timeout` seconds, one
+    call is let through: the circuit closes if it succeeds, and opens again
+    otherwise.
+    '''
+
+    def __init__(self, service, failure_threshold=5, reset_timeout=60):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(self.service, f"too many failures, not called for {self.reset_timeout}s", retryable=True)
+            # half-open: let this call through, the next ones raise CircuitOpenError until it succeeds,
+            # or until reset_timeout elapses again
+            self.opened_at = time.monotonic()
+
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(service):
+    '''Get the circuit breaker of the service, shared by all the interfaces of the process'''
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(service)
+        return _breakers[service]
+
+
+def backoff_delay(attempt, base_delay=1, max_delay=30):
+    '''Exponential backoff with full jitter: a random delay up to base_delay * 2**attempt seconds'''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call(service, function, is_transient, idempotent=True, max_attempts=4, get_status=lambda failure: None):
+    '''Call function, retrying it on transient failures if it is idempotent
+
+    Arguments:
+        service -- string. Name of the service, for the circuit breaker and the errors
+        function -- callable without arguments, doing the call
+        is_transient -- callable taking the result, or the exception raised, of function.
+                        True if the call failed in a way that may succeed when retried
+        idempotent -- boolean. Only idempotent calls are retried, so that nothing is created twice
+        max_attempts -- integer. Number of attempts of idempotent calls
+        get_status -- callable returning the HTTP status of a failed result or exception
+
+    Returns: the result of function
+
+    Raises:
+        InterfaceError if the call still fails transiently after the attempts,
+        CircuitOpenError if the service failed repeatedly. Other exceptions are
+        raised unchanged.
+    '''
+    logger = logging.getLogger(__name__)
+    breaker = get_circuit_breaker(service)
+    attempts = max_attempts if idempotent else 1
+
+    for attempt in range(attempts):
+        breaker.before_call()
+        try:
+            result = function()
+        except InterfaceError:
+            raise
+        except Exception as error:
+            if not is_transient(error):
+                breaker.record_success()
+                raise
+            failure = error
+        else:
+            if not is_transient(result):
+                breaker.record_success()
+                return result
+            failure = result
+
+        breaker.record_failure()
+        if attempt < attempts - 1:
+            delay = backoff_delay(attempt)
+            logger.warning(f"Transient failure of {service} ({get_status(failure) or failure}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    raise InterfaceError(service, f"call failed after {attempts} attempt(s): {get_status(failure) or failure}",
+                         status=get_status(failure), retryable=True, response=failure)
@@ -1,18 +1,87 @@
 #!/usr/bin/env python3
 
+import json
 import logging
 import os
 from datetime import datetime, timedelta
 # Import WebClient from Python SDK (github.com/slackapi/python-slack-sdk)
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+from interfaces.shared.RateLimiter import get_scheduler
+from interfaces.shared.RequestCache import get_cache
+from interfaces.shared import Resilience
+
+
+class RateLimitedWebClient(WebClient):
+    """
+    WebClient which calls each API method within the rate limits of its tier, and retries it
+    after the delay given by Slack when it is throttled (HTTP 429).
+    https://api.slack.com/apis/rate-limits
+
+    The methods which only read (*.list, *.info) are also retried, with a backoff, on network
+    errors and 5xx responses. InterfaceError is raised if they still fail after the retries, and
+    SlackApiError is raised as an InterfaceError with the response of Slack (see error_code).
+
+    Their responses are cached for the rest of the run, and the other methods invalidate the
+    cached responses of their family (i.e. conversations.invite invalidates conversations.info).
+    """
+    # methods which are not listed are in tier 3
+    METHOD_TIERS = {
+        'bookmarks.add': 'tier2',
+        'bookmarks.remove': 'tier2',
+        'conversations.archive': 'tier2',
+        'conversations.create': 'tier2',
+        'conversations.list': 'tier2',
+        'users.list': 'tier2',
+        'chat.postMessage': 'post',
+    }
+
+    def api_call(self, api_method, **kwargs):
+        family = api_method.split('.')[0] + '.'
+        if api_method.endswith(('.list', '.info')):
+            request_key = (api_method, json.dumps(kwargs, sort_keys=True, default=str))
+            return get_cache().get('slack', family, request_key,
+                                   lambda: self.send_api_call(api_method, **kwargs))
+
+        try:
+            return self.send_api_call(api_method, **kwargs)
+        finally:
+            get_cache().invalidate('slack', family)
+
+    def send_api_call(self, api_method, **kwargs):
+        try:
+            return Resilience.call(
+                'slack',
+                lambda: get_scheduler().call(
+                    'slack', self.METHOD_TIERS.get(api_method, 'tier3'),
+                    lambda: super(RateLimitedWebClient, self).api_call(api_method, **kwargs),
+                    is_throttled=lambda error: isinstance(error, SlackApiError) and error.response.status_code == 429,
+                    retry_after=lambda error: error.response.headers.get('Retry-After', error.response.headers.get('retry-after'))),
+                is_transient=lambda error: Resilience.is_transient_error(error) or
+                    (isinstance(error, SlackApiError) and error.response.status_code in Resilience.RETRYABLE_STATUSES),
+                idempotent=api_method.endswith(('.list', '.info')),
+                get_status=lambda error: error.response.status_code if isinstance(error, SlackApiError) else None)
+        except SlackApiError as error:
+            raise Resilience.InterfaceError('slack', f"{api_method}: {error.response.get('error')}",
+                                            status=error.response.status_code, response=error.response) from error
+
+
+def error_code(error):
+    """Error code of Slack (i.e. 'name_taken') of an InterfaceError, None if Slack did not answer with one"""
+    if isinstance(error.response, SlackApiError):
+        return error.response.response.get('error')
+    if isinstance(error.response, SlackResponse):
+        return error.response.get('error')
+    return None
+
 
 class SlackInterface:
     def __init__(self, bot_token):
         self.bot_token = bot_token
         # WebClient instantiates a client that can call API methods
         # When using Bolt, you can use either `app.client` or the `client` passed to listeners.
-        self.client = WebClient(token=self.bot_token)
+        self.client = RateLimitedWebClient(token=self.bot_token)
         self.logger = logging.getLogger(__name__)
         self.channel_dict = {}
         self.user_dict = {}
@@ -26,8 +95,11 @@ class SlackInterface:
                     )
             self.logger.info(result)
 
-        except SlackApiError as e:
-            self.logger.error("Error creating conversation: {}".format(e))
+        except Resilience.InterfaceError as e:
+            # the channel was created by an earlier run
+            if error_code(e) != 'name_taken':
+                raise
+            self.logger.info(f"Channel {name} already exists")
 
 
     def get_channel_id(self, name, next_cursor=None):
@@ -35,31 +107,27 @@ class SlackInterface:
         if name in self.channel_dict:
             return self.channel_dict[name]
 
-        try:
-            if next_cursor is None:
-                result = self.client.conversations_list(limit=100, exclude_archived=True)
-            else:
-                result = self.client.conversations_list(limit=100, exclude_archived=True, cursor=next_cursor)
-
-            # if we find the channel, it ends here
-            for channel in result['channels']:
-                # populate channel_dict for all channels retrieved
-                self.channel_dict[channel['name']] = channel['id']
-
-            if name in self.channel_dict:
-                return self.channel_dict[name]
-
-            # if it was not found, check next cursor
-            # at the end, next_cursor will be an empty string
-            next_cursor = result["response_metadata"]["next_cursor"]
-            if next_cursor != "":
-                return self.get_channel_id(name, next_cursor)
-            else:
-                return None
-            self.logger.info(result)
+        if next_cursor is None:
+            result = self.client.conversations_list(limit=100, exclude_archived=True)
+        else:
+            result = self.client.conversations_list(limit=100, exclude_archived=True, cursor=next_cursor)
+
+        # if we find the channel, it ends here
+        for channel in result['channels']:
+            # populate channel_dict for all channels retrieved
+            self.channel_dict[channel['name']] = channel['id']
 
-        except SlackApiError as e:
-            self.logger.error("Error listing conversations: {}".format(e))
+        if name in self.channel_dict:
+            return self.channel_dict[name]
+
+        # if it was not found, check next cursor
+        # at the end, next_cursor will be an empty string
+        next_cursor = result["response_metadata"]["next_cursor"]
+        if next_cursor != "":
+            return self.get_channel_id(name, next_cursor)
+        else:
+            return None
+        self.logger.info(result)
 
 
     def get_user_id(self, email, next_cursor=None):
@@ -67,40 +135,36 @@ class SlackInterface:
         if email in self.user_dict:
             return self.user_dict[email]
 
-        try:
-            if next_cursor is None:
-                result = self.client.users_list(limit=100, exclude_archived=True)
-            else:
-                result = self.client.users_list(limit=100, exclude_archived=True, cursor=next_cursor)
-
-            # if we find the user, it ends here
-            for user in result['members']:
-                if 'profile' in user and 'email' in user['profile'] and user['profile']['email'] == email:
-                    self.user_dict[email] = user['id']
-                    return user['id']
-
-            # if it was not found, check next cursor
-            # at the end, next_cursor will be an empty string
-            next_cursor = result["response_metadata"]["next_cursor"]
-            if next_cursor != "":
-                return self.get_user_id(email, next_cursor)
-            else:
-                return None
-            self.logger.info(result)
+        if next_cursor is None:
+            result = self.client.users_list(limit=100, exclude_archived=True)
+        else:
+            result = self.client.users_list(limit=100, exclude_archived=True, cursor=next_cursor)
 
-        except SlackApiError as e:
-            self.logger.error("Error listing users: {}".format(e))
+        # if we find the user, it ends here
+        for user in result['members']:
+            if 'profile' in user and 'email' in user['profile'] and user['profile']['email'] == email:
+                self.user_dict[email] = user['id']
+                return user['id']
+
+        # if it was not found, check next cursor
+        # at the end, next_cursor will be an empty string
+        next_cursor = result["response_metadata"]["next_cursor"]
+        if next_cursor != "":
+            return self.get_user_id(email, next_cursor)
+        else:
+            return None
+        self.logger.info(result)
 
 
     def invite_to_channel(self, channel_name, user_emails):
-        try:
-            channel= self.get_channel_id(channel_name)
-            if isinstance(user_emails, str):
-                user_emails = user_emails.split(',')
-                user_emails = [email.strip() for email in user_emails]
+        channel= self.get_channel_id(channel_name)
+        if isinstance(user_emails, str):
+            user_emails = user_emails.split(',')
+            user_emails = [email.strip() for email in user_emails]
 
-            users = ",".join([self.get_user_id(email) for email in user_emails])
+        users = ",".join([self.get_user_id(email) for email in user_emails])
 
+        try:
             result = self.client.conversations_invite(
                     # The name of the conversation
                     channel=channel,
@@ -109,96 +173,79 @@ class SlackInterface:
             # Log the result which includes information like the ID of the conversation
             self.logger.info(result)
 
-        except SlackApiError as e:
-            self.logger.error("Error inviting to conversation: {}".format(e))
+        except Resilience.InterfaceError as e:
+            # the users were invited by an earlier run
+            if error_code(e) != 'already_in_channel':
+                raise
+            self.logger.info(f"{users} already in channel {channel_name}")
 
 
     def join_channel(self, channel_name):
-        try:
-            channel= self.get_channel_id(channel_name)
-            result = self.client.conversations_join(
+        channel= self.get_channel_id(channel_name)
+        result = self.client.conversations_join(
+                # The name of the conversation
+                channel=channel,
+                )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
+
+
+    def is_member(self, channel_name):
+        channel= self.get_channel_id(channel_name)
+        result = self.client.conversations_info(
+                # The name of the conversation
+                channel=channel,
+                )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
+        return result['channel']['is_member']
+
+
+    def post_to_channel(self, channel_name, message, schedule=None):
+        channel= self.get_channel_id(channel_name)
+
+        if schedule:
+            schedule_timestamp = schedule.strftime('%s')
+            result = self.client.chat_scheduleMessage(
                     # The name of the conversation
                     channel=channel,
+                    text=message,
+                    post_at=schedule_timestamp
                     )
             # Log the result which includes information like the ID of the conversation
             self.logger.info(result)
-
-        except SlackApiError as e:
-            self.logger.error(f"Error joining conversation: {e}")
-
-
-    def is_member(self, channel_name):
-        try:
-            channel= self.get_channel_id(channel_name)
-            result = self.client.conversations_info(
+        else:
+            result = self.client.chat_postMessage(
                     # The name of the conversation
                     channel=channel,
+                    text=message
                     )
             # Log the result which includes information like the ID of the conversation
             self.logger.info(result)
-            return result['channel']['is_member']
-
-        except SlackApiError as e:
-            self.logger.error(f"Error joining conversation: {e}")
-
-
-    def post_to_channel(self, channel_name, message, schedule=None):
-        try:
-            channel= self.get_channel_id(channel_name)
-
-            if schedule:
-                schedule_timestamp = schedule.strftime('%s')
-                result = self.client.chat_scheduleMessage(
-                        # The name of the conversation
-                        channel=channel,
-                        text=message,
-                        post_at=schedule_timestamp
-                        )
-                # Log the result which includes information like the ID of the conversation
-                self.logger.info(result)
-            else:
-                result = self.client.chat_postMessage(
-                        # The name of the conversation
-                        channel=channel,
-                        text=message
-                        )
-                # Log the result which includes information like the ID of the conversation
-                self.logger.info(result)
-
-        except SlackApiError as e:
-            self.logger.error(f"Error posting message: {e}")
 
 
     def list_channel_scheduled_messages(self, channel_name):
-        try:
-            channel= self.get_channel_id(channel_name)
-
-            result = self.client.chat_scheduledMessages_list(
-                        # The name of the conversation
-                        channel=channel
-                        )
-            # Log the result which includes information like the ID of the conversation
-            self.logger.info(result)
-            return result['scheduled_messages']
+        channel= self.get_channel_id(channel_name)
 
-        except SlackApiError as e:
-            self.logger.error(f"Error listing scheduled messages: {e}")
+        result = self.client.chat_scheduledMessages_list(
+                    # The name of the conversation
+                    channel=channel
+                    )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
+        return result['scheduled_messages']
 
 
     def delete_channel_scheduled_messages(self, channel_name, message_id):
-        try:
-            channel= self.get_channel_id(channel_name)
+        channel= self.get_channel_id(channel_name)
 
-            result = self.client.chat_deleteScheduledMessage(
-                        # The name of the conversation
-                        channel=channel,
-                        scheduled_message_id=message_id
-                        )
-            # Log the result which includes information like the ID of the conversation
-            self.logger.info(result)
-
-        except SlackApiError as e:
-            self.logger.error(f"Error deleting scheduled messages: {e}")
+        result = self.client.chat_deleteScheduledMessage(
+                    # The name of the conversation
+                    channel=channel,
+                    scheduled_message_id=message_id
+                    )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
 
 
     def wipe_channel_scheduled_messages(self, channel_name):
@@ -207,53 +254,41 @@ class SlackInterface:
 
 
     def add_bookmark_to_channel(self, channel_name, title, link):
-        try:
-            channel= self.get_channel_id(channel_name)
+        channel= self.get_channel_id(channel_name)
 
-            result = self.client.bookmarks_add(
-                    # The name of the conversation
-                    channel_id=channel,
-                    type='link',
-                    title=title,
-                    link=link
-                    )
-            # Log the result which includes information like the ID of the conversation
-            self.logger.info(result)
-
-        except SlackApiError as e:
-            self.logger.error(f"Error adding bookmark: {e}")
+        result = self.client.bookmarks_add(
+                # The name of the conversation
+                channel_id=channel,
+                type='link',
+                title=title,
+                link=link
+                )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
 
 
     def list_channel_bookmarks(self, channel_name):
-        try:
-            channel= self.get_channel_id(channel_name)
+        channel= self.get_channel_id(channel_name)
 
-            result = self.client.bookmarks_list(
-                    # The name of the conversation
-                    channel_id=channel,
-                    )
-            # Log the result which includes information like the ID of the conversation
-            self.logger.info(result)
-            return result['bookmarks']
-
-        except SlackApiError as e:
-            self.logger.error(f"Error listing bookmark: {e}")
+        result = self.client.bookmarks_list(
+                # The name of the conversation
+                channel_id=channel,
+                )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
+        return result['bookmarks']
 
 
     def delete_bookmark_from_channel(self, channel_name, bookmark_id):
-        try:
-            channel= self.get_channel_id(channel_name)
-
-            result = self.client.bookmarks_remove(
-                    # The name of the conversation
-                    channel_id=channel,
-                    bookmark_id=bookmark_id,
-                    )
-            # Log the result which includes information like the ID of the conversation
-            self.logger.info(result)
+        channel= self.get_channel_id(channel_name)
 
-        except SlackApiError as e:
-            self.logger.error(f"Error removing bookmark: {e}")
+        result = self.client.bookmarks_remove(
+                # The name of the conversation
+                channel_id=channel,
+                bookmark_id=bookmark_id,
+                )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
 
 
     def get_channel_bookmark_link(self, channel_name, bookmark_title):
@@ -275,18 +310,14 @@ class SlackInterface:
 
 
     def archive_channel(self, channel_name):
-        try:
-            channel= self.get_channel_id(channel_name)
-
-            result = self.client.conversations_archive(
-                    # The name of the conversation
-                    channel=channel
-                    )
-            # Log the result which includes information like the ID of the conversation
-            self.logger.info(result)
-
-        except SlackApiError as e:
-            self.logger.error(f"Error archiving channel: {e}")
+        channel= self.get_channel_id(channel_name)
+
+        result = self.client.conversations_archive(
+                # The name of the conversation
+                channel=channel
+                )
+        # Log the result which includes information like the ID of the conversation
+        self.logger.info(result)
 
 
 
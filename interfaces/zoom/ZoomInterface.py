@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
-import requests
+import json
+import os
+import time
 from datetime import datetime
 
+from interfaces.shared.FileLock import FileLock, write_atomically
+from interfaces.shared.HttpSession import get_session
+from interfaces.shared.RateLimiter import get_scheduler
+from interfaces.shared.RequestCache import get_cache
+from interfaces.shared.HttpCache import get_http_cache
+from interfaces.shared import Resilience
+from interfaces.shared.Resilience import InterfaceError
+
 class ZoomInterface:
     '''Constants
 
@@ -12,9 +22,11 @@ class ZoomInterface:
     '''
     auth_token_url = "https://zoom.us/oauth/token"
     api_base_url = "https://api.zoom.us/v2"
+    # refresh the access token this many seconds before it expires
+    token_refresh_margin = 300
 
 
-    def __init__(self, account_id, client_id, client_secret, timezone = "America/Montreal", user = "me"):
+    def __init__(self, account_id, client_id, client_secret, timezone = "America/Montreal", user = "me", secrets_dir = "./secrets"):
         '''Initialize the Zoom interface object with API credentials
 
         Reference: https://developers.zoom.us/docs/zoom-rooms/s2s-oauth/
@@ -26,6 +38,7 @@ class ZoomInterface:
             timezone -- string. Valid values are in all_timezones from pytz
                 https://pythonhosted.org/pytz/#helpers
             user -- string. Zoom username, either email address or "me"
+            secrets_dir -- string. Directory of the token file and of the HTTP cache
         '''
 
         self.account_id = account_id
@@ -33,10 +46,17 @@ class ZoomInterface:
         self.client_secret = client_secret
         self.timezone = timezone
         self.user = user
+        self.access_token = None
+        self.token_expires_at = 0
+        # connections are kept alive between the calls to the API
+        self.session = get_session()
+        # the token and the cached responses are shared with the other scripts running on this host
+        self.secrets_dir = secrets_dir
+        self.token_file = os.path.join(secrets_dir, "token_zoom.json")
 
 
     def get_authorization_header(self):
-        '''Get the OAuth temporary authorization token
+        '''Get the headers to authenticate with the OAuth temporary token
 
         Reference:
             https://developers.zoom.us/docs/zoom-rooms/s2s-oauth/
@@ -45,7 +65,74 @@ class ZoomInterface:
         Returns: dictionary with keys "Authorization" and "Content-Type"
         '''
 
-        response = requests.post(
+        headers = {
+            "Authorization": f"Bearer {self.get_access_token()}",
+            "Content-Type": "application/json"
+        }
+
+        return headers
+
+
+    def get_access_token(self):
+        '''Get a valid OAuth access token, requesting a new one only when needed
+
+        The token is kept in memory and in the token file of the secrets
+        directory, so that successive API calls and concurrent scripts reuse
+        it until it is about to expire. The token file is locked while it is
+        read and renewed, so only one process requests a new token.
+
+        Returns: the access token string
+        '''
+
+        if self.access_token and time.time() < self.token_expires_at - self.token_refresh_margin:
+            return self.access_token
+
+        with FileLock(self.token_file + ".lock"):
+            token = self.read_token_file()
+            if not token or time.time() >= token['expires_at'] - self.token_refresh_margin:
+                token = self.request_access_token()
+                write_atomically(self.token_file, json.dumps(token))
+
+        self.access_token = token['access_token']
+        self.token_expires_at = token['expires_at']
+        return self.access_token
+
+
+    def read_token_file(self):
+        '''Read the cached token, or None if it is missing or for another app'''
+        try:
+            with open(self.token_file) as f:
+                token = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if token.get('account_id') != self.account_id or token.get('client_id') != self.client_id:
+            return None
+        return token
+
+
+    def forget_access_token(self, access_token):
+        '''Delete the token rejected by Zoom (HTTP 401), so that a new one is requested
+
+        The token file is only deleted if it still holds this token: another
+        process may already have replaced it.
+        '''
+
+        self.access_token = None
+        self.token_expires_at = 0
+        with FileLock(self.token_file + ".lock"):
+            token = self.read_token_file()
+            if token and token['access_token'] == access_token:
+                os.remove(self.token_file)
+
+
+    def request_access_token(self):
+        '''Request a new OAuth access token from Zoom
+
+        Returns: dictionary with keys "access_token", "expires_at", "account_id" and "client_id"
+        '''
+
+        response = self.session.post(
             self.auth_token_url,
             auth=(self.client_id, self.client_secret),
             data={
@@ -54,17 +141,96 @@ class ZoomInterface:
                 "client_secret": self.client_secret
             })
 
+        self.check_response(response, 200)
         response_data = response.json()
 
-        assert response.status_code == 200, response_data['message']
-
-        access_token = response_data["access_token"]
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
+        return {
+            "access_token": response_data["access_token"],
+            "expires_at": time.time() + int(response_data.get("expires_in", 3600)),
+            "account_id": self.account_id,
+            "client_id": self.client_id,
         }
 
-        return headers
+
+    def request(self, method, url, category='light', **kwargs):
+        '''Send a request to the Zoom API within its rate limits
+
+        The request waits for the rate limits of its endpoint category, and is
+        retried after the delay given by Zoom when it is throttled (HTTP 429).
+        Requests other than POST are also retried, with a backoff, on network
+        errors and on 5xx responses.
+
+        Successful GET responses are cached for the rest of the run, and the
+        other requests invalidate the cached responses of the same resource
+        and of the lists of the user (see RequestCache). Between runs, GET
+        responses are kept on disk for a few minutes (see HttpCache).
+
+        Reference: https://developers.zoom.us/docs/api/rest/rate-limits/
+
+        Arguments:
+            method -- string. HTTP method, i.e. "GET"
+            url -- string. Full URL of the endpoint
+            category -- string. Rate limit label of the endpoint: "light", "medium" or "heavy"
+            kwargs -- passed to requests.Session.request (headers, json, params)
+
+        Returns: the requests.Response
+
+        Raises: InterfaceError if the request still fails after the retries
+        '''
+        if method == "GET":
+            request_key = f"{url} {json.dumps(kwargs.get('params'), sort_keys=True, default=str)}"
+            return get_cache().get('zoom', url, request_key,
+                                   lambda: get_http_cache(self.secrets_dir).send('zoom', url, request_key,
+                                       lambda headers: self.send_request(method, url, category,
+                                           **dict(kwargs, headers={**kwargs.get('headers', {}), **headers}))),
+                                   cacheable=lambda response: response.status_code == 200)
+
+        try:
+            return self.send_request(method, url, category, **kwargs)
+        finally:
+            resources = (url, f"{self.api_base_url}/users/{self.user}/")
+            for resource in resources:
+                get_cache().invalidate('zoom', resource)
+            get_http_cache(self.secrets_dir).invalidate_all('zoom', resources)
+
+
+    def send_request(self, method, url, category, **kwargs):
+        '''Send a request, without the cache, within the rate limits and with retries (see request())
+
+        When Zoom rejects the access token (HTTP 401, i.e. it was revoked), the
+        token is deleted and the request is sent once more with a new token.
+        '''
+        response = self.send_request_once(method, url, category, **kwargs)
+        authorization = kwargs.get('headers', {}).get('Authorization', '')
+        if getattr(response, 'status_code', None) == 401 and authorization.startswith('Bearer '):
+            self.forget_access_token(authorization[len('Bearer '):])
+            kwargs = dict(kwargs, headers={**kwargs['headers'], 'Authorization': f"Bearer {self.get_access_token()}"})
+            response = self.send_request_once(method, url, category, **kwargs)
+        return response
+
+
+    def send_request_once(self, method, url, category, **kwargs):
+        return Resilience.call(
+            'zoom',
+            lambda: get_scheduler().call(
+                'zoom', category,
+                lambda: self.session.request(method, url, **kwargs),
+                is_throttled=lambda response: getattr(response, 'status_code', None) == 429,
+                retry_after=lambda response: response.headers.get('Retry-After')),
+            is_transient=lambda response: Resilience.is_transient_error(response) or
+                getattr(response, 'status_code', None) in Resilience.RETRYABLE_STATUSES,
+            idempotent=method != "POST",
+            get_status=lambda response: getattr(response, 'status_code', None))
+
+
+    def check_response(self, response, expected_status):
+        '''Raise InterfaceError if the response does not have the expected HTTP status'''
+        if response.status_code != expected_status:
+            try:
+                message = response.json().get('message', response.text)
+            except ValueError:
+                message = response.text
+            raise InterfaceError('zoom', message, status=response.status_code, response=response)
 
 
     def create_meeting(self, topic, duration, start_date, start_time, settings = {}):
@@ -83,12 +249,11 @@ class ZoomInterface:
         for key, value in settings.items():
             payload[key] = value
 
-        resp = requests.post(f"{self.api_base_url}/users/{self.user}/meetings",
-                             headers=headers,
-                             json=payload)
+        resp = self.request("POST", f"{self.api_base_url}/users/{self.user}/meetings", "medium",
+                            headers=headers,
+                            json=payload)
 
-        if resp.status_code!=201:
-            print("Unable to generate meeting link")
+        self.check_response(resp, 201)
         response_data = resp.json()
         return response_data
 
@@ -96,12 +261,10 @@ class ZoomInterface:
         headers = self.get_authorization_header()
 
         # https://developers.zoom.us/docs/api/rest/reference/zoom-api/methods/#operation/meetingDelete
-        resp = requests.delete(f"{self.api_base_url}/meetings/{meeting_id}",
-                               headers=headers)
+        resp = self.request("DELETE", f"{self.api_base_url}/meetings/{meeting_id}",
+                            headers=headers)
 
-        if resp.status_code!=204:
-            print("Unable to delete meeting")
-            print(f"{resp}")
+        self.check_response(resp, 204)
 
         return
 
@@ -133,12 +296,11 @@ class ZoomInterface:
         for key, value in settings.items():
             payload[key] = value
 
-        resp = requests.post(f"{self.api_base_url}/users/{self.user}/webinars",
-                             headers=headers,
-                             json=payload)
+        resp = self.request("POST", f"{self.api_base_url}/users/{self.user}/webinars", "medium",
+                            headers=headers,
+                            json=payload)
 
-        if resp.status_code!=201:
-            print("Unable to generate webinar link")
+        self.check_response(resp, 201)
         response_data = resp.json()
         return response_data
 
@@ -147,12 +309,10 @@ class ZoomInterface:
 
         # https://developers.zoom.us/docs/api/rest/reference/zoom-api/methods/#operation/webinarDelete
         print(f"{self.api_base_url}/webinars/{webinar_id}")
-        resp = requests.delete(f"{self.api_base_url}/webinars/{webinar_id}",
-                               headers=headers)
+        resp = self.request("DELETE", f"{self.api_base_url}/webinars/{webinar_id}",
+                            headers=headers)
 
-        if resp.status_code!=204:
-            print("Unable to delete webinar")
-            print(f"{resp}")
+        self.check_response(resp, 204)
 
         return
 
@@ -169,8 +329,8 @@ class ZoomInterface:
             name -- string. Full name of the panelist
         '''
 
-        response = requests.post(
-            f'{self.api_base_url}/webinars/{webinar_id}/panelists',
+        response = self.request(
+            "POST", f'{self.api_base_url}/webinars/{webinar_id}/panelists', "medium",
             json={'panelists': [{
                 'email': email,
                 'name': name
@@ -178,7 +338,7 @@ class ZoomInterface:
             headers=self.get_authorization_header(),
         )
 
-        assert response.status_code == 201, response.json()['message']
+        self.check_response(response, 201)
 
 
     def get_panelists(self, webinar_id):
@@ -193,15 +353,13 @@ class ZoomInterface:
         Returns: a list of dictionaries with fields 'name' and 'email'
         '''
 
-        response = requests.get(
-            f'{self.api_base_url}/webinars/{webinar_id}/panelists',
+        response = self.request(
+            "GET", f'{self.api_base_url}/webinars/{webinar_id}/panelists', "medium",
             headers=self.get_authorization_header(),
         )
-        response_data = response.json()
-
-        assert response.status_code == 200, response_data['message']
+        self.check_response(response, 200)
 
-        return response_data['panelists']
+        return response.json()['panelists']
 
 
     def get_webinar(self, webinar_id):
@@ -216,14 +374,12 @@ class ZoomInterface:
         Returns: a dictionary with the information of one webinar
         '''
 
-        response = requests.get(
-            f'{self.api_base_url}/webinars/{webinar_id}',
+        response = self.request(
+            "GET", f'{self.api_base_url}/webinars/{webinar_id}',
             headers=self.get_authorization_header())
-        response_data = response.json()
+        self.check_response(response, 200)
 
-        assert response.status_code == 200, response_data['message']
-
-        return response_data
+        return response.json()
 
 
     def get_webinars(self, date = None, ids = None):
@@ -247,9 +403,9 @@ class ZoomInterface:
         next_page_token = 'The first query is done without a real token'
 
         while next_page_token:
-            response = requests.get(url, params=payload, headers=headers)
+            response = self.request("GET", url, "medium", params=payload, headers=headers)
+            self.check_response(response, 200)
             response_data = response.json()
-            assert response.status_code == 200, response_data['message']
 
             all_webinars += response_data.get('webinars', [])
             next_page_token = response_data.get('next_page_token', None)
@@ -274,13 +430,13 @@ class ZoomInterface:
             webinar_id -- int or string. To specify the webinar by ID.
             params -- dictionary. Contains parameters to send.
         '''
-        response = requests.patch(
-            f'{self.api_base_url}/webinars/{webinar_id}',
+        response = self.request(
+            "PATCH", f'{self.api_base_url}/webinars/{webinar_id}',
             json=params,
             headers=self.get_authorization_header(),
         )
 
-        assert response.status_code == 204, response.content
+        self.check_response(response, 204)
         pass
 
 
@@ -293,10 +449,11 @@ class ZoomInterface:
         if next_page_token:
             payload['next_page_token'] = next_page_token
 
-        resp = requests.get(f"{self.api_base_url}/report/webinars/{webinarId}/participants",
-                             headers=headers,
-                             params=payload)
+        resp = self.request("GET", f"{self.api_base_url}/report/webinars/{webinarId}/participants", "heavy",
+                            headers=headers,
+                            params=payload)
 
+        self.check_response(resp, 200)
         response = resp.json()
         all_participants = response.get('participants', None)
         # get next pages if there is any
@@ -332,7 +489,8 @@ def main():
         client_id = zoom_cfg['client_id'],
         client_secret = zoom_cfg['client_secret'],
         timezone = config['global']['timezone'],
-        user = zoom_cfg['user'])
+        user = zoom_cfg['user'],
+        secrets_dir = os.environ.get('CQORC_SECRETS_DIR', DefaultArgs.secrets_dir))
 
     # Create one meeting
     '''
@@ -2,8 +2,8 @@
 import os, argparse, itertools
 from datetime import datetime, timedelta, date
 import pytz
-import requests
 import configparser
+from interfaces.shared.HttpSession import get_session
 
 
 parser = argparse.ArgumentParser()
@@ -43,7 +43,7 @@ params = {
     'alt': 'json',
 }
 
-response = requests.get(
+response = get_session().get(
     f'https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events',
     params=params,
 )
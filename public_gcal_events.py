@@ -7,12 +7,14 @@ import yaml
 import CQORCcalendar
 import re
 
-from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, get_title
+from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, valid_window, get_consumer_name
 from common import actualize_repo
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--date", metavar=ISO_8061_FORMAT, type=valid_date, help="Generate for the first event on this date")
 parser.add_argument("--course_id", help="Generate events for the course specified by the course_id")
+parser.add_argument("--window", metavar="START:END", type=valid_window, help="Only load the courses within this window around now, i.e. -30d:+120d")
+parser.add_argument("--changed-only", default=False, action='store_true', help="Only handle the courses added or modified since the last run with the same actions")
 parser.add_argument("--config_dir", default=".", help="Directory that holds the configuration files")
 parser.add_argument("--secrets_dir", default="./secrets", help="Directory that holds the configuration files")
 parser.add_argument("--all", default=False, action='store_true', help="Act for all events")
@@ -29,10 +31,10 @@ secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
 credentials_file = config['google']['credentials_file']
 credentials_file_path = os.path.join(secrets_dir, credentials_file)
 timezone = config['google.calendar'].get('timezone', config['global']['timezone'])
-gcal = GCalInterface.GCalInterface(credentials_file_path, config['google.calendar']['public_calendar_id'], timezone)
+gcal = GCalInterface.GCalInterface(credentials_file_path, config['google.calendar']['public_calendar_id'], timezone, secrets_dir=secrets_dir)
 
 # initialize EventBrite interface:
-eb = Eventbrite.EventbriteInterface(config['eventbrite']['api_key'])
+eb = Eventbrite.EventbriteInterface(config['eventbrite']['api_key'], secrets_dir)
 
 def get_eb_event_by_date(query_date):
     # retrieve event from EventBrite
@@ -50,63 +52,72 @@ sessions = calendar.get_all_sessions()
 
 # keep only sessions on the date listed
 if args.date:
-    sessions = [session for session in sessions if args.date.date().isoformat() in session['start_date']]
+    sessions = calendar.sessions_on(args.date.date())
 # keep only sessions for the given course_id
 if args.course_id:
     sessions = [session for session in sessions if args.course_id == session['course_id']]
+# keep only the sessions of the courses modified since the last run
+consumer = get_consumer_name('public_gcal', args)
+if args.changed_only:
+    changed_courses = calendar.changed_courses(consumer, {session.course for session in sessions})
+    sessions = [session for session in sessions if session.course in changed_courses]
 
 send_updates = "none"
 
 # ensure descriptions are up to date
 actualize_repo(config["descriptions"]["repo_url"], config["descriptions"]["local_repo"])
 
-for session in sessions:
-    try:
-        if len(session['code']):
-            # Read the description from the repo
-            with open(os.path.join(config["descriptions"]["local_repo"], f"{session['code']}-{session['language']}.yaml")) as f:
-                event_description = yaml.safe_load(f)
-        else:
-            event_description = None
-            print("Empty workshop code, skipping updating description")
-
-        start_time = to_iso8061(session['start_date'])
-        end_time = to_iso8061(session['end_date'])
-
-        if session['eventbrite_id']:
-            eb_event = eb.get_event(session['eventbrite_id'])
-        else:
-            eb_event = get_eb_event_by_date(start_time.date())
-        eb_event_id = None
-        if eb_event:
-            eb_event_id = eb_event['id']
-
-        registration_url = eval('f' + repr(config['eventbrite']['registration_url']))
-        registration_url = f"""<a href="{registration_url}">{registration_url}</a>"""
-
-        attendees = None
-        if event_description:
-            title = get_title(session)
-            summary = f"""{event_description['summary']}
+failed_sessions = set()
+# the events are created, updated and deleted together after the loop, in a few batch requests
+creations, updates, deletions = [], [], []
+with calendar.transaction():
+    for session in sessions:
+        try:
+            if len(session['code']):
+                # Read the description from the repo
+                with open(os.path.join(config["descriptions"]["local_repo"], f"{session['code']}-{session['language']}.yaml")) as f:
+                    event_description = yaml.safe_load(f)
+            else:
+                event_description = None
+                print("Empty workshop code, skipping updating description")
+
+            start_time = session.start
+            end_time = session.end
+
+            if session['eventbrite_id']:
+                eb_event = eb.get_event(session['eventbrite_id'])
+            else:
+                eb_event = get_eb_event_by_date(start_time.date())
+            eb_event_id = None
+            if eb_event:
+                eb_event_id = eb_event['id']
+
+            registration_url = eval('f' + repr(config['eventbrite']['registration_url']))
+            registration_url = f"""<a href="{registration_url}">{registration_url}</a>"""
+
+            attendees = None
+            if event_description:
+                title = session.title
+                summary = f"""{event_description['summary']}
 
 {event_description['description']}"""
-            if isinstance(event_description['plan'], list) and isinstance(event_description['plan'][0], str):
-                plan = "\n* ".join([''] + event_description['plan'])
-            elif isinstance(event_description['plan'], list) and isinstance(event_description['plan'][0], list):
-                # we flatten the 2d list
-                plan = "\n* ".join([''] + list(itertools.chain.from_iterable(event_description['plan'])))
-        else:
-            title = get_title(session)
-            plan = "-"
-            summary = "-"
-
-        # take the EventBrite title in priority
-        if eb_event:
-            title = eb_event['name']['text']
-
-        if session['language'] == "fr":
-            presence = "en ligne" if session['site'] in ("online", "en ligne") else "onsite"
-            description = f"""Inscriptions: {registration_url}
+                if isinstance(event_description['plan'], list) and isinstance(event_description['plan'][0], str):
+                    plan = "\n* ".join([''] + event_description['plan'])
+                elif isinstance(event_description['plan'], list) and isinstance(event_description['plan'][0], list):
+                    # we flatten the 2d list
+                    plan = "\n* ".join([''] + list(itertools.chain.from_iterable(event_description['plan'])))
+            else:
+                title = session.title
+                plan = "-"
+                summary = "-"
+
+            # take the EventBrite title in priority
+            if eb_event:
+                title = eb_event['name']['text']
+
+            if session['language'] == "fr":
+                presence = "en ligne" if session['site'] in ("online", "en ligne") else "onsite"
+                description = f"""Inscriptions: {registration_url}
 
 {summary}
 
@@ -120,9 +131,9 @@ Language: french
 Registration URL: {registration_url}
 
 """
-        else:
-            presence = "online" if session['site'] in ("online", "en ligne") else "onsite"
-            description = f"""Registration: {registration_url}
+            else:
+                presence = "online" if session['site'] in ("online", "en ligne") else "onsite"
+                description = f"""Registration: {registration_url}
 
 {summary}
 
@@ -136,60 +147,92 @@ Language: english
 Registration URL: {registration_url}
 
 """
-        if args.create:
-            if args.dry_run:
-                cmd = f"gcal.create_event({start_time.isoformat()}, {end_time.isoformat()}, {title}, {description}, {attendees}, send_updates={send_updates})"
-                print(f"Dry-run: would run {cmd}")
-            elif session['public_gcal_id']:
-                event_id = session['public_gcal_id']
-                print(f"Calendar ID found: {session['public_gcal_id']}, not creating a new event")
-            else:
-                event = gcal.create_event(start_time.isoformat(), end_time.isoformat(), title, description, attendees, send_updates=send_updates)
+            if args.create:
+                if args.dry_run:
+                    cmd = f"gcal.create_event({start_time.isoformat()}, {end_time.isoformat()}, {title}, {description}, {attendees}, send_updates={send_updates})"
+                    print(f"Dry-run: would run {cmd}")
+                elif session['public_gcal_id']:
+                    event_id = session['public_gcal_id']
+                    print(f"Calendar ID found: {session['public_gcal_id']}, not creating a new event")
+                else:
+                    creations.append((session, title, {'start_time': start_time.isoformat(), 'end_time': end_time.isoformat(),
+                                                       'summary': title, 'description': description, 'attendees': attendees}))
+
+            elif args.update:
+                if session['public_gcal_id']:
+                    event_id = session['public_gcal_id']
+                else:
+                    existing_events = gcal.get_events_by_date(start_time)
+                    if len(existing_events) != 1:
+                        print(f"{len(existing_events)} existing events found on {start_time.date()} instead of 1, session {session['course_id']} skipped")
+                        failed_sessions.add(session)
+                        continue
+                    event_id = existing_events[0]['id']
+
+                if args.dry_run:
+                    cmd = f"gcal.update_event({event_id}, {start_time.isoformat()}, {end_time.isoformat()}, {title}, {description}, {attendees}, send_updates={send_updates})"
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    updates.append((session, title, {'event_id': event_id, 'start_time': start_time.isoformat(), 'end_time': end_time.isoformat(),
+                                                     'summary': title, 'description': description, 'attendees': attendees}))
+        
+            elif args.delete:
+                if session['public_gcal_id']:
+                    event_id = session['public_gcal_id']
+                else:
+                    existing_events = gcal.get_events_by_date(start_time)
+                    if len(existing_events) != 1:
+                        print(f"{len(existing_events)} existing events found on {start_time.date()} instead of 1, session {session['course_id']} skipped")
+                        failed_sessions.add(session)
+                        continue
+
+                    event_id = existing_events[0]['id']
+
+                if args.dry_run:
+                    print(f"Dry-run: would delete event {event_id} ({title}), send_updates={send_updates}")
+                else:
+                    deletions.append((session, title, event_id))
+        except Exception as e:
+            print(f"Error encountered when processing session {session}: {e}")
+            failed_sessions.add(session)
+
+    try:
+        if creations:
+            events = gcal.create_events([event for session, title, event in creations], send_updates=send_updates)
+            for (session, title, _), event in zip(creations, events):
+                if isinstance(event, Exception):
+                    print(f"Error encountered when creating event {title} for session {session}: {event}")
+                    failed_sessions.add(session)
+                    continue
                 print(f'Successfully created event {event["id"]} for {title}')
                 calendar.set_gcal_id(session['course_id'], session['start_date'], event['id'], "public_gcal_id")
-                calendar.update_spreadsheet()
                 print(f"Google spreadsheet created a google calendar id for session {session['course_id']} - {title}")
 
-        elif args.update:
-            if session['public_gcal_id']:
-                event_id = session['public_gcal_id']
-            else:
-                existing_events = gcal.get_events_by_date(start_time)
-                if len(existing_events) != 1:
-                    print("Number of existing events found different than 1. Case not handled. Exiting")
-                    exit(1)
-                event_id = existing_events[0]['id']
-
-            if args.dry_run:
-                cmd = f"gcal.update_event({event_id}, {start_time.isoformat()}, {end_time.isoformat()}, {title}, {description}, {attendees}, send_updates={send_updates})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                gcal.update_event(event_id, start_time.isoformat(), end_time.isoformat(), title, description, attendees, send_updates=send_updates)
-                print(f"Successfully updated event {event_id} for {title}")
-        
-        elif args.delete:
-            if session['public_gcal_id']:
-                event_id = session['public_gcal_id']
-            else:
-                existing_events = gcal.get_events_by_date(start_time)
-                if len(existing_events) != 1:
-                    print("Number of existing events found different than 1. Case not handled. Exiting")
-                    exit(1)
-
-                event_id = existing_events[0]['id']
-
-            if args.dry_run:
-                print(f"Dry-run: would delete event {event_id} ({title}), send_updates={send_updates}")
-            else:
-                gcal.delete_event(event_id, send_updates=send_updates)
+        if updates:
+            events = gcal.update_events([event for session, title, event in updates], send_updates=send_updates)
+            for (session, title, event), result in zip(updates, events):
+                if isinstance(result, Exception):
+                    print(f"Error encountered when updating event {event['event_id']} for session {session}: {result}")
+                    failed_sessions.add(session)
+                    continue
+                print(f"Successfully updated event {event['event_id']} for {title}")
+
+        if deletions:
+            results = gcal.delete_events([event_id for session, title, event_id in deletions], send_updates=send_updates)
+            for (session, title, event_id), error in zip(deletions, results):
+                if error:
+                    print(f"Error encountered when deleting event {event_id} for session {session}: {error}")
+                    failed_sessions.add(session)
+                    continue
                 print(f"Successfully deleted event {event_id} for {title}")
                 calendar.set_gcal_id(session['course_id'], session['start_date'], '', "public_gcal_id")
-                calendar.update_spreadsheet()
                 print(f"Google spreadsheet deleted google calendar id for session {session['course_id']} - {title}")
-    except Exception as e:
-        print(f"Error encountered when processing session {session}: {e}")
 
+    except Exception as e:
+        print(f"Error encountered when sending the calendar events: {e}")
+        failed_sessions.update(session for session, _, _ in creations + updates + deletions)
 
+# the courses are processed only if all their selected sessions (i.e. those of --date) were processed
 if not args.dry_run:
-    calendar.update_spreadsheet()
-
+    calendar.save_state(consumer, [course for course in {session.course for session in sessions}
+                                   if not failed_sessions.intersection(course['sessions'])])
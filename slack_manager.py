@@ -5,13 +5,14 @@ import interfaces.zoom.ZoomInterface as ZoomInterface
 import interfaces.slack.SlackInterface as SlackInterface
 import CQORCcalendar
 
-from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, get_title
+from common import valid_date, ISO_8061_FORMAT, get_config, valid_window, get_consumer_name
 from common import get_survey_link
-from common import get_trainer_keys
 from common import Trainers
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--course_id", default=None, help="Manage only for this course id")
+parser.add_argument("--window", metavar="START:END", type=valid_window, help="Only load the courses within this window around now, i.e. -30d:+120d")
+parser.add_argument("--changed-only", default=False, action='store_true', help="Only handle the courses added or modified since the last run with the same actions")
 parser.add_argument("--config_dir", default=".", help="Directory that holds the configuration files")
 parser.add_argument("--secrets_dir", default="./secrets", help="Directory that holds the configuration files")
 parser.add_argument("--create", default=False, action='store_true', help="Create channel")
@@ -35,7 +36,7 @@ credentials_file_path = os.path.join(secrets_dir, credentials_file)
 timezone = config['google.calendar'].get('timezone', config['global']['timezone'])
 slack = SlackInterface.SlackInterface(config['slack']['bot_token'])
 zoom_user = config['zoom']['user']
-zoom = ZoomInterface.ZoomInterface(config['zoom']['account_id'], config['zoom']['client_id'], config['zoom']['client_secret'], config['global']['timezone'], zoom_user)
+zoom = ZoomInterface.ZoomInterface(config['zoom']['account_id'], config['zoom']['client_id'], config['zoom']['client_secret'], config['global']['timezone'], zoom_user, secrets_dir=secrets_dir)
 
 
 # get the events from the working calendar in the Google spreadsheets
@@ -59,173 +60,178 @@ if args.course_id:
         exit(1)
 else:
     courses = calendar.get_courses()
+# keep only the courses modified since the last run
+consumer = get_consumer_name('slack', args)
+if args.changed_only:
+    courses = calendar.changed_courses(consumer, courses)
+
+failed_courses = []
+with calendar.transaction():
+    for course in courses:
+        try:
+            first_session = course['sessions'][0]
+
+            # no course code, continue
+            if not 'code' in first_session:
+                continue
+
+            date = first_session.start.date()
+            course_code = first_session['code']
+            locale = first_session['language']
+            title = first_session.title
+            site = first_session['site'].replace('.', '').replace(' ', '')
+
+            survey_link = get_survey_link(config, locale, title, date)
+
+            post_mortem_link = config['slack']['post_mortem_link']
+            eb_course_link = config['slack']['eb_course_link']
+
+            # if is documented, use that, otherwise create it
+            slack_channel_name = first_session['slack_channel']
+            if not slack_channel_name:
+                slack_channel_name = eval('f' + repr(config['global']['slack_channel_template']))
+                slack_channel_name = slack_channel_name.lower()
+
+            if args.create:
+                if args.dry_run:
+                    cmd = f"slack.create_channel({slack_channel_name})"
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    slack.create_channel(slack_channel_name)
+                    calendar.set_slack_channel(first_session['course_id'], slack_channel_name)
+                    print(f"Channel {slack_channel_name} created for course {course['course_id']}")
+
+            if args.invites:
+                attendees = [trainers.slack_email(key) for key in course.trainer_keys(['instructor', 'host', 'assistants', 'equipe_techno'])]
+                if args.additional_slack_invite:
+                    additional_email = args.additional_slack_invite.lower()
+                    if additional_email not in attendees:
+                        attendees.append(additional_email)
+                if args.dry_run:
+                    cmd = f"slack.invite_to_channel({slack_channel_name}, {attendees})"
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    slack.invite_to_channel(slack_channel_name, attendees)
+                    print(f"Invited {attendees} to channel {slack_channel_name}")
 
-for course in courses:
-    try:
-        first_session = course['sessions'][0]
-
-        # no course code, continue
-        if not 'code' in first_session:
-            continue
-
-        date = to_iso8061(first_session['start_date']).date()
-        course_code = first_session['code']
-        locale = first_session['language']
-        title = get_title(first_session)
-        site = first_session['site'].replace('.', '').replace(' ', '')
-
-        survey_link = get_survey_link(config, locale, title, date)
-
-        post_mortem_link = config['slack']['post_mortem_link']
-        eb_course_link = config['slack']['eb_course_link']
-
-        # if is documented, use that, otherwise create it
-        slack_channel_name = first_session['slack_channel']
-        if not slack_channel_name:
-            slack_channel_name = eval('f' + repr(config['global']['slack_channel_template']))
-            slack_channel_name = slack_channel_name.lower()
-
-        if args.create:
-            if args.dry_run:
-                cmd = f"slack.create_channel({slack_channel_name})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                slack.create_channel(slack_channel_name)
-                calendar.set_slack_channel(first_session['course_id'], slack_channel_name)
-                print(f"Channel {slack_channel_name} created for course {course['course_id']}")
-
-        if args.invites:
-            attendees = [trainers.slack_email(key) for key in get_trainer_keys(course, ['instructor', 'host', 'assistants', 'equipe_techno'])]
-            if args.additional_slack_invite:
-                additional_email = args.additional_slack_invite.lower()
-                if additional_email not in attendees:
-                    attendees.append(additional_email)
-            if args.dry_run:
-                cmd = f"slack.invite_to_channel({slack_channel_name}, {attendees})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                slack.invite_to_channel(slack_channel_name, attendees)
-                print(f"Invited {attendees} to channel {slack_channel_name}")
-
-        if args.bookmarks:
-            if first_session['zoom_id']:
-                webinar = zoom.get_webinar(webinar_id = first_session['zoom_id'])
-            else:
-                start_time = to_iso8061(first_session['start_date'])
-                webinar = zoom.get_webinars(date = start_time.date())
+            if args.bookmarks:
+                if first_session['zoom_id']:
+                    webinar = zoom.get_webinar(webinar_id = first_session['zoom_id'])
+                else:
+                    start_time = first_session.start
+                    webinar = zoom.get_webinars(date = start_time.date())
+                    if webinar:
+                        webinar = zoom.get_webinar(webinar_id = webinar[0]['id'])
+
+                bookmarks = [
+                    {'title': 'Magic Castle', 'link': f'https://{course_code.lower()}.calculquebec.cloud'}
+                    ]
                 if webinar:
-                    webinar = zoom.get_webinar(webinar_id = webinar[0]['id'])
-
-            bookmarks = [
-                {'title': 'Magic Castle', 'link': f'https://{course_code.lower()}.calculquebec.cloud'}
-                ]
-            if webinar:
-                bookmarks += [{'title': 'Zoom URL Participants', 'link': webinar['join_url']}]
-            if survey_link:
-                bookmarks += [{'title': 'Survey', 'link': survey_link}]
-            if post_mortem_link:
-                bookmarks += [{'title': 'Post Mortem des formations', 'link': post_mortem_link}]
-            if eb_course_link:
-                bookmarks += [{'title': 'Liens à partager vers nos prochaines formations', 'link': eb_course_link}]
-            if args.dry_run:
-                cmd = f"slack.update_channel_bookmarks({slack_channel_name}, {bookmarks})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                slack.update_channel_bookmarks(slack_channel_name, bookmarks)
-                print(f"Updated bookmarks for channel {slack_channel_name}")
-
-        if args.archive:
-            if args.dry_run:
-                cmd = f"slack.archive_channel({slack_channel_name})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                slack.archive_channel(slack_channel_name)
-                print(f"Archived channel {slack_channel_name}")
-
-        if args.wipe_messages:
-            if args.dry_run:
-                cmd = f"slack.wipe_channel_scheduled_messages({slack_channel_name})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                slack.wipe_channel_scheduled_messages(slack_channel_name)
-                print(f"Wiped scheduled messages for channel {slack_channel_name}")
-
-        if args.list_messages:
-            if args.dry_run:
-                cmd = f"slack.list_channel_scheduled_messages({slack_channel_name})"
-                print(f"Dry-run: would run {cmd}")
-            else:
-                print(f"{slack.list_channel_scheduled_messages(slack_channel_name)}")
-
-        if args.messages:
-            magic_castle_link = slack.get_channel_bookmark_link(slack_channel_name, "Magic Castle")
-            zoom_user_link = slack.get_channel_bookmark_link(slack_channel_name, "Zoom URL Participants")
-            survey_link = slack.get_channel_bookmark_link(slack_channel_name, "Survey")
-            message_prefixes = []
-            for key in config['slack']:
-                key_parts = key.split('_')
-                if len(key_parts) == 3 and key_parts[0] == "message" and key_parts[2] == "template":
-                    message_prefixes += ['_'.join(key_parts[0:2])]
-
-            messages = []
-            equipe_techno_email = [trainers.slack_email(key.split()[0]) for key in get_trainer_keys(course, ['equipe_techno'])]
-            analysts_tagged = ""
-
-            if equipe_techno_email:
-                equipe_techno_id_list = []
-        
-                for email in equipe_techno_email:
-                    equipe_techno_id = ''.join(slack.get_user_id(email, next_cursor=None))
-                    equipe_techno_id_list.append(equipe_techno_id)
-
-                analysts_tagged = format_tag(equipe_techno_id_list)
-
-            for prefix in message_prefixes:
-                if not equipe_techno_email and prefix in {
-                    "message_creationoui",    
-                    "message_creationnon",    
-                    "message_destructionoui",    
-                    "message_destructionnon",
-                    "message_debut",
-                    "message_jouravant"
-                }:
-                    continue
-                # Evalutate text message
-                text = eval('f' + repr(config['slack'][f'{prefix}_template']))
-
-                for session in course['sessions']:
-                    # Evaluate the condition
-                    if f'{prefix}_condition' in config['slack']:
-                        if not eval(config['slack'][f'{prefix}_condition']):
-                            continue
-
-                    start_time = to_iso8061(session['start_date'])
-                    end_time = to_iso8061(session['end_date'])
-
-                    if start_time == to_iso8061(first_session['start_date']) or config['slack'][f'{prefix}_multidays'] == "True":
-                        time = start_time
-                        # Applying offsets
-                        if f'{prefix}_offset_start' in config['slack']:
-                            time = start_time + datetime.timedelta(minutes=int(config['slack'][f'{prefix}_offset_start']))
-                        elif f'{prefix}_offset_end' in config['slack']:
-                            time = end_time + datetime.timedelta(minutes=int(config['slack'][f'{prefix}_offset_end']))
-                        elif f'{prefix}_offset_now' in config['slack']:
-                            time = datetime.datetime.now() + datetime.timedelta(minutes=int(config['slack'][f'{prefix}_offset_now']))
-
-                        messages += [{'time': time, 'message': text}]
-
-            for message in messages:
+                    bookmarks += [{'title': 'Zoom URL Participants', 'link': webinar['join_url']}]
+                if survey_link:
+                    bookmarks += [{'title': 'Survey', 'link': survey_link}]
+                if post_mortem_link:
+                    bookmarks += [{'title': 'Post Mortem des formations', 'link': post_mortem_link}]
+                if eb_course_link:
+                    bookmarks += [{'title': 'Liens à partager vers nos prochaines formations', 'link': eb_course_link}]
+                if args.dry_run:
+                    cmd = f"slack.update_channel_bookmarks({slack_channel_name}, {bookmarks})"
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    slack.update_channel_bookmarks(slack_channel_name, bookmarks)
+                    print(f"Updated bookmarks for channel {slack_channel_name}")
+
+            if args.archive:
                 if args.dry_run:
-                    cmd = f"slack.post_to_channel({slack_channel_name}, {message['message']}, {message['time']})"
+                    cmd = f"slack.archive_channel({slack_channel_name})"
                     print(f"Dry-run: would run {cmd}")
                 else:
-                    slack.post_to_channel(slack_channel_name, message['message'], message['time'])
-                    print(f"Scheduled message for channel {slack_channel_name} at {message['time']}: {message['message']}")
+                    slack.archive_channel(slack_channel_name)
+                    print(f"Archived channel {slack_channel_name}")
 
-    except Exception as e:
-        print(f"Error encountered when processing course {course}: \n\n{e}")
+            if args.wipe_messages:
+                if args.dry_run:
+                    cmd = f"slack.wipe_channel_scheduled_messages({slack_channel_name})"
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    slack.wipe_channel_scheduled_messages(slack_channel_name)
+                    print(f"Wiped scheduled messages for channel {slack_channel_name}")
 
+            if args.list_messages:
+                if args.dry_run:
+                    cmd = f"slack.list_channel_scheduled_messages({slack_channel_name})"
+                    print(f"Dry-run: would run {cmd}")
+                else:
+                    print(f"{slack.list_channel_scheduled_messages(slack_channel_name)}")
+
+            if args.messages:
+                magic_castle_link = slack.get_channel_bookmark_link(slack_channel_name, "Magic Castle")
+                zoom_user_link = slack.get_channel_bookmark_link(slack_channel_name, "Zoom URL Participants")
+                survey_link = slack.get_channel_bookmark_link(slack_channel_name, "Survey")
+                message_prefixes = []
+                for key in config['slack']:
+                    key_parts = key.split('_')
+                    if len(key_parts) == 3 and key_parts[0] == "message" and key_parts[2] == "template":
+                        message_prefixes += ['_'.join(key_parts[0:2])]
+
+                messages = []
+                equipe_techno_email = [trainers.slack_email(key.split()[0]) for key in course.trainer_keys(['equipe_techno'])]
+                analysts_tagged = ""
+
+                if equipe_techno_email:
+                    equipe_techno_id_list = []
+        
+                    for email in equipe_techno_email:
+                        equipe_techno_id = ''.join(slack.get_user_id(email, next_cursor=None))
+                        equipe_techno_id_list.append(equipe_techno_id)
+
+                    analysts_tagged = format_tag(equipe_techno_id_list)
+
+                for prefix in message_prefixes:
+                    if not equipe_techno_email and prefix in {
+                        "message_creationoui",    
+                        "message_creationnon",    
+                        "message_destructionoui",    
+                        "message_destructionnon",
+                        "message_debut",
+                        "message_jouravant"
+                    }:
+                        continue
+                    # Evalutate text message
+                    text = eval('f' + repr(config['slack'][f'{prefix}_template']))
+
+                    for session in course['sessions']:
+                        # Evaluate the condition
+                        if f'{prefix}_condition' in config['slack']:
+                            if not eval(config['slack'][f'{prefix}_condition']):
+                                continue
+
+                        start_time = session.start
+                        end_time = session.end
+
+                        if start_time == first_session.start or config['slack'][f'{prefix}_multidays'] == "True":
+                            time = start_time
+                            # Applying offsets
+                            if f'{prefix}_offset_start' in config['slack']:
+                                time = start_time + datetime.timedelta(minutes=int(config['slack'][f'{prefix}_offset_start']))
+                            elif f'{prefix}_offset_end' in config['slack']:
+                                time = end_time + datetime.timedelta(minutes=int(config['slack'][f'{prefix}_offset_end']))
+                            elif f'{prefix}_offset_now' in config['slack']:
+                                time = datetime.datetime.now() + datetime.timedelta(minutes=int(config['slack'][f'{prefix}_offset_now']))
+
+                            messages += [{'time': time, 'message': text}]
+
+                for message in messages:
+                    if args.dry_run:
+                        cmd = f"slack.post_to_channel({slack_channel_name}, {message['message']}, {message['time']})"
+                        print(f"Dry-run: would run {cmd}")
+                    else:
+                        slack.post_to_channel(slack_channel_name, message['message'], message['time'])
+                        print(f"Scheduled message for channel {slack_channel_name} at {message['time']}: {message['message']}")
+
+        except Exception as e:
+            print(f"Error encountered when processing course {course}: \n\n{e}")
+            failed_courses.append(course)
 
 if not args.dry_run:
-    calendar.update_spreadsheet()
-
+    calendar.save_state(consumer, [course for course in courses if course not in failed_courses])
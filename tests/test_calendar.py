@@ -0,0 +1,57 @@
+from CQORCcalendar import Calendar, column_letter, get_runs
+
+
+def make_calendar(headers, dirty_cells):
+    # only the state used to build the ranges, without reading the spreadsheet
+    calendar = Calendar.__new__(Calendar)
+    calendar.headers = headers
+    calendar.dirty_cells = dirty_cells
+    return calendar
+
+
+def test_column_letter():
+    assert column_letter(0) == 'A'
+    assert column_letter(25) == 'Z'
+    assert column_letter(26) == 'AA'
+    assert column_letter(51) == 'AZ'
+    assert column_letter(52) == 'BA'
+    assert column_letter(701) == 'ZZ'
+    assert column_letter(702) == 'AAA'
+
+
+def test_get_runs():
+    assert get_runs([]) == []
+    assert get_runs([5]) == [(5, 5)]
+    assert get_runs([2, 3, 4, 7]) == [(2, 4), (7, 7)]
+    assert get_runs([1, 3, 4, 6]) == [(1, 1), (3, 4), (6, 6)]
+
+
+def test_get_dirty_ranges_coalesces_contiguous_rows():
+    calendar = make_calendar(
+        {'2025': ['course_id', 'start_date', 'zoom_id', 'slack_channel']},
+        {('2025', 4, 'zoom_id'): '3', ('2025', 2, 'zoom_id'): '1', ('2025', 3, 'zoom_id'): '2', ('2025', 7, 'zoom_id'): '4'})
+
+    assert sorted(calendar.get_dirty_ranges(), key=lambda r: r['range']) == [
+        {'range': "'2025'!C2:C4", 'values': [['1'], ['2'], ['3']]},
+        {'range': "'2025'!C7:C7", 'values': [['4']]},
+    ]
+
+
+def test_get_dirty_ranges_separates_columns_and_sheets():
+    calendar = make_calendar(
+        {'2025': ['course_id', 'zoom_id', 'slack_channel'], 'Archive': ['slack_channel', 'course_id', 'zoom_id']},
+        {('2025', 2, 'zoom_id'): 'z2', ('2025', 3, 'slack_channel'): 's3', ('2025', 3, 'zoom_id'): 'z3',
+         ('Archive', 3, 'zoom_id'): 'a3', ('Archive', 4, 'zoom_id'): 'a4'})
+
+    assert sorted(calendar.get_dirty_ranges(), key=lambda r: r['range']) == [
+        {'range': "'2025'!B2:B3", 'values': [['z2'], ['z3']]},
+        {'range': "'2025'!C3:C3", 'values': [['s3']]},
+        {'range': "'Archive'!C3:C4", 'values': [['a3'], ['a4']]},
+    ]
+
+
+def test_get_dirty_ranges_of_given_cells():
+    calendar = make_calendar({'2025': ['course_id', 'zoom_id']}, {('2025', 2, 'zoom_id'): 'dirty'})
+
+    assert calendar.get_dirty_ranges({('2025', 5, 'course_id'): 'X'}) == [{'range': "'2025'!A5:A5", 'values': [['X']]}]
+    assert calendar.get_dirty_ranges({}) == []
@@ -0,0 +1,23 @@
+import argparse
+from datetime import timedelta
+
+import pytest
+
+from common import valid_window
+
+
+def test_valid_window():
+    assert valid_window('-30d:+120d') == (timedelta(days=-30), timedelta(days=120))
+    assert valid_window('-12h:0h') == (timedelta(hours=-12), timedelta(0))
+    assert valid_window('1w:2w') == (timedelta(weeks=1), timedelta(weeks=2))
+
+
+@pytest.mark.parametrize('window', ['', '-30d', '-30d:+120d:+1w', '-30x:+120d', 'd:+120d', '-30d:', '-3.5d:+1d'])
+def test_valid_window_invalid_value(window):
+    with pytest.raises(argparse.ArgumentTypeError):
+        valid_window(window)
+
+
+def test_valid_window_start_after_end():
+    with pytest.raises(argparse.ArgumentTypeError):
+        valid_window('+2w:-1d')
@@ -0,0 +1,169 @@
+import json
+import os
+
+import pytest
+import requests
+
+from interfaces.shared import HttpCache as http_cache
+from interfaces.shared.HttpCache import HttpCache
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(http_cache.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HttpCache(str(tmp_path / 'http'))
+
+
+def make_response(status_code, body='', headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.encoding = 'utf-8'
+    response._content = body.encode('utf-8')
+    response.headers.update(headers or {})
+    return response
+
+
+class Server:
+    '''Function sending the GET: records the conditional headers, and returns the next response'''
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.headers = []
+
+    def __call__(self, headers):
+        self.headers += [headers]
+        return self.responses.pop(0)
+
+
+def test_get_ttl(cache):
+    assert cache.get_ttl('zoom', '/v2/webinars/1') == 300
+    assert cache.get_ttl('zoom', '/v2/webinars/1/registrants') == 0
+    assert cache.get_ttl('eventbrite', '/v3/events/1/attendees/') == 0
+    assert cache.get_ttl('eventbrite', '/v3/events/1/structured_content/') == 0
+    assert cache.get_ttl('google.sheets', '/v4/spreadsheets/1') == 0
+
+
+def test_ttl_entry_fresh_until_it_expires(cache, clock):
+    cache.store('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', '{"id": 1}')
+    entry = cache.load('zoom', 'GET /v2/webinars/1')
+
+    assert entry['body'] == '{"id": 1}'
+    assert cache.is_fresh(entry, 'zoom')
+    clock.now += 299
+    assert cache.is_fresh(entry, 'zoom')
+    clock.now += 2
+    assert not cache.is_fresh(entry, 'zoom')
+
+
+def test_entry_without_validators_or_ttl_not_stored(cache, clock):
+    cache.store('zoom', '/v2/webinars/1/registrants', 'GET /v2/webinars/1/registrants', '[]')
+    cache.store('google.sheets', '/v4/spreadsheets/1', 'GET /v4/spreadsheets/1', '{}')
+
+    assert cache.load('zoom', 'GET /v2/webinars/1/registrants') is None
+    assert cache.load('google.sheets', 'GET /v4/spreadsheets/1') is None
+
+
+def test_entry_with_validators_never_fresh(cache, clock):
+    cache.store('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', '{}', etag='"v1"', last_modified='Mon, 01 Sep 2025 00:00:00 GMT')
+    entry = cache.load('zoom', 'GET /v2/webinars/1')
+
+    assert not cache.is_fresh(entry, 'zoom')
+    assert cache.conditional_headers(entry) == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Sep 2025 00:00:00 GMT'}
+    assert cache.conditional_headers(None) == {}
+
+
+def test_send_serves_fresh_entry_without_request(cache, clock):
+    server = Server(make_response(200, '{"id": 1}', {'Content-Type': 'application/json'}))
+
+    first = cache.send('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', server)
+    second = cache.send('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', server)
+
+    assert len(server.headers) == 1
+    assert second.status_code == 200
+    assert second.json() == first.json() == {'id': 1}
+    assert second.headers['Content-Type'] == 'application/json'
+
+
+def test_send_revalidates_with_etag(cache, clock):
+    server = Server(make_response(200, '{"v": 1}', {'ETag': '"v1"'}),
+                    make_response(304),
+                    make_response(200, '{"v": 2}', {'ETag': '"v2"'}))
+
+    assert cache.send('google.sheets', '/v4/spreadsheets/1', 'GET /v4/spreadsheets/1', server).json() == {'v': 1}
+    revalidated = cache.send('google.sheets', '/v4/spreadsheets/1', 'GET /v4/spreadsheets/1', server)
+    modified = cache.send('google.sheets', '/v4/spreadsheets/1', 'GET /v4/spreadsheets/1', server)
+
+    assert server.headers == [{}, {'If-None-Match': '"v1"'}, {'If-None-Match': '"v1"'}]
+    assert revalidated.status_code == 200
+    assert revalidated.json() == {'v': 1}
+    assert modified.json() == {'v': 2}
+    assert cache.load('google.sheets', 'GET /v4/spreadsheets/1')['etag'] == '"v2"'
+
+
+def test_send_does_not_store_errors(cache, clock):
+    server = Server(make_response(500, 'error'), make_response(200, '{}'))
+
+    assert cache.send('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', server).status_code == 500
+    assert cache.send('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', server).status_code == 200
+    assert len(server.headers) == 2
+
+
+def test_invalidate_resource_children_and_parents(cache, clock):
+    for resource in ['/v2/webinars', '/v2/webinars/1', '/v2/webinars/1/panelists', '/v2/webinars/2']:
+        cache.store('zoom', resource, f"GET {resource}", '{}')
+    cache.store('eventbrite', '/v2/webinars/1', 'GET /v2/webinars/1', '{}')
+
+    cache.invalidate('zoom', '/v2/webinars/1')
+
+    assert cache.load('zoom', 'GET /v2/webinars') is None
+    assert cache.load('zoom', 'GET /v2/webinars/1') is None
+    assert cache.load('zoom', 'GET /v2/webinars/1/panelists') is None
+    assert cache.load('zoom', 'GET /v2/webinars/2') is not None
+    assert cache.load('eventbrite', 'GET /v2/webinars/1') is not None
+
+
+def test_invalidate_entries_stored_by_another_instance(cache, clock):
+    cache.store('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', '{}')
+
+    HttpCache(cache.directory).invalidate('zoom', '/v2/webinars/1')
+
+    assert cache.load('zoom', 'GET /v2/webinars/1') is None
+
+
+def test_journal_merged_into_index(cache, clock, monkeypatch):
+    names = [cache.get_name('zoom', f"GET /v2/webinars/{i}") for i in range(5)]
+    cache.store('zoom', '/v2/webinars/0', 'GET /v2/webinars/0', '{}')
+    # one journal line per entry, the index is written once the journal is too large
+    monkeypatch.setattr(HttpCache, 'MAX_JOURNAL_SIZE', 2 * os.path.getsize(cache.journal_path))
+    for i in range(1, 5):
+        cache.store('zoom', f"/v2/webinars/{i}", f"GET /v2/webinars/{i}", '{}')
+
+    with open(cache.index_path) as f:
+        assert set(json.load(f)) == set(names[:3])
+    with open(cache.journal_path) as f:
+        assert [json.loads(line)[0] for line in f] == names[3:]
+    assert set(cache.read_index()) == set(names)
+
+
+def test_expired_entries_removed(cache, clock):
+    cache.store('zoom', '/v2/webinars/1', 'GET /v2/webinars/1', '{}')
+    clock.now += HttpCache.MAX_AGE + 1
+    cache.store('zoom', '/v2/webinars/2', 'GET /v2/webinars/2', '{}')
+
+    cache.invalidate('zoom', '/v2/users')
+
+    assert cache.load('zoom', 'GET /v2/webinars/1') is None
+    assert cache.load('zoom', 'GET /v2/webinars/2') is not None
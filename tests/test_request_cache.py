@@ -0,0 +1,78 @@
+from interfaces.shared.RequestCache import RequestCache, resource_path
+
+
+class Counter:
+    '''Function returning the number of times it was called'''
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.calls
+
+
+def test_resource_path():
+    assert resource_path('https://api.zoom.us/v2/webinars/123?page_size=300') == 'api.zoom.us/v2/webinars/123'
+    assert resource_path('https://sheets.googleapis.com/v4/spreadsheets/ID/values:batchUpdate?alt=json') == \
+        'sheets.googleapis.com/v4/spreadsheets/ID/values'
+    assert resource_path('https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart') == \
+        'www.googleapis.com/drive/v3/files'
+
+
+def test_get_caches_the_result():
+    cache = RequestCache()
+    function = Counter()
+
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function) == 1
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function) == 1
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1?page=2', function) == 2
+
+
+def test_get_does_not_cache_uncacheable_results():
+    cache = RequestCache()
+    function = Counter()
+
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function, cacheable=lambda result: False) == 1
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function, cacheable=lambda result: False) == 2
+
+
+def test_invalidate_resource_children_and_parents():
+    cache = RequestCache()
+    requests = {
+        '/webinars': 'GET /webinars',
+        '/webinars/1': 'GET /webinars/1',
+        '/webinars/1/panelists': 'GET /webinars/1/panelists',
+        '/webinars/2': 'GET /webinars/2',
+    }
+    functions = {resource: Counter() for resource in requests}
+    for resource, request in requests.items():
+        cache.get('zoom', resource, request, functions[resource])
+
+    cache.invalidate('zoom', '/webinars/1')
+    for resource, request in requests.items():
+        cache.get('zoom', resource, request, functions[resource])
+
+    assert functions['/webinars'].calls == 2
+    assert functions['/webinars/1'].calls == 2
+    assert functions['/webinars/1/panelists'].calls == 2
+    assert functions['/webinars/2'].calls == 1
+
+
+def test_invalidate_other_service():
+    cache = RequestCache()
+    function = Counter()
+    cache.get('zoom', '/webinars/1', 'GET /webinars/1', function)
+
+    cache.invalidate('eventbrite', '/webinars/1')
+
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function) == 1
+
+
+def test_disabled():
+    cache = RequestCache()
+    function = Counter()
+    cache.get('zoom', '/webinars/1', 'GET /webinars/1', function)
+
+    with cache.disabled():
+        assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function) == 2
+    assert cache.get('zoom', '/webinars/1', 'GET /webinars/1', function) == 1
@@ -0,0 +1,179 @@
+import pytest
+
+from interfaces.shared import Resilience
+from interfaces.shared.Resilience import CircuitBreaker, CircuitOpenError, InterfaceError
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(Resilience.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(Resilience.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+@pytest.fixture(autouse=True)
+def breakers(monkeypatch):
+    # each test starts with closed circuits
+    monkeypatch.setattr(Resilience, '_breakers', {})
+
+
+def test_circuit_opens_after_threshold(clock):
+    breaker = CircuitBreaker('zoom', failure_threshold=3, reset_timeout=60)
+
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.service == 'zoom'
+    assert error.value.retryable
+
+
+def test_success_resets_failure_count(clock):
+    breaker = CircuitBreaker('zoom', failure_threshold=3, reset_timeout=60)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    breaker.before_call()
+
+
+def test_half_open_success_closes_circuit(clock):
+    breaker = CircuitBreaker('zoom', failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 1
+    # half-open: one call goes through, the others wait for its result
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_half_open_failure_opens_circuit_again(clock):
+    breaker = CircuitBreaker('zoom', failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+
+    clock.now += 60
+    breaker.before_call()
+    clock.now += 5
+    breaker.record_failure()
+
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+
+
+def test_half_open_call_without_outcome_lets_another_through(clock):
+    breaker = CircuitBreaker('zoom', failure_threshold=1, reset_timeout=60)
+    breaker.record_failure()
+
+    clock.now += 60
+    breaker.before_call()
+    clock.now += 60
+    breaker.before_call()
+
+
+def test_backoff_delay(monkeypatch):
+    monkeypatch.setattr(Resilience.random, 'uniform', lambda low, high: high)
+
+    assert [Resilience.backoff_delay(attempt) for attempt in range(7)] == [1, 2, 4, 8, 16, 30, 30]
+
+
+class Calls:
+    '''Function returning, or raising, the next outcome'''
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_call_retries_transient_failures(clock, sleeps):
+    function = Calls(ConnectionError(), 503, 'ok')
+
+    result = Resilience.call('zoom', function, is_transient=lambda outcome: outcome == 503 or Resilience.is_transient_error(outcome))
+
+    assert result == 'ok'
+    assert function.calls == 3
+    assert len(sleeps) == 2
+    Resilience.get_circuit_breaker('zoom').before_call()
+
+
+def test_call_raises_interface_error_after_attempts(clock, sleeps):
+    function = Calls(503, 503, 503)
+
+    with pytest.raises(InterfaceError) as error:
+        Resilience.call('zoom', function, is_transient=lambda outcome: outcome == 503, max_attempts=3,
+                        get_status=lambda failure: failure)
+
+    assert function.calls == 3
+    assert len(sleeps) == 2
+    assert error.value.status == 503
+    assert error.value.retryable
+    assert error.value.response == 503
+
+
+def test_call_does_not_retry_non_idempotent_calls(clock, sleeps):
+    function = Calls(ConnectionError(), 'created twice')
+
+    with pytest.raises(InterfaceError):
+        Resilience.call('zoom', function, is_transient=Resilience.is_transient_error, idempotent=False)
+
+    assert function.calls == 1
+    assert sleeps == []
+
+
+def test_call_raises_other_errors_unchanged(clock, sleeps):
+    function = Calls(KeyError('id'))
+
+    with pytest.raises(KeyError):
+        Resilience.call('zoom', function, is_transient=Resilience.is_transient_error)
+
+    assert function.calls == 1
+
+
+def test_call_fails_fast_when_circuit_is_open(clock, sleeps):
+    function = Calls(*[ConnectionError()] * 5)
+    for _ in range(5):
+        with pytest.raises(InterfaceError):
+            Resilience.call('zoom', function, is_transient=Resilience.is_transient_error, idempotent=False)
+
+    with pytest.raises(CircuitOpenError):
+        Resilience.call('zoom', Calls('ok'), is_transient=Resilience.is_transient_error)
+    clock.now += 60
+    assert Resilience.call('zoom', Calls('ok'), is_transient=Resilience.is_transient_error) == 'ok'
@@ -0,0 +1,109 @@
+#!/bin/env python3
+import os, argparse, json, shlex, subprocess, sys, time
+from datetime import datetime
+
+import interfaces.google.GDriveInterface as GDriveInterface
+from interfaces.shared.FileLock import write_atomically
+from interfaces.shared.Resilience import InterfaceError
+from common import get_config
+
+parser = argparse.ArgumentParser(description="Watch the calendar spreadsheet and run the managers when it is modified.")
+parser.add_argument("--config_dir", default=".", help="Directory that holds the configuration files")
+parser.add_argument("--secrets_dir", default="./secrets", help="Directory that holds the configuration files")
+parser.add_argument("--interval", type=int, help="Seconds between two polls of Google Drive (default: interval in [script.watch], or 30)")
+parser.add_argument("--once", default=False, action='store_true', help="Poll once, run the commands if needed, and exit")
+parser.add_argument("--dry-run", default=False, action='store_true', help="Dry-run: pass --dry-run to the commands")
+args = parser.parse_args()
+
+# read configuration files
+config = get_config(args)
+watch_config = config['script.watch']
+
+secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
+credentials_file = config['google']['credentials_file']
+credentials_file_path = os.path.join(secrets_dir, credentials_file)
+gdrive = GDriveInterface.GDriveInterface(credentials_file_path, secrets_dir=secrets_dir)
+
+calendar_file = config['google']['calendar_file']
+interval = args.interval or watch_config.getint('interval', 30)
+# one command per line, i.e. "zoom_manager.py --create --update"
+commands = [shlex.split(line) for line in watch_config['commands'].splitlines() if line.strip()]
+window = watch_config.get('window')
+
+# the page token is saved once the commands ran, so that the changes are not lost if the watcher is stopped
+page_token_file = os.path.join(secrets_dir, 'cache', f"watch_{calendar_file}.json")
+
+
+def now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def read_page_token():
+    try:
+        with open(page_token_file) as f:
+            return json.load(f)['page_token']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def run_commands():
+    """
+    Runs the configured commands on the courses modified since their last run.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for command in commands:
+        command = [sys.executable] + command + ['--changed-only', '--config_dir', args.config_dir, '--secrets_dir', args.secrets_dir]
+        if window:
+            # with =, as the window usually starts with a minus sign
+            command += [f'--window={window}']
+        if args.dry_run:
+            command += ['--dry-run']
+        print(f"{now()} Running {shlex.join(command)}")
+        result = subprocess.run(command, cwd=script_dir)
+        if result.returncode:
+            print(f"Error: {shlex.join(command)} exited with code {result.returncode}")
+
+
+def get_start_page_token():
+    """
+    Returns the current page token of the changes, retrying until Google Drive answers.
+    """
+    while True:
+        try:
+            page_token = gdrive.get_start_page_token()
+        except InterfaceError as error:
+            print(f"{now()} Error: {error}")
+            page_token = None
+        if page_token:
+            return page_token
+        if args.once:
+            sys.exit(1)
+        print(f"{now()} Unable to get the page token of the changes, retrying in {interval}s")
+        time.sleep(interval)
+
+
+page_token = read_page_token()
+if not page_token:
+    # first run: nothing is known about the courses processed before, process the modified courses once
+    page_token = get_start_page_token()
+    run_commands()
+    write_atomically(page_token_file, json.dumps({'page_token': page_token}))
+
+while True:
+    try:
+        changes, new_page_token = gdrive.list_changes(page_token)
+    except InterfaceError as error:
+        # Google Drive is unavailable, the same changes are listed by the next poll
+        print(f"{now()} Unable to list the changes: {error}")
+        changes, new_page_token = [], page_token
+    calendar_changes = [change for change in changes if change.get('fileId') == calendar_file]
+    if calendar_changes:
+        print(f"{now()} Calendar modified at {calendar_changes[-1].get('time')}")
+        run_commands()
+    if new_page_token and new_page_token != page_token:
+        page_token = new_page_token
+        write_atomically(page_token_file, json.dumps({'page_token': page_token}))
+
+    if args.once:
+        break
+    time.sleep(interval)
@@ -31,6 +31,7 @@ args = parser.parse_args()
 
 # read configuration files
 global_config = get_config(args)
+secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
 
 # get the events from the working calendar in the Google spreadsheets
 calendar = CQORCcalendar.Calendar(global_config, args)
@@ -40,7 +41,7 @@ if args.course_id:
 
 # initialize Zoom interface
 zoom_user = global_config['zoom']['user']
-zoom = ZoomInterface.ZoomInterface(global_config['zoom']['account_id'], global_config['zoom']['client_id'], global_config['zoom']['client_secret'], global_config['global']['timezone'], zoom_user)
+zoom = ZoomInterface.ZoomInterface(global_config['zoom']['account_id'], global_config['zoom']['client_id'], global_config['zoom']['client_secret'], global_config['global']['timezone'], zoom_user, secrets_dir=secrets_dir)
 
 webinars = []
 if args.zoom_id:
@@ -90,7 +91,7 @@ if args.verbose:
     print("===============")
 
 # initialize EventBrite interface:
-eb = Eventbrite.EventbriteInterface(global_config['eventbrite']['api_key'])
+eb = Eventbrite.EventbriteInterface(global_config['eventbrite']['api_key'], secrets_dir)
 # retrieve event from EventBrite
 eb_event = None
 if args.eventbrite_id:
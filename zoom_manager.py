@@ -5,15 +5,15 @@ import pprint
 import interfaces.zoom.ZoomInterface as ZoomInterface
 import CQORCcalendar
 
-from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, get_title
-from common import valid_date, to_iso8061, ISO_8061_FORMAT, get_config, get_title
-from common import get_trainer_keys
+from common import valid_date, ISO_8061_FORMAT, get_config, valid_window, get_consumer_name
 from common import Trainers
 from common import get_survey_link
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--date", metavar=ISO_8061_FORMAT, type=valid_date, help="Generate for the first event on this date")
 parser.add_argument("--course_id", help="Handle course specified by course_id")
+parser.add_argument("--window", metavar="START:END", type=valid_window, help="Only load the courses within this window around now, i.e. -30d:+120d")
+parser.add_argument("--changed-only", default=False, action='store_true', help="Only handle the courses added or modified since the last run with the same actions")
 parser.add_argument("--config_dir", default=".", help="Directory that holds the configuration files")
 parser.add_argument("--secrets_dir", default="./secrets", help="Directory that holds the configuration files")
 parser.add_argument("--create", default=False, action='store_true', help="Create webinar")
@@ -31,10 +31,11 @@ args = parser.parse_args()
 # read configuration files
 config = get_config(args)
 trainers = Trainers(config['global']['trainers_db'])
+secrets_dir = os.environ.get('CQORC_SECRETS_DIR', args.secrets_dir)
 
 timezone = config['google.calendar'].get('timezone', config['global']['timezone'])
 zoom_user = config['zoom']['user']
-zoom = ZoomInterface.ZoomInterface(config['zoom']['account_id'], config['zoom']['client_id'], config['zoom']['client_secret'], config['global']['timezone'], zoom_user)
+zoom = ZoomInterface.ZoomInterface(config['zoom']['account_id'], config['zoom']['client_id'], config['zoom']['client_secret'], config['global']['timezone'], zoom_user, secrets_dir=secrets_dir)
 
 
 # get the courses from the working calendar in the Google spreadsheets
@@ -43,28 +44,34 @@ courses = calendar.get_courses()
 
 # keep only courses that start on the date listed
 if args.date:
-    courses = [courses for course in courses if args.date.date().isoformat() in course['sessions'][0]['start_date']]
+    courses = calendar.courses_on(args.date.date())
 # keep only the course for the course_id specified
 if args.course_id:
     courses = [calendar[args.course_id]]
-
-for course in courses:
+# keep only the courses modified since the last run
+consumer = get_consumer_name('zoom', args)
+if args.changed_only:
+    courses = calendar.changed_courses(consumer, courses)
+
+# courses which could not be handled, they are handled again by the next run
+skipped_courses = []
+with calendar.transaction():
+    for course in courses:
 #    try:
         # no course code, continue
         first_session = course['sessions'][0]
         if not 'code' in first_session:
             continue
 
-        date = to_iso8061(first_session['start_date']).date()
+        date = first_session.start.date()
         course_code = first_session['code']
         locale = first_session['language']
-        title = get_title(first_session)
-        title = get_title(first_session)
+        title = first_session.title
 
         # for multi-session courses, the duration of the webinar must be from the start to the end
-        start_time = min([to_iso8061(session['start_date']) for session in course['sessions']])
-        end_time = max([to_iso8061(session['end_date']) for session in course['sessions']])
-        duration = (end_time - start_time).total_seconds()/60
+        start_time = course.start
+        end_time = course.end
+        duration = course.duration.total_seconds()/60
 
         if args.create:
             if first_session['zoom_id']:
@@ -77,7 +84,6 @@ for course in courses:
                 if webinar and 'id' in webinar:
                     calendar.set_zoom_id(first_session['course_id'], webinar['id'])
                     print(f"Zoom id createdfor session {first_session['course_id']} - {title}")
-                    calendar.update_spreadsheet()
                     print(f"Google spreadsheet updated with zoom id for session {first_session['course_id']} - {title}")
 
         is_placeholder_webinar = False
@@ -87,8 +93,9 @@ for course in courses:
             webinar = {'id': '<new_webinar_id>'}
             is_placeholder_webinar = True
         else:
-            print(f"No webinar found. Please create it first with the --create option")
-            exit(1)
+            print(f"No webinar found for course {first_session['course_id']} - {title}. Please create it first with the --create option")
+            skipped_courses.append(course)
+            continue
 
         if args.delete:
             if args.dry_run:
@@ -99,11 +106,10 @@ for course in courses:
                 print(f"Webinar {webinar['id']} deleted")
                 calendar.set_zoom_id(first_session['course_id'], '')
                 print(f"Zoom id deleted for session {first_session['course_id']} - {title}")
-                calendar.update_spreadsheet()
                 print(f"Google spreadsheet updated with zoom id deletion for session {first_session['course_id']} - {title}")
 
         if args.update_panelists or args.update:
-            attendee_keys = get_trainer_keys(course, ['assistants', 'instructor', 'host'])
+            attendee_keys = course.trainer_keys(['assistants', 'instructor', 'host'])
             panelists = []
             if not is_placeholder_webinar:
                 panelists = zoom.get_panelists(webinar['id'])
@@ -118,7 +124,7 @@ for course in courses:
         if args.update_hosts or args.update:
             params = {}
             settings = {}
-            settings['alternative_hosts'] = ','.join([trainers.zoom_email(k) for k in get_trainer_keys(course, ['host'])])
+            settings['alternative_hosts'] = ','.join([trainers.zoom_email(k) for k in course.trainer_keys(['host'])])
             params['settings'] = settings
             if args.dry_run:
                 print(f"Dry-run: would update hosts for webinar {webinar['id']} to {settings['alternative_hosts']}")
@@ -165,6 +171,6 @@ for course in courses:
 #        print(f"Error encountered when processing event {event}: \n\n{e}")
 
 if not args.dry_run:
-    calendar.update_spreadsheet()
+    calendar.save_state(consumer, [course for course in courses if course not in skipped_courses])
 
 